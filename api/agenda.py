@@ -0,0 +1,67 @@
+import heapq
+from itertools import islice
+
+from api.occurrences import OCCURRENCE_HORIZON, RECURRING, as_occurrence, materialization_enabled, recurring_since
+from api.utils import annotate_is_checked, filter_permitted_schedules
+from main.models import Event, EventOccurrence, Schedule
+from main.models import SchedulePermissionLevels as Level
+
+
+def agenda_key(event):
+    return event.start_date, event.id
+
+
+# Occurrences of a recurring event in [start, end) after the `after` key,
+# computed one at a time as the merge asks for them
+def occurrence_stream(event, start, end, after):
+    if after is not None:
+        start = max(start, after[0])
+    rruleset = event.recurrences.to_dateutil_rruleset(dtstart=event.start_date)
+    for occurrence in rruleset.xafter(start, inc=True):
+        if occurrence >= end:
+            return
+        if after is None or (occurrence, event.id) > after:
+            yield as_occurrence(event, occurrence)
+
+
+# The first `limit` materialized occurrences in [start, end) after the
+# `after` key, read in index order like the plain events
+def materialized_occurrences(events, recurring, schedules, start, end, after, limit):
+    rows = EventOccurrence.objects.filter(schedule__in=schedules, event__in=recurring.values('id'),
+                                          start_date__gte=start, start_date__lt=end)
+    if after is not None:
+        rows = rows.filter(start_date__gte=after[0]).exclude(start_date=after[0], event_id__lte=after[1])
+    rows = list(rows.order_by('start_date', 'event_id').values_list('event_id', 'start_date', 'end_date')[:limit])
+    by_id = events.in_bulk({event_id for event_id, _, _ in rows})
+    return [as_occurrence(by_id[event_id], start_date, end_date) for event_id, start_date, end_date in rows]
+
+
+def agenda_events(user, start, end=None, after=None, limit=50, events=None):
+    """
+    Returns at most `limit` events and occurrences of recurring events of
+    every schedule the user can read, starting in [start, end) after the
+    (start_date, id) key `after`, ordered by (start_date, id).
+
+    One query reads the first `limit` plain events of all readable schedules
+    in index order. With MATERIALIZE_OCCURRENCES so does one of the
+    occurrences; otherwise the series that haven't ended before `start` are
+    read and expanded lazily while they are merged.
+    """
+    if events is None:
+        events = Event.objects.all()
+    schedules = filter_permitted_schedules(Schedule.objects.all(), user, Level.READ_ACCESS).values('id')
+    end = end or start + OCCURRENCE_HORIZON
+    events = events.filter(schedule__in=schedules)
+    recurring = recurring_since(events, start).filter(start_date__lt=end)
+    events = annotate_is_checked(events, user)
+
+    plain = events.exclude(RECURRING).filter(start_date__gte=start, start_date__lt=end)
+    if after is not None:
+        plain = plain.filter(start_date__gte=after[0]).exclude(start_date=after[0], id__lte=after[1])
+    plain = plain.order_by('start_date', 'id')[:limit]
+    if materialization_enabled():
+        streams = [materialized_occurrences(events, recurring, schedules, start, end, after, limit)]
+    else:
+        streams = [occurrence_stream(event, start, end, after)
+                   for event in annotate_is_checked(recurring, user)]
+    return list(islice(heapq.merge(plain, *streams, key=agenda_key), limit))
@@ -0,0 +1,67 @@
+from asgiref.sync import SyncToAsync
+from django.db import close_old_connections
+
+from api.change_stream import CHANGE_POLL_WAIT, ChangePollResponse, poll_data
+from api.ical_views import EventFeed, UserFeed
+from api.views import ScheduleViewSet, EventViewSet
+
+
+class DatabaseSyncToAsync(SyncToAsync):
+    """
+    SyncToAsync for ORM access from async views.
+
+    Django 3.1 has no async ORM and runs thread sensitive sync code in one
+    shared thread, so the read views run in the default thread pool instead,
+    opening and closing their connections like a sync request would.
+    """
+
+    def thread_handler(self, loop, *args, **kwargs):
+        close_old_connections()
+        try:
+            return super().thread_handler(loop, *args, **kwargs)
+        finally:
+            close_old_connections()
+
+
+# Streamed responses are left to mimcal.handlers.StreamingASGIHandler, which
+# produces their chunks in a thread, outside the event loop
+def render_response(view, request, *args, **kwargs):
+    response = view(request, *args, **kwargs)
+    if hasattr(response, 'render'):
+        response.render()
+    return response
+
+
+def async_read_view(view):
+    render = DatabaseSyncToAsync(render_response, thread_sensitive=False)
+
+    async def async_view(request, *args, **kwargs):
+        return await render(view, request, *args, **kwargs)
+
+    async_view.csrf_exempt = True
+    return async_view
+
+
+schedule_events = async_read_view(ScheduleViewSet.as_view({'get': 'events'}))
+event_thread = async_read_view(EventViewSet.as_view({'get': 'thread'}))
+event_feed = async_read_view(EventFeed())
+user_feed = async_read_view(UserFeed())
+
+
+poll_view = ScheduleViewSet.as_view({'get': 'poll'})
+
+
+# A long poll: the response waits in the event loop, not in a thread, for
+# the changes after the client's cursor, up to CHANGE_POLL_WAIT seconds, and
+# the client polls again with the cursor it gets
+async def schedule_poll(request, *args, **kwargs):
+    request.wait_for_changes = True
+    response = await DatabaseSyncToAsync(poll_view, thread_sensitive=False)(request, *args, **kwargs)
+    if not isinstance(response, ChangePollResponse):
+        return response.render()
+    try:
+        messages = await response.subscription.get_async(CHANGE_POLL_WAIT)
+    finally:
+        response.subscription.close()
+    response.data = poll_data(response.subscription, messages, 0)
+    return response.render()
@@ -0,0 +1,64 @@
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.translation import gettext_lazy as _
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication
+
+from mimcal.db_routers import primary_reads
+
+AUTH_TOKEN_CACHE_TIMEOUT = getattr(settings, 'AUTH_TOKEN_CACHE_TIMEOUT', 300)
+
+
+def _cache_key(key):
+    # tokens are credentials, so they don't end up in cache keys as they are
+    return 'auth-token:%s' % hashlib.sha256(key.encode()).hexdigest()
+
+
+# TokenAuthentication resolving tokens through the default cache, whose own
+# culling bounds the number of entries. Entries are deleted when the token is
+# deleted (e.g. on logout) and whenever its user is saved, which only reaches
+# every process through a shared cache (see api.checks). The outcome is kept
+# on the request, so middleware that needs the user before DRF authenticates
+# (see token_user()) doesn't make the request resolve its token twice.
+class CachedTokenAuthentication(TokenAuthentication):
+    def authenticate(self, request):
+        http_request = getattr(request, '_request', request)
+        if not hasattr(http_request, '_token_auth'):
+            try:
+                http_request._token_auth = super().authenticate(request)
+            except exceptions.AuthenticationFailed as e:
+                http_request._token_auth = e
+        if isinstance(http_request._token_auth, exceptions.AuthenticationFailed):
+            raise http_request._token_auth
+        return http_request._token_auth
+
+    def authenticate_credentials(self, key):
+        cache_key = _cache_key(key)
+        token = cache.get(cache_key)
+        if token is None:
+            model = self.get_model()
+            try:
+                # a token issued a moment ago may not be on the replica yet
+                with primary_reads():
+                    token = model.objects.select_related('user').get(key=key)
+            except model.DoesNotExist:
+                raise exceptions.AuthenticationFailed(_('Invalid token.'))
+            cache.set(cache_key, token, AUTH_TOKEN_CACHE_TIMEOUT)
+        if not token.user.is_active:
+            raise exceptions.AuthenticationFailed(_('User inactive or deleted.'))
+        return (token.user, token)
+
+
+# The user of the token a request is sent with, or None
+def token_user(request):
+    try:
+        user, _ = CachedTokenAuthentication().authenticate(request) or (None, None)
+    except exceptions.AuthenticationFailed:
+        return None
+    return user
+
+
+def invalidate_tokens(keys):
+    cache.delete_many([_cache_key(key) for key in keys])
@@ -0,0 +1,178 @@
+from django.db import connection, transaction
+from django.utils import timezone
+from rest_framework import serializers
+
+from api.changes import record_changes
+from api.occurrences import materialization_enabled, materialize_occurrences
+from api.serializers import EventSerializer
+from api.signals import schedules_changed
+from api.utils import check_permission_to_schedule
+from main.models import Event, EventType, Schedule
+from main.models import SchedulePermissionLevels as Level
+
+BULK_EVENTS_LIMIT = 5000
+OPERATIONS = ('create', 'update', 'delete')
+STATUSES = {'create': 'created', 'update': 'updated', 'delete': 'deleted'}
+
+
+class PreloadedPrimaryKeyRelatedField(serializers.PrimaryKeyRelatedField):
+    # looks objects up in context['preloaded'][model] instead of one query per value
+    def to_internal_value(self, data):
+        objects = self.context['preloaded'][self.get_queryset().model]
+        try:
+            return objects[int(data)]
+        except KeyError:
+            self.fail('does_not_exist', pk_value=data)
+        except (TypeError, ValueError):
+            self.fail('incorrect_type', data_type=type(data).__name__)
+
+
+class BulkEventSerializer(EventSerializer):
+    schedule = PreloadedPrimaryKeyRelatedField(queryset=Schedule.objects.all())
+    type = PreloadedPrimaryKeyRelatedField(queryset=EventType.objects.all())
+
+    # the same rule as api.importers, updates may change one of the dates
+    def validate(self, attrs):
+        attrs = super().validate(attrs)
+        start = attrs.get('start_date', getattr(self.instance, 'start_date', None))
+        end = attrs.get('end_date', getattr(self.instance, 'end_date', None))
+        if start is not None and end is not None and end < start:
+            raise serializers.ValidationError({'end_date': ['The event ends before it starts.']})
+        return attrs
+
+
+def _related_ids(operations, field):
+    ids = set()
+    for operation in operations:
+        try:
+            ids.add(int(operation['data'][field]))
+        except (KeyError, TypeError, ValueError):
+            pass
+    return ids
+
+
+def _op(operation):
+    return operation.get('op') if isinstance(operation, dict) else None
+
+
+def _parse(operations):
+    errors = []
+    event_ids = set()
+    for operation in operations:
+        if _op(operation) not in OPERATIONS:
+            errors.append({'op': ['Expected one of: %s.' % ', '.join(OPERATIONS)]})
+            continue
+        if operation['op'] != 'delete' and not isinstance(operation.get('data'), dict):
+            errors.append({'data': ['Expected an object.']})
+            continue
+        if operation['op'] == 'create':
+            errors.append(None)
+            continue
+        try:
+            event_id = int(operation.get('id'))
+        except (TypeError, ValueError):
+            errors.append({'id': ['A valid integer is required.']})
+            continue
+        if event_id in event_ids:
+            errors.append({'id': ['Event %d appears more than once.' % event_id]})
+            continue
+        event_ids.add(event_id)
+        errors.append(None)
+    return errors, event_ids
+
+
+# Validates every operation, checks each touched schedule once and applies
+# all of them in one transaction. Returns (applied, results), results are in
+# the order of operations.
+def apply_event_operations(operations, user):
+    errors, event_ids = _parse(operations)
+    events = Event.objects.select_related('schedule').in_bulk(event_ids)
+    context = {'user_id': user, 'preloaded': {
+        Schedule: Schedule.objects.in_bulk(_related_ids(operations, 'schedule')),
+        EventType: EventType.objects.in_bulk(_related_ids(operations, 'type')),
+    }}
+
+    validated = []
+    for operation, error in zip(operations, errors):
+        if error is not None:
+            validated.append(error)
+            continue
+        instance = None
+        if operation['op'] != 'create':
+            instance = events.get(int(operation['id']))
+            if instance is None:
+                validated.append({'id': ['Event %s does not exist.' % operation['id']]})
+                continue
+        if operation['op'] == 'delete':
+            validated.append(instance)
+            continue
+        serializer = BulkEventSerializer(instance, data=operation['data'], partial=instance is not None,
+                                         context=context)
+        validated.append(serializer if serializer.is_valid() else serializer.errors)
+
+    failed = [not isinstance(item, (Event, BulkEventSerializer)) for item in validated]
+    if any(failed):
+        results = []
+        for operation, item, item_failed in zip(operations, validated, failed):
+            result = {'op': _op(operation), 'status': 'invalid' if item_failed else 'valid'}
+            if item_failed:
+                result['errors'] = item
+            results.append(result)
+        return False, results
+
+    schedules = {}
+    for item in validated:
+        if isinstance(item, Event):
+            schedules[item.schedule_id] = item.schedule
+        else:
+            if item.instance is not None:
+                schedules[item.instance.schedule_id] = item.instance.schedule
+            if 'schedule' in item.validated_data:
+                schedules[item.validated_data['schedule'].id] = item.validated_data['schedule']
+    for schedule in schedules.values():
+        check_permission_to_schedule(user, Level.READ_WRITE_ACCESS, schedule)
+
+    created, updated, deleted, update_fields, moved = [], [], [], set(), []
+    for item in validated:
+        if isinstance(item, Event):
+            deleted.append(item)
+        elif item.instance is None:
+            created.append(Event(**item.validated_data))
+        else:
+            moved.append((item.instance.schedule_id, item.instance))
+            for field, value in item.validated_data.items():
+                setattr(item.instance, field, value)
+            update_fields.update(item.validated_data)
+            updated.append(item.instance)
+
+    # bulk writes skip Event.save()
+    for event in created + updated:
+        event.update_recurrence_end()
+    with transaction.atomic():
+        if connection.features.can_return_rows_from_bulk_insert:
+            Event.objects.bulk_create(created)
+            record_changes('event', 'created', [(event.schedule_id, event.id) for event in created])
+        else:
+            # the backend can't report ids of bulk inserted rows, save() records the changes
+            for event in created:
+                event.save()
+        if updated and update_fields:
+            now = timezone.now()
+            for event in updated:
+                event.updated_at = now
+            Event.objects.bulk_update(updated, update_fields | {'updated_at', 'recurrence_end'})
+        Event.objects.filter(id__in=[event.id for event in deleted]).delete()
+        if materialization_enabled():
+            materialize_occurrences(created + updated)
+        schedules_changed(list(schedules))
+        # deleting through the queryset still sends post_delete
+        record_changes('event', 'updated', [(event.schedule_id, event.id) for event in updated])
+        record_changes('event', 'deleted', [(previous_schedule_id, event.id) for previous_schedule_id, event in moved
+                                            if previous_schedule_id != event.schedule_id])
+
+    results = []
+    created = iter(created)
+    for operation in operations:
+        event_id = next(created).id if operation['op'] == 'create' else int(operation['id'])
+        results.append({'op': operation['op'], 'status': STATUSES[operation['op']], 'id': event_id})
+    return True, results
@@ -0,0 +1,77 @@
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from main.models import Schedule, new_version_token
+from mimcal.db_routers import primary_reads
+
+RESPONSE_CACHE_TIMEOUT = getattr(settings, 'RESPONSE_CACHE_TIMEOUT', 60 * 60)
+VERSION_CACHE_TIMEOUT = getattr(settings, 'VERSION_CACHE_TIMEOUT', 60 * 60)
+
+
+def _version_key(schedule_id):
+    return 'schedule-version:%d' % schedule_id
+
+
+# Every schedule has an opaque version token that changes whenever its
+# content does. Entries derived from a schedule embed the token in their key,
+# so invalidation is a single write and stale entries simply age out. The
+# token is stored on the schedule, so every process agrees on it even when
+# the cache loses it, and cached for VERSION_CACHE_TIMEOUT seconds.
+def get_schedule_version(schedule_id):
+    key = _version_key(schedule_id)
+    version = cache.get(key)
+    if version is None:
+        version = _read_versions([schedule_id]).get(schedule_id)
+        if version is None:
+            # no such schedule, nothing derived from it may be reused
+            return _new_version()
+        cache.set(key, version, VERSION_CACHE_TIMEOUT)
+    return version
+
+
+def _new_version():
+    return {'token': new_version_token(), 'modified': timezone.now().replace(microsecond=0)}
+
+
+def _read_versions(schedule_ids):
+    with primary_reads():
+        rows = list(Schedule.objects.filter(id__in=schedule_ids).values_list('id', 'version_token', 'version_modified'))
+    return {schedule_id: {'token': token, 'modified': modified.replace(microsecond=0)}
+            for schedule_id, token, modified in rows}
+
+
+# Only a committed version is stored, inside a transaction the new token is
+# just cached (see api.signals.schedules_changed)
+def bump_schedule_version(schedule_id, store=True):
+    version = _new_version()
+    if store:
+        Schedule.objects.filter(id=schedule_id).update(version_token=version['token'],
+                                                       version_modified=version['modified'])
+    cache.set(_version_key(schedule_id), version, VERSION_CACHE_TIMEOUT)
+
+
+# One version of the content of several schedules, e.g. of a feed combining
+# them; it changes when any of them changes or the set of schedules does
+def get_combined_version(schedule_ids):
+    keys = {schedule_id: _version_key(schedule_id) for schedule_id in schedule_ids}
+    cached = cache.get_many(list(keys.values()))
+    versions = {schedule_id: cached[key] for schedule_id, key in keys.items() if key in cached}
+    missing = _read_versions([schedule_id for schedule_id in schedule_ids if schedule_id not in versions])
+    cache.set_many({keys[schedule_id]: version for schedule_id, version in missing.items()},
+                   VERSION_CACHE_TIMEOUT)
+    versions.update(missing)
+    tokens, modified = [], None
+    for schedule_id in sorted(versions):
+        version = versions[schedule_id]
+        tokens.append('%d:%s' % (schedule_id, version['token']))
+        modified = max(modified, version['modified']) if modified else version['modified']
+    return {'token': hashlib.sha1('|'.join(tokens).encode()).hexdigest(), 'modified': modified}
+
+
+# `variant` is whatever else the response depends on, e.g. the query string
+def response_cache_key(schedule_id, variant):
+    return 'schedule-response:%d:%s:%s' % (schedule_id, get_schedule_version(schedule_id)['token'],
+                                           hashlib.sha1(variant.encode()).hexdigest())
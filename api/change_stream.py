@@ -0,0 +1,174 @@
+import asyncio
+import itertools
+import queue
+import threading
+from collections import defaultdict, deque
+
+from django.conf import settings
+from django.db import transaction
+from django.utils.module_loading import import_string
+from rest_framework.response import Response
+
+CHANGE_STREAM_BROKER = getattr(settings, 'CHANGE_STREAM_BROKER', 'api.changes.ChangeLogBroker')
+CHANGE_STREAM_REPLAY = getattr(settings, 'CHANGE_STREAM_REPLAY', 100)
+CHANGE_POLL_WAIT = getattr(settings, 'CHANGE_POLL_WAIT', 15)
+CHANGE_POLL_SYNC_RETRY = getattr(settings, 'CHANGE_POLL_SYNC_RETRY', 5)
+
+
+class Subscription:
+    """
+    Messages of the subscribed schedules, as (id, message) pairs.
+
+    Brokers call put() from whatever thread receives the message, readers
+    wait for them with get() in a sync view or get_async() in an event loop.
+    The next poll resumes after cursor, which the broker advances past
+    every message it has surely delivered.
+    """
+
+    def __init__(self, broker, channels):
+        self.broker = broker
+        self.channels = channels
+        self.queue = queue.Queue()
+        self.waiter = None
+        self.cursor = 0
+
+    def put(self, message_id, message):
+        self.queue.put((message_id, message))
+        waiter = self.waiter
+        if waiter is not None:
+            loop, event = waiter
+            loop.call_soon_threadsafe(event.set)
+
+    def drain(self):
+        messages = []
+        while True:
+            try:
+                messages.append(self.queue.get_nowait())
+            except queue.Empty:
+                return messages
+
+    def get(self, timeout):
+        try:
+            messages = [self.queue.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        return messages + self.drain()
+
+    async def get_async(self, timeout):
+        event = asyncio.Event()
+        self.waiter = (asyncio.get_event_loop(), event)
+        try:
+            # a message may have arrived before the waiter was set
+            if self.queue.empty():
+                await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self.waiter = None
+        return self.drain()
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class BaseBroker:
+    """
+    Fans messages published for a schedule out to its subscriptions.
+
+    Backends shared between processes subclass this and call put() on the
+    local subscriptions of a channel when a message for it arrives.
+    """
+
+    def publish(self, channel, message):
+        raise NotImplementedError
+
+    def subscribe(self, channels, after=None):
+        raise NotImplementedError
+
+    def unsubscribe(self, subscription):
+        raise NotImplementedError
+
+
+class InProcessBroker(BaseBroker):
+    """
+    Reaches only subscribers in the same process, so it suits development
+    with a single worker; ids restart with the process.
+
+    The last CHANGE_STREAM_REPLAY messages of every channel are kept, so a
+    client polling again doesn't miss what was published in between.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.last_id = 0
+        self.subscriptions = defaultdict(set)
+        self.history = defaultdict(lambda: deque(maxlen=CHANGE_STREAM_REPLAY))
+
+    def publish(self, channel, message):
+        with self.lock:
+            message_id = self.last_id = next(self.ids)
+            self.history[channel].append((message_id, message))
+            subscriptions = list(self.subscriptions.get(channel, ()))
+        for subscription in subscriptions:
+            subscription.put(message_id, message)
+            subscription.cursor = message_id
+
+    def subscribe(self, channels, after=None):
+        subscription = Subscription(self, channels)
+        with self.lock:
+            if after is not None:
+                missed = sorted(item for channel in channels for item in self.history[channel]
+                                if item[0] > after)
+                for message_id, message in missed:
+                    subscription.put(message_id, message)
+            subscription.cursor = self.last_id
+            for channel in channels:
+                self.subscriptions[channel].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            for channel in subscription.channels:
+                subscriptions = self.subscriptions.get(channel, set())
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    self.subscriptions.pop(channel, None)
+
+
+_broker = None
+
+
+def get_broker():
+    global _broker
+    if _broker is None:
+        _broker = import_string(CHANGE_STREAM_BROKER)()
+    return _broker
+
+
+# Messages are sent once the change is committed, e.g.
+# {"kind": "event", "action": "updated", "id": 12}
+def publish_change(schedule_id, kind, action, **data):
+    if schedule_id is None:
+        return
+    message = dict(kind=kind, action=action, **data)
+    transaction.on_commit(lambda: get_broker().publish(schedule_id, message))
+
+
+# The cursor may be behind the last change: changes past it are sent again
+# rather than skipped
+def poll_data(subscription, messages, retry_after):
+    return {'cursor': subscription.cursor, 'retry_after': retry_after,
+            'changes': [message for _, message in messages]}
+
+
+class ChangePollResponse(Response):
+    """
+    A long poll waiting for changes, see async_views.schedule_poll, which
+    fills in its data once they arrive or CHANGE_POLL_WAIT runs out.
+    """
+
+    def __init__(self, subscription):
+        super().__init__()
+        self.subscription = subscription
+        self['Cache-Control'] = 'no-cache'
@@ -0,0 +1,202 @@
+import logging
+import threading
+import time
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, connections
+from django.db.models import Max
+from django.utils import timezone
+
+from api.change_stream import CHANGE_STREAM_REPLAY, BaseBroker, Subscription, publish_change
+from main.models import ScheduleChange
+from mimcal.db_routers import primary_reads
+
+logger = logging.getLogger(__name__)
+
+# Rows of the last few seconds are sent again on the next sync, so a
+# transaction that took a lower id but committed later isn't skipped
+CHANGES_SETTLE_SECONDS = getattr(settings, 'CHANGES_SETTLE_SECONDS', 5)
+CHANGES_PAGE_SIZE = getattr(settings, 'CHANGES_PAGE_SIZE', 500)
+CHANGE_LOG_RETENTION_DAYS = getattr(settings, 'CHANGE_LOG_RETENTION_DAYS', 30)
+CHANGE_STREAM_POLL_INTERVAL = getattr(settings, 'CHANGE_STREAM_POLL_INTERVAL', 1)
+
+
+class ChangeTokenExpired(Exception):
+    pass
+
+
+# Logs the change for delta sync and pushes it to the schedule's stream
+def record_change(schedule_id, kind, action, object_id, **data):
+    record_changes(kind, action, [(schedule_id, object_id)], **data)
+
+
+def record_changes(kind, action, changes, **data):
+    changes = [(schedule_id, object_id) for schedule_id, object_id in changes if schedule_id is not None]
+    log_changes(kind, action == 'deleted', changes,
+                [dict(kind=kind, action=action, id=object_id, **data) for _, object_id in changes])
+    for schedule_id, object_id in changes:
+        publish_change(schedule_id, kind, action, id=object_id, **data)
+
+
+# Streams a message that delta sync has no object for, e.g. of an import
+def record_message(schedule_id, kind, action, **data):
+    message = dict(kind=kind, action=action, **data)
+    ScheduleChange.objects.create(schedule_id=schedule_id, kind='message', object_id=0, message=message)
+    publish_change(schedule_id, kind, action, **data)
+
+
+# Without messages the changes are only seen by delta sync
+def log_changes(kind, deleted, changes, messages=None):
+    messages = messages or [None] * len(changes)
+    ScheduleChange.objects.bulk_create([
+        ScheduleChange(schedule_id=schedule_id, kind=kind, object_id=object_id, deleted=deleted, message=message)
+        for (schedule_id, object_id), message in zip(changes, messages)])
+
+
+def settled_before():
+    return timezone.now() - timedelta(seconds=CHANGES_SETTLE_SECONDS)
+
+
+def current_token():
+    return ScheduleChange.objects.filter(created_at__lte=settled_before()).aggregate(token=Max('id'))['token'] or 0
+
+
+def changes_since(schedule_id, since):
+    """
+    Returns (token, {kind: ids of created or updated objects}, {kind: ids of
+    deleted objects}, more) for at most CHANGES_PAGE_SIZE logged changes.
+    """
+    if since and not ScheduleChange.objects.filter(id=since).exists():
+        raise ChangeTokenExpired
+    settled = settled_before()
+    log = list(ScheduleChange.objects.filter(schedule_id=schedule_id, id__gt=since).order_by('id')
+               .values_list('id', 'kind', 'object_id', 'deleted', 'created_at')[:CHANGES_PAGE_SIZE + 1])
+    more = len(log) > CHANGES_PAGE_SIZE
+    log = log[:CHANGES_PAGE_SIZE]
+    # past unsettled rows everything is unsettled, the client retries later
+    more = more and log[-1][4] <= settled
+
+    latest = {}
+    token = since
+    for change_id, kind, object_id, deleted, created_at in log:
+        latest[kind, object_id] = deleted
+        if created_at <= settled:
+            token = change_id
+    if not more:
+        # keeps the token of a quiet schedule from expiring
+        token = max(token, current_token())
+
+    upserted, deleted = {}, {}
+    for (kind, object_id), is_deleted in latest.items():
+        (deleted if is_deleted else upserted).setdefault(kind, []).append(object_id)
+    return token, upserted, deleted, more
+
+
+def prune_changes():
+    expired = timezone.now() - timedelta(days=CHANGE_LOG_RETENTION_DAYS)
+    deleted, _ = ScheduleChange.objects.filter(created_at__lt=expired).delete()
+    return deleted
+
+
+class ChangeLogBroker(BaseBroker):
+    """
+    Hands the messages of the change log to subscribers, so the long polls
+    of every process see the changes committed by any of them. This is
+    polling too: while the process has subscriptions a thread reads the log
+    every CHANGE_STREAM_POLL_INTERVAL seconds. Like delta sync, a subscription's
+    cursor only moves over settled rows, so a transaction that took a lower
+    id but committed later is still sent; until then the ids sent past the
+    cursor are remembered and not sent twice.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscriptions = defaultdict(set)
+        self.sent = {}
+        self.thread = None
+
+    def publish(self, channel, message):
+        # record_changes() has put the message in the log
+        pass
+
+    def subscribe(self, channels, after=None):
+        subscription = Subscription(self, channels)
+        sent = set()
+        with primary_reads():
+            subscription.cursor = token = current_token()
+            if after is not None:
+                settled = settled_before()
+                log = list(ScheduleChange.objects.filter(schedule_id__in=channels, id__gt=after,
+                                                         message__isnull=False)
+                           .order_by('id').values_list('id', 'message', 'created_at')[:CHANGE_STREAM_REPLAY + 1])
+                more = len(log) > CHANGE_STREAM_REPLAY
+                log = log[:CHANGE_STREAM_REPLAY]
+                cursor, settling = after, False
+                for change_id, message, created_at in log:
+                    subscription.put(change_id, message)
+                    sent.add(change_id)
+                    settling = settling or created_at > settled
+                    if not settling:
+                        cursor = change_id
+                if more:
+                    # the client comes back for the rest, live messages would skip it
+                    subscription.cursor = cursor
+                    return subscription
+                if not settling:
+                    cursor = max(cursor, token)
+                subscription.cursor = cursor
+        with self.lock:
+            self.sent[subscription] = {change_id for change_id in sent if change_id > subscription.cursor}
+            for channel in channels:
+                self.subscriptions[channel].add(subscription)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='change-log-broker', daemon=True)
+                self.thread.start()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self.sent.pop(subscription, None)
+            for channel in subscription.channels:
+                subscriptions = self.subscriptions.get(channel, set())
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    self.subscriptions.pop(channel, None)
+
+    def run(self):
+        while True:
+            time.sleep(CHANGE_STREAM_POLL_INTERVAL)
+            with self.lock:
+                if not self.sent:
+                    self.thread = None
+                    break
+                subscriptions = list(self.sent.items())
+            try:
+                with primary_reads():
+                    self.poll(subscriptions)
+            except Exception:
+                logger.exception('Reading the change log failed')
+            finally:
+                close_old_connections()
+        connections.close_all()
+
+    def poll(self, subscriptions):
+        # rows up to the token are committed, so all of them are read below
+        token = current_token()
+        log = (ScheduleChange.objects
+               .filter(schedule_id__in={channel for subscription, _ in subscriptions
+                                        for channel in subscription.channels},
+                       id__gt=min(subscription.cursor for subscription, _ in subscriptions),
+                       message__isnull=False)
+               .order_by('id').values_list('id', 'schedule_id', 'message'))
+        for change_id, schedule_id, message in log:
+            for subscription, sent in subscriptions:
+                if schedule_id in subscription.channels and change_id > subscription.cursor \
+                        and change_id not in sent:
+                    subscription.put(change_id, message)
+                    sent.add(change_id)
+        for subscription, sent in subscriptions:
+            subscription.cursor = max(subscription.cursor, token)
+            sent.difference_update([change_id for change_id in sent if change_id <= token])
@@ -0,0 +1,23 @@
+from django.conf import settings
+from django.core.checks import Error, Tags, register
+
+# Backends whose entries live in the memory of one process
+PROCESS_LOCAL_CACHES = (
+    'django.core.cache.backends.locmem.LocMemCache',
+)
+
+
+# Resolved tokens, permission maps and schedule versions are invalidated in
+# the cache of the process that handled the change. With a cache per process
+# the others keep e.g. authenticating a revoked token until it expires, which
+# is fine for a single development process but not for a deployment.
+@register(Tags.caches, deploy=True)
+def check_shared_cache(app_configs, **kwargs):
+    backend = settings.CACHES.get('default', {}).get('BACKEND')
+    if backend not in PROCESS_LOCAL_CACHES:
+        return []
+    return [Error(
+        'The default cache %s is not shared between processes.' % backend,
+        hint='Set REDIS_URL, or CACHE_BACKEND and CACHE_LOCATION for another shared cache.',
+        id='api.E001',
+    )]
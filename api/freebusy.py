@@ -0,0 +1,90 @@
+from itertools import chain
+
+import icalendar
+import pytz
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+
+from api.ical_views import PRODUCT_ID
+from api.occurrences import RECURRING, materialization_enabled, not_ended_before, occurrence_starts
+from api.utils import filter_permitted_schedules
+from main.models import Event, EventOccurrence, Schedule
+from main.models import SchedulePermissionLevels as Level
+
+FREEBUSY_MAX_DAYS = getattr(settings, 'FREEBUSY_MAX_DAYS', 92)
+
+
+# Sort and sweep: an interval starting before the current one ends extends it
+def merge_intervals(intervals):
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return [tuple(interval) for interval in merged]
+
+
+def busy_intervals(user, start, end, checked=False):
+    """
+    Merged (start, end) intervals in [start, end) taken by events of the
+    schedules the user can read, or only by the events they checked.
+    Events are read in one range query, recurring ones that haven't ended
+    before the window are expanded here, or with MATERIALIZE_OCCURRENCES
+    their occurrences are read in a second range query.
+    """
+    schedules = filter_permitted_schedules(Schedule.objects.all(), user, Level.READ_ACCESS).values('id')
+    events = Event.objects.filter(schedule__in=schedules, start_date__lt=end)
+    if checked:
+        events = events.filter(users_marks=user)
+    if materialization_enabled():
+        occurrences = EventOccurrence.objects.filter(event__in=events.filter(RECURRING).values('id'),
+                                                     start_date__lt=end, end_date__gt=start)
+        intervals = [(max(busy_start, start), min(busy_end, end)) for busy_start, busy_end in chain(
+            events.exclude(RECURRING).filter(end_date__gt=start).values_list('start_date', 'end_date'),
+            occurrences.values_list('start_date', 'end_date'))]
+    else:
+        intervals = []
+        events = events.filter(Q(end_date__gt=start) | RECURRING & not_ended_before(start))
+        for event in events.only('start_date', 'end_date', 'recurrences'):
+            duration = event.end_date - event.start_date
+            # occurrences starting before the window may still overlap it
+            for occurrence in occurrence_starts(event, start - duration, end):
+                if occurrence + duration > start:
+                    intervals.append((max(occurrence, start), min(occurrence + duration, end)))
+    return merge_intervals(interval for interval in intervals if interval[0] < interval[1])
+
+
+# datetimes are naive in TIME_ZONE (UTC), FREEBUSY periods must be in UTC;
+# icalendar writes dates with a Z and no TZID only for pytz.utc
+def _utc(value):
+    return pytz.utc.localize(value) if timezone.is_naive(value) else value.astimezone(pytz.utc)
+
+
+class FreeBusyRenderer(BaseRenderer):
+    media_type = 'text/calendar'
+    format = 'ics'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if 'busy' not in data:
+            # errors keep their JSON body
+            return JSONRenderer().render(data)
+        freebusy = icalendar.FreeBusy()
+        freebusy.add('uid', 'freebusy-%s-%s@mimcal' % (_utc(data['from']).strftime('%Y%m%dT%H%M%SZ'),
+                                                        _utc(data['to']).strftime('%Y%m%dT%H%M%SZ')))
+        freebusy.add('dtstamp', _utc(timezone.now().replace(microsecond=0)))
+        freebusy.add('dtstart', _utc(data['from']))
+        freebusy.add('dtend', _utc(data['to']))
+        for interval in data['busy']:
+            period = icalendar.vPeriod((_utc(interval['start']), _utc(interval['end'])))
+            # periods are in UTC, which must not be given as a TZID
+            period.params.pop('TZID', None)
+            freebusy.add('freebusy', period)
+        calendar = icalendar.Calendar()
+        calendar.add('prodid', PRODUCT_ID)
+        calendar.add('version', '2.0')
+        calendar.add_component(freebusy)
+        return calendar.to_ical()
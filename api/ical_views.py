@@ -1,17 +1,118 @@
+import copy
+from itertools import islice
+
+from django.conf import settings
+from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, StreamingHttpResponse
+from django.views.decorators.http import condition
+from django.db.models import Q
 from django_ical.feedgenerator import ICal20Feed
+from django_ical.utils import build_rrule_from_recurrences_rrule
 from django_ical.views import ICalFeed
-from main.models import Event, Schedule
-from api.utils import has_permission_to_schedule
+from icalendar import Calendar
+from rest_framework.exceptions import ValidationError
+from main.models import Event, FeedToken, Schedule, SchedulePermission
+from main.models import SchedulePermissionLevels as Level
+from api.caching import get_combined_version, get_schedule_version
+from api.occurrences import RECURRING
+from api.utils import filter_permitted_schedules, has_permission_to_schedule, parse_datetime_param
+from mimcal.db_routers import read_from_primary, reset_replica, route_request
+
+FEED_CACHE_TIMEOUT = getattr(settings, 'FEED_CACHE_TIMEOUT', 60 * 60 * 24)
+# Feeds with more events than this are streamed instead of rendered and cached
+FEED_STREAM_THRESHOLD = getattr(settings, 'FEED_STREAM_THRESHOLD', 2000)
+FEED_STREAM_CHUNK_SIZE = getattr(settings, 'FEED_STREAM_CHUNK_SIZE', 500)
 
-from django.contrib.auth.mixins import UserPassesTestMixin
+FEED_CONTENT_TYPE = "text/calendar, text/x-vcalendar, application/hbs-vcs"
+PRODUCT_ID = '-//Mimuw//Mimcal 21.3777//EN'
 
 
 class EventFeed(ICalFeed):
     feed_type = ICal20Feed
-    product_id = '-//Mimuw//Mimcal 21.3777//EN'
+    product_id = PRODUCT_ID
     timezone = 'Europe/Warsaw'
 
+    def __call__(self, request, **kwargs):
+        token = route_request(request)
+        try:
+            return self.serve(request, **kwargs)
+        finally:
+            if token is not None:
+                reset_replica(token)
+
+    def serve(self, request, **kwargs):
+        try:
+            schedule = self.get_object(request, **kwargs)
+        except ObjectDoesNotExist:
+            raise Http404("Feed object does not exist.")
+        try:
+            schedule.feed_window = (parse_datetime_param(request.GET, 'from'),
+                                    parse_datetime_param(request.GET, 'to'))
+        except ValidationError as e:
+            return HttpResponseBadRequest(str(e.detail[0]))
+        version = self.get_version(schedule)
+
+        @condition(etag_func=lambda request: version['token'],
+                   last_modified_func=lambda request: version['modified'])
+        def feed_view(request):
+            stream = self.stream_requested(request)
+            key = '%s:%s:%s' % (self.cache_key(schedule), version['token'],
+                                '-'.join(d.isoformat() if d else '' for d in schedule.feed_window))
+            content = None if stream else cache.get(key)
+            if content is None and stream is None:
+                stream = self.items(schedule).count() > FEED_STREAM_THRESHOLD
+            if stream:
+                response = StreamingHttpResponse(self.stream_feed(request, schedule), content_type=FEED_CONTENT_TYPE)
+            else:
+                if content is None:
+                    # cached under the current version, which the replica may not have yet
+                    read_from_primary()
+                    content = self.render_feed(request, schedule)
+                    cache.set(key, content, FEED_CACHE_TIMEOUT)
+                response = HttpResponse(content, content_type=FEED_CONTENT_TYPE)
+            response["Content-Disposition"] = 'attachment; filename="%s"' % self.file_name(schedule)
+            return response
+
+        return feed_view(request)
+
+    # ?stream=1/0 forces a mode, otherwise it depends on FEED_STREAM_THRESHOLD
+    def stream_requested(self, request):
+        if 'stream' not in request.GET:
+            return None
+        return request.GET['stream'] not in ('', '0', 'false')
+
+    def render_feed(self, request, schedule):
+        return self.write_feed(self.get_feed(schedule, request))
+
+    def write_feed(self, feedgen):
+        response = HttpResponse()
+        feedgen.write(response, "utf-8")
+        return response.content
+
+    # Yields the same bytes as render_feed: the calendar header, then the
+    # VEVENTs of one chunk of events at a time, then the closing line.
+    def stream_feed(self, request, schedule):
+        header = self.get_feed_for_items(schedule, request, [])
+        end = b'END:VCALENDAR\r\n'
+        yield self.write_feed(header)[:-len(end)]
+
+        events = self.items(schedule).iterator(chunk_size=FEED_STREAM_CHUNK_SIZE)
+        while True:
+            chunk = list(islice(events, FEED_STREAM_CHUNK_SIZE))
+            if not chunk:
+                break
+            calendar = Calendar()
+            self.get_feed_for_items(schedule, request, chunk).write_items(calendar)
+            yield b''.join(component.to_ical() for component in calendar.subcomponents)
+        yield end
+
+    def get_feed_for_items(self, schedule, request, items):
+        # the feed instance is shared between requests, so override items on a copy
+        feed = copy.copy(self)
+        feed.items = lambda obj: items
+        return feed.get_feed(schedule, request)
+
     def file_name(self, obj):
         return "mimcal-%s.ics" % (obj.id)
 
@@ -20,12 +121,30 @@ class EventFeed(ICalFeed):
 
     def get_object(self, request, schedule_id):
         schedule = Schedule.objects.get(id=schedule_id)
-        # if not has_permission_to_schedule(request.user, 1, schedule):
-        #     raise ObjectDoesNotExist
+        if not has_permission_to_schedule(request.user, Level.READ_ACCESS, schedule):
+            raise ObjectDoesNotExist
         return schedule
 
+    # the ETag and Last-Modified of the feed, rendered feeds are cached under it
+    def get_version(self, schedule):
+        return get_schedule_version(schedule.id)
+
+    def cache_key(self, schedule):
+        return 'ical-feed:%d' % schedule.id
+
+    def events(self, schedule):
+        return Event.objects.filter(schedule=schedule)
+
+    # recurring events are emitted once, with their RRULE, if the series
+    # starts before the end of the window
     def items(self, schedule: Schedule):
-        return Event.objects.filter(schedule=schedule).order_by('-start_date')
+        events = self.events(schedule)
+        start, end = getattr(schedule, 'feed_window', (None, None))
+        if start:
+            events = events.filter(Q(start_date__gte=start) | RECURRING)
+        if end:
+            events = events.filter(start_date__lt=end)
+        return events.order_by('-start_date')
 
     def item_title(self, event: Event):
         return event.title
@@ -39,8 +158,61 @@ class EventFeed(ICalFeed):
     def item_end_datetime(self, event: Event):
         return event.end_date
 
+    def item_rrule(self, event: Event):
+        if event.recurrences:
+            return [build_rrule_from_recurrences_rrule(rule) for rule in event.recurrences.rrules]
+
+    def item_exrule(self, event: Event):
+        if event.recurrences:
+            return [build_rrule_from_recurrences_rrule(rule) for rule in event.recurrences.exrules]
+
+    def item_rdate(self, event: Event):
+        if event.recurrences:
+            return event.recurrences.rdates
+
+    def item_exdate(self, event: Event):
+        if event.recurrences:
+            return event.recurrences.exdates
+
     def item_link(self, item):
         return ''
 
     def item_guid(self, item):
         return "mimcal:" + str(item.id)
+
+
+# The schedules of a user's feed: those they have a permission on (owners
+# have one), when it or the default level lets them read the schedule
+def feed_schedule_ids(user):
+    schedules = Schedule.objects.filter(id__in=SchedulePermission.objects.filter(user=user).values('schedule'))
+    return list(filter_permitted_schedules(schedules, user, Level.READ_ACCESS).values_list('id', flat=True))
+
+
+class PersonalFeed:
+    def __init__(self, user, schedule_ids):
+        self.id = user.id
+        self.name = 'Mimcal: %s' % user.username
+        self.schedule_ids = schedule_ids
+
+
+# All schedules of a user in one feed, at a URL with their FeedToken. The
+# schedule ids are read on every poll, the rendered feed is cached under
+# the combined versions of these schedules.
+class UserFeed(EventFeed):
+    def get_object(self, request, key):
+        token = FeedToken.objects.select_related('user').get(key_hash=FeedToken.hash_key(key))
+        if not token.user.is_active:
+            raise ObjectDoesNotExist
+        return PersonalFeed(token.user, feed_schedule_ids(token.user))
+
+    def get_version(self, feed):
+        return get_combined_version(feed.schedule_ids)
+
+    def cache_key(self, feed):
+        return 'ical-user-feed:%d' % feed.id
+
+    def events(self, feed):
+        return Event.objects.filter(schedule_id__in=feed.schedule_ids)
+
+    def file_name(self, feed):
+        return 'mimcal-user-%d.ics' % feed.id
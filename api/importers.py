@@ -0,0 +1,236 @@
+import csv
+import io
+from datetime import datetime, time, timedelta
+
+import icalendar
+import recurrence
+from recurrence.exceptions import DeserializationError
+from django.db import connection, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from api.changes import log_changes, record_message
+from api.occurrences import materialization_enabled, materialize_occurrences
+from api.signals import schedules_changed
+from main.models import Event, EventType
+
+IMPORT_CHUNK_SIZE = 500
+MAX_REPORTED_ERRORS = 20
+CSV_COLUMNS = ('title', 'desc', 'start_date', 'end_date', 'type')
+RECURRENCE_PROPERTIES = ('rrule', 'exrule', 'rdate', 'exdate')
+
+
+class EventImportError(ValueError):
+    pass
+
+
+def _naive(value):
+    if isinstance(value, datetime):
+        return timezone.make_naive(value) if timezone.is_aware(value) else value
+    return datetime.combine(value, time.min)
+
+
+# Yields (line number, VEVENT bytes) without reading the whole file; folded
+# lines are left to icalendar, END:VEVENT is never a continuation line.
+def _vevent_blocks(file):
+    block = None
+    for number, line in enumerate(file, start=1):
+        stripped = line.rstrip(b'\r\n')
+        if stripped == b'BEGIN:VEVENT':
+            block, block_start = [], number
+        if block is not None:
+            block.append(stripped)
+            if stripped == b'END:VEVENT':
+                yield block_start, b'\r\n'.join(block) + b'\r\n'
+                block = None
+
+
+def _as_list(value):
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+# RRULE, EXRULE, RDATE and EXDATE of a VEVENT as Event.recurrences, dates
+# naive in TIME_ZONE like the event's own
+def _recurrences(vevent):
+    # icalendar drops properties it can't parse instead of failing
+    for name, error in vevent.errors:
+        if name.lower() in RECURRENCE_PROPERTIES:
+            raise EventImportError(error)
+    rules = recurrence.deserialize('\n'.join(
+        '%s:%s' % (name.upper(), rule.to_ical().decode())
+        for name in ('rrule', 'exrule') for rule in _as_list(vevent.get(name))))
+    dates = {name: [_naive(date.dt) for dates in _as_list(vevent.get(name)) for date in dates.dts]
+             for name in ('rdate', 'exdate')}
+    if not (rules.rrules or rules.exrules or dates['rdate'] or dates['exdate']):
+        return None
+    return recurrence.Recurrence(rrules=rules.rrules, exrules=rules.exrules,
+                                 rdates=dates['rdate'], exdates=dates['exdate'])
+
+
+def read_ics(file, default_type):
+    for number, block in _vevent_blocks(file):
+        try:
+            vevent = icalendar.Event.from_ical(block)
+            if 'dtstart' not in vevent:
+                raise EventImportError('missing DTSTART')
+            start = vevent.decoded('dtstart')
+            if 'dtend' in vevent:
+                end = vevent.decoded('dtend')
+            elif 'duration' in vevent:
+                end = start + vevent.decoded('duration')
+            else:
+                end = start + timedelta(days=1) if not isinstance(start, datetime) else start
+            categories = vevent.get('categories')
+            if isinstance(categories, list):
+                categories = categories[0]
+            type_name = str(categories.cats[0]) if categories is not None and categories.cats else default_type
+            yield number, {'title': str(vevent.get('summary', '')), 'desc': str(vevent.get('description', '')),
+                           'start_date': _naive(start), 'end_date': _naive(end), 'type': type_name,
+                           'recurrences': _recurrences(vevent)}
+        except DeserializationError:
+            yield number, EventImportError('invalid recurrence rule')
+        except (ValueError, KeyError) as e:
+            yield number, EventImportError(str(e) or 'invalid VEVENT')
+
+
+def _parse_csv_date(value):
+    parsed = parse_datetime(value)
+    if parsed is None:
+        day = parse_date(value)
+        if day is None:
+            raise EventImportError('invalid date %r' % value)
+        parsed = day
+    return _naive(parsed)
+
+
+# Past an undecodable byte or a malformed line the rest can't be read. The
+# file is decoded in blocks, so a decoding error has no reliable line number.
+def _unreadable(reader, error):
+    if isinstance(error, UnicodeDecodeError):
+        return EventImportError('the file is not UTF-8 encoded')
+    return EventImportError('line %d: %s' % (reader.line_num, error))
+
+
+def _csv_rows(reader):
+    try:
+        yield from reader
+    except (UnicodeDecodeError, csv.Error) as e:
+        raise _unreadable(reader, e)
+
+
+def read_csv(file, default_type):
+    reader = csv.DictReader(io.TextIOWrapper(file, encoding='utf-8-sig', newline=''))
+    try:
+        fieldnames = reader.fieldnames
+    except (UnicodeDecodeError, csv.Error) as e:
+        raise _unreadable(reader, e)
+    missing = {'title', 'start_date', 'end_date'} - set(fieldnames or ())
+    if missing:
+        raise EventImportError('missing columns: %s' % ', '.join(sorted(missing)))
+    for row in _csv_rows(reader):
+        try:
+            yield reader.line_num, {'title': row['title'], 'desc': row.get('desc') or '',
+                                    'start_date': _parse_csv_date(row['start_date'] or ''),
+                                    'end_date': _parse_csv_date(row['end_date'] or ''),
+                                    'type': row.get('type') or default_type}
+        except ValueError as e:
+            yield reader.line_num, EventImportError(str(e))
+
+
+class EventImporter:
+    """
+    Inserts parsed rows into a schedule in IMPORT_CHUNK_SIZE bulk_create
+    chunks, each committed on its own so a large file doesn't hold the
+    write lock until it ends. Rows equal to an event already in the schedule
+    (same title, start and end) are skipped.
+    """
+
+    def __init__(self, schedule):
+        self.schedule = schedule
+        self.types = {event_type.name: event_type for event_type in EventType.objects.all()}
+        self.inserted = self.skipped = self.failed = 0
+        self.errors = []
+
+    def get_type(self, name):
+        if name not in self.types:
+            self.types[name] = EventType.objects.create(name=name)
+        return self.types[name]
+
+    def fail(self, line, error):
+        self.failed += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({'line': line, 'error': str(error)})
+
+    # Without ids from bulk_create the new events are found by their keys,
+    # which the chunk holds once; the newest event wins a concurrent insert
+    def fetch_ids(self, events):
+        rows = (Event.objects.filter(schedule=self.schedule, start_date__in={event.start_date for event in events})
+                .order_by('id').values_list('id', 'title', 'start_date', 'end_date'))
+        ids = {(title, start_date, end_date): event_id for event_id, title, start_date, end_date in rows}
+        for event in events:
+            event.pk = ids[event.title, event.start_date, event.end_date]
+
+    def flush(self, chunk):
+        with transaction.atomic():
+            existing = set(Event.objects.filter(schedule=self.schedule,
+                                                start_date__in={event.start_date for event in chunk})
+                           .values_list('title', 'start_date', 'end_date'))
+            new = []
+            for event in chunk:
+                key = (event.title, event.start_date, event.end_date)
+                if key in existing:
+                    self.skipped += 1
+                    continue
+                existing.add(key)
+                event.update_recurrence_end()
+                new.append(event)
+            if not new:
+                return
+            Event.objects.bulk_create(new)
+            if not connection.features.can_return_rows_from_bulk_insert:
+                self.fetch_ids(new)
+            # bulk_create doesn't send post_save
+            schedules_changed([self.schedule.id])
+            log_changes('event', False, [(self.schedule.id, event.id) for event in new])
+            if materialization_enabled():
+                materialize_occurrences([event for event in new if event.is_recurring])
+        self.inserted += len(new)
+
+    def run(self, rows):
+        chunk = []
+        try:
+            for line, row in rows:
+                if isinstance(row, Exception):
+                    self.fail(line, row)
+                    continue
+                if not row['title'] or row['end_date'] < row['start_date']:
+                    self.fail(line, 'missing title' if not row['title'] else 'ends before it starts')
+                    continue
+                chunk.append(Event(title=row['title'], desc=row['desc'], start_date=row['start_date'],
+                                   end_date=row['end_date'], type=self.get_type(row['type']),
+                                   recurrences=row.get('recurrences'), schedule=self.schedule))
+                if len(chunk) >= IMPORT_CHUNK_SIZE:
+                    self.flush(chunk)
+                    chunk = []
+        except EventImportError as e:
+            # the rest of the file is unreadable, committed chunks are reported
+            if not self.inserted:
+                raise
+            self.fail(None, e)
+        if chunk:
+            self.flush(chunk)
+        if self.inserted:
+            record_message(self.schedule.id, 'event', 'imported', count=self.inserted)
+        return {'inserted': self.inserted, 'skipped': self.skipped, 'failed': self.failed, 'errors': self.errors}
+
+
+def import_events(schedule, file, default_type):
+    first_line = file.readline()
+    file.seek(0)
+    if file.name.lower().endswith('.ics') or first_line.strip() == b'BEGIN:VCALENDAR':
+        rows = read_ics(file, default_type)
+    else:
+        rows = read_csv(file, default_type)
+    return EventImporter(schedule).run(rows)
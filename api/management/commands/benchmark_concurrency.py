@@ -0,0 +1,101 @@
+import asyncio
+import time
+from urllib.parse import urlsplit
+
+from django.core.management.base import BaseCommand, CommandError
+
+SLOW_CHUNK_SIZE = 8
+SLOW_CHUNK_DELAY = 0.5
+
+
+class Command(BaseCommand):
+    help = ('Compares throughput and latency of running deployments under concurrent load, '
+            'e.g. wsgi=http://localhost:8000 asgi=http://localhost:8001')
+
+    def add_arguments(self, parser):
+        parser.add_argument('targets', nargs='+', metavar='label=url')
+        parser.add_argument('--path', default='/api/v1/schedules/1/events/')
+        parser.add_argument('--requests', type=int, default=200)
+        parser.add_argument('--concurrency', type=int, default=20)
+        parser.add_argument('--slow-clients', type=int, default=0,
+                            help='connections that trickle their request headers during the run')
+        parser.add_argument('--header', action='append', default=[],
+                            help='extra request header, e.g. "Authorization: Token ..."')
+
+    def handle(self, *args, **options):
+        if options['requests'] < 1 or options['concurrency'] < 1:
+            raise CommandError('--requests and --concurrency must be positive')
+        self.stdout.write('%-10s %8s %8s %8s %8s %7s' % ('target', 'req/s', 'p50 ms', 'p95 ms', 'max ms', 'errors'))
+        for target in options['targets']:
+            label, _, url = target.partition('=')
+            url = urlsplit(url)
+            if url.scheme != 'http' or not url.hostname:
+                raise CommandError('expected label=http://host:port, got %r' % target)
+            request = ('GET %s HTTP/1.1\r\nHost: %s\r\nConnection: close\r\n%s\r\n' % (
+                options['path'], url.netloc, ''.join(h + '\r\n' for h in options['header']))).encode()
+            elapsed, latencies, errors = asyncio.run(self.run(url.hostname, url.port or 80, request, options))
+            latencies.sort()
+            self.stdout.write('%-10s %8.1f %8.1f %8.1f %8.1f %7d' % (
+                label, len(latencies) / elapsed, percentile(latencies, 50) * 1000,
+                percentile(latencies, 95) * 1000, latencies[-1] * 1000, errors))
+
+    async def run(self, host, port, request, options):
+        latencies = []
+        errors = 0
+        remaining = iter(range(options['requests']))
+        done = asyncio.Event()
+
+        async def worker():
+            nonlocal errors
+            for _ in remaining:
+                started = time.perf_counter()
+                try:
+                    status = await fetch(host, port, request)
+                except OSError:
+                    status = 0
+                latencies.append(time.perf_counter() - started)
+                if not 200 <= status < 400:
+                    errors += 1
+
+        async def slow_client():
+            while not done.is_set():
+                try:
+                    await fetch(host, port, request, slow=True)
+                except OSError:
+                    await asyncio.sleep(SLOW_CHUNK_DELAY)
+
+        slow = [asyncio.ensure_future(slow_client()) for _ in range(options['slow_clients'])]
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(options['concurrency'])))
+        elapsed = time.perf_counter() - started
+        done.set()
+        for task in slow:
+            task.cancel()
+        await asyncio.gather(*slow, return_exceptions=True)
+        return elapsed, latencies, errors
+
+
+async def fetch(host, port, request, slow=False):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        if slow:
+            for i in range(0, len(request), SLOW_CHUNK_SIZE):
+                writer.write(request[i:i + SLOW_CHUNK_SIZE])
+                await writer.drain()
+                await asyncio.sleep(SLOW_CHUNK_DELAY)
+        else:
+            writer.write(request)
+            await writer.drain()
+        status_line = await reader.readline()
+        while await reader.read(65536):
+            pass
+    finally:
+        writer.close()
+    try:
+        return int(status_line.split()[1])
+    except (IndexError, ValueError):
+        return 0
+
+
+def percentile(values, percent):
+    return values[min(len(values) - 1, len(values) * percent // 100)]
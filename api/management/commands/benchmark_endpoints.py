@@ -0,0 +1,125 @@
+import json
+import time
+
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Count
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from rest_framework.authtoken.models import Token
+
+from api.management.commands.benchmark_concurrency import percentile
+from main.models import Schedule, Event
+from main.models import SchedulePermissionLevels as Level
+
+# (name, path, most SQL queries a request may take with the cache cleared)
+ENDPOINTS = [
+    ('schedules', '/api/v1/schedules/', 2),
+    ('schedule', '/api/v1/schedules/{schedule}/', 2),
+    ('schedule-expand', '/api/v1/schedules/{schedule}/?expand=events', 3),
+    ('events', '/api/v1/schedules/{schedule}/events/', 3),
+    ('events-page', '/api/v1/schedules/{schedule}/events/?limit=50', 3),
+    ('events-window', '/api/v1/schedules/{schedule}/events/?from=2021-03-01&to=2021-04-01', 4),
+    ('changes', '/api/v1/schedules/{schedule}/changes/?since=0', 4),
+    ('event', '/api/v1/events/{event}/', 2),
+    ('comments', '/api/v1/events/{event}/comments/', 4),
+    ('thread', '/api/v1/events/{event}/thread/', 4),
+    ('ical-feed', '/api/v1/schedules/{schedule}/to_webcal/', 4),
+    ('search', '/api/v1/search/?q=event', 7),
+    ('agenda', '/api/v1/events/agenda/?from=2021-01-01', 3),
+]
+
+
+class Command(BaseCommand):
+    help = ('Runs every read endpoint against the current database (see generate_dataset), reports '
+            'latency percentiles and SQL query counts and fails when a query budget is exceeded')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=20)
+        parser.add_argument('--schedule', type=int, help='defaults to the public schedule with most events')
+        parser.add_argument('--event', type=int, help='defaults to its event with most comments')
+        parser.add_argument('--endpoint', action='append', default=[], help='run only these, by name')
+        parser.add_argument('--cold', action='store_true',
+                            help='clear the cache before every request, to measure uncached reads')
+        parser.add_argument('--budgets', help='JSON file of {endpoint: query budget} overriding the defaults')
+        parser.add_argument('--output', help='write the results to this JSON file')
+
+    def handle(self, *args, **options):
+        if options['iterations'] < 1:
+            raise CommandError('--iterations must be positive')
+        budgets = {name: budget for name, _, budget in ENDPOINTS}
+        if options['budgets']:
+            with open(options['budgets']) as f:
+                budgets.update(json.load(f))
+        endpoints = [(name, path) for name, path, _ in ENDPOINTS
+                     if not options['endpoint'] or name in options['endpoint']]
+        if not endpoints:
+            raise CommandError('unknown endpoint, expected one of %s' % ', '.join(name for name, _, _ in ENDPOINTS))
+
+        schedule = self.get_schedule(options['schedule'])
+        event = self.get_event(schedule, options['event'])
+        token, _ = Token.objects.get_or_create(user=schedule.owner)
+        client = Client(HTTP_AUTHORIZATION='Token ' + token.key)
+
+        results = []
+        self.stdout.write('%-16s %8s %8s %8s %8s %8s' % ('endpoint', 'p50 ms', 'p95 ms', 'max ms', 'queries', 'budget'))
+        for name, path in endpoints:
+            result = self.run(client, name, path.format(schedule=schedule.id, event=event.id), options)
+            result['budget'] = budgets[name]
+            results.append(result)
+            self.stdout.write('%-16s %8.1f %8.1f %8.1f %8d %8d' % (
+                name, result['p50'], result['p95'], result['max'], result['queries'], result['budget']))
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump({'schedule': schedule.id, 'event': event.id, 'cold': options['cold'],
+                           'results': results}, f, indent=2)
+        exceeded = ['%s (%d > %d)' % (r['endpoint'], r['queries'], r['budget'])
+                    for r in results if r['queries'] > r['budget']]
+        if exceeded:
+            raise CommandError('query budget exceeded: %s' % ', '.join(exceeded))
+
+    def get_schedule(self, schedule_id):
+        schedules = Schedule.objects.select_related('owner')
+        if schedule_id is not None:
+            try:
+                return schedules.get(id=schedule_id)
+            except Schedule.DoesNotExist:
+                raise CommandError('schedule %d does not exist' % schedule_id)
+        # the iCal feed is only served anonymously for public schedules
+        schedule = schedules.filter(default_permission_level__gte=Level.READ_ACCESS).annotate(
+            events_count=Count('event')).order_by('-events_count', 'id').first()
+        if schedule is None:
+            raise CommandError('no public schedule, run generate_dataset first')
+        return schedule
+
+    def get_event(self, schedule, event_id):
+        events = Event.objects.filter(schedule=schedule)
+        if event_id is not None:
+            event = events.filter(id=event_id).first()
+        else:
+            event = events.annotate(comments_count=Count('comment')).order_by('-comments_count', 'id').first()
+        if event is None:
+            raise CommandError('no such event in schedule %d' % schedule.id)
+        return event
+
+    def run(self, client, name, path, options):
+        latencies = []
+        queries = 0
+        for _ in range(options['iterations']):
+            if options['cold']:
+                cache.clear()
+            with CaptureQueriesContext(connection) as context:
+                started = time.perf_counter()
+                response = client.get(path)
+                if response.streaming:
+                    b''.join(response.streaming_content)
+                latencies.append(time.perf_counter() - started)
+            if response.status_code != 200:
+                raise CommandError('%s returned %d' % (path, response.status_code))
+            queries = max(queries, len(context.captured_queries))
+        latencies.sort()
+        return {'endpoint': name, 'path': path, 'queries': queries,
+                'p50': percentile(latencies, 50) * 1000, 'p95': percentile(latencies, 95) * 1000,
+                'max': latencies[-1] * 1000}
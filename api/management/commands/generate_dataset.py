@@ -0,0 +1,170 @@
+import random
+from datetime import datetime, timedelta
+
+import recurrence
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from api.occurrences import materialization_enabled, materialize_occurrences
+from main.models import User, Schedule, SchedulePermission, EventType, Event, Comment, CommentReply
+from main.models import SchedulePermissionLevels as Level
+
+BATCH_SIZE = 1000
+EVENT_TYPES = ['lecture', 'lab', 'exam', 'meeting']
+GRANTED_LEVELS = [Level.READ_ACCESS, Level.READ_WRITE_ACCESS, Level.MANAGE_ACCESS]
+
+
+def zipf_weights(count, skew):
+    # the i-th item is picked 1 / (i + 1) ** skew times as often as the first
+    return [1 / (i + 1) ** skew for i in range(count)]
+
+
+class Command(BaseCommand):
+    help = ('Generates a synthetic dataset for benchmarks. With --skew above 0 a few users, '
+            'schedules and events get most of the events, permissions, comments and likes.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=100)
+        parser.add_argument('--schedules', type=int, default=20)
+        parser.add_argument('--permissions', type=int, default=200)
+        parser.add_argument('--events', type=int, default=5000)
+        parser.add_argument('--recurring', type=float, default=0.05, help='fraction of weekly events')
+        parser.add_argument('--checks', type=int, default=2000, help='events checked by users')
+        parser.add_argument('--comments', type=int, default=5000)
+        parser.add_argument('--replies', type=int, default=10000)
+        parser.add_argument('--likes', type=int, default=20000, help='likes of comments and replies')
+        parser.add_argument('--skew', type=float, default=1.0, help='0 spreads everything uniformly')
+        parser.add_argument('--public', type=float, default=0.5,
+                            help='fraction of publicly readable schedules, the busiest one always is')
+        parser.add_argument('--start', default='2021-01-01', help='first day of the generated events')
+        parser.add_argument('--days', type=int, default=365)
+        parser.add_argument('--prefix', default='bench', help='username prefix')
+        parser.add_argument('--password', default='bench')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        if options['users'] < 1 or options['schedules'] < 1:
+            raise CommandError('--users and --schedules must be positive')
+        if User.objects.filter(username__startswith=options['prefix'] + '-').exists():
+            raise CommandError('users prefixed %r exist, pass another --prefix' % options['prefix'])
+        try:
+            self.start = datetime.strptime(options['start'], '%Y-%m-%d')
+        except ValueError:
+            raise CommandError('invalid --start, expected YYYY-MM-DD')
+        self.random = random.Random(options['seed'])
+        self.options = options
+
+        with transaction.atomic():
+            users = self.create_users()
+            schedules = self.create_schedules(users)
+            self.create_permissions(users, schedules)
+            events = self.create_events(schedules)
+            self.create_checks(users, events)
+            comments = self.create_comments(users, events)
+            replies = self.create_replies(users, comments)
+            self.create_likes(users, comments, replies)
+        self.stdout.write('generated %d users, %d schedules, %d events, %d comments and %d replies' % (
+            len(users), len(schedules), len(events), len(comments), len(replies)))
+
+    def pick(self, population, count):
+        if not population:
+            return []
+        return self.random.choices(population, zipf_weights(len(population), self.options['skew']), k=count)
+
+    def pick_pairs(self, first, second, count):
+        # distinct pairs, fewer than count when the skew makes them repeat
+        pairs = set()
+        for pair in zip(self.pick(first, count * 3), self.pick(second, count * 3)):
+            if len(pairs) == count:
+                break
+            pairs.add(pair)
+        return pairs
+
+    def create_users(self):
+        password = make_password(self.options['password'])
+        User.objects.bulk_create([
+            User(username='%s-%d' % (self.options['prefix'], i), password=password)
+            for i in range(self.options['users'])], batch_size=BATCH_SIZE)
+        return list(User.objects.filter(username__startswith=self.options['prefix'] + '-').order_by('id'))
+
+    def create_schedules(self, users):
+        schedules = []
+        for i, owner in enumerate(self.pick(users, self.options['schedules'])):
+            public = i == 0 or self.random.random() < self.options['public']
+            schedules.append(Schedule(name='Schedule %d' % i, owner=owner, default_permission_level=(
+                Level.READ_ACCESS if public else Level.RESTRICTED_ACCESS)))
+        Schedule.objects.bulk_create(schedules, batch_size=BATCH_SIZE)
+        schedules = list(Schedule.objects.filter(owner__in=users).order_by('id'))
+        SchedulePermission.objects.bulk_create([
+            SchedulePermission(schedule=schedule, user_id=schedule.owner_id, level=Level.MANAGE_ACCESS)
+            for schedule in schedules], batch_size=BATCH_SIZE)
+        return schedules
+
+    def create_permissions(self, users, schedules):
+        owners = {(schedule.id, schedule.owner_id) for schedule in schedules}
+        pairs = [(schedule, user) for schedule, user in self.pick_pairs(schedules, users, self.options['permissions'])
+                 if (schedule.id, user.id) not in owners]
+        SchedulePermission.objects.bulk_create([
+            SchedulePermission(schedule=schedule, user=user, level=self.random.choice(GRANTED_LEVELS))
+            for schedule, user in pairs], batch_size=BATCH_SIZE)
+
+    def create_events(self, schedules):
+        types = [EventType.objects.get_or_create(name=name)[0] for name in EVENT_TYPES]
+        weekly = recurrence.deserialize('RRULE:FREQ=WEEKLY;COUNT=15')
+        events = []
+        for i, schedule in enumerate(self.pick(schedules, self.options['events'])):
+            start = self.start + timedelta(days=self.random.randrange(self.options['days']),
+                                           hours=self.random.randrange(8, 20))
+            events.append(Event(
+                title='Event %d' % i, desc='Description of event %d' % i, schedule=schedule,
+                type=self.random.choice(types), start_date=start,
+                end_date=start + timedelta(minutes=self.random.choice([45, 90, 120, 180])),
+                recurrences=weekly if self.random.random() < self.options['recurring'] else None))
+            events[-1].update_recurrence_end()
+        Event.objects.bulk_create(events, batch_size=BATCH_SIZE)
+        events = list(Event.objects.filter(schedule__in=schedules).order_by('id'))
+        if materialization_enabled():
+            materialize_occurrences([event for event in events if event.is_recurring])
+        return events
+
+    def create_checks(self, users, events):
+        Event.users_marks.through.objects.bulk_create([
+            Event.users_marks.through(event=event, user=user)
+            for event, user in self.pick_pairs(events, users, self.options['checks'])], batch_size=BATCH_SIZE)
+
+    def create_comments(self, users, events):
+        count = self.options['comments']
+        Comment.objects.bulk_create([
+            Comment(content='Comment %d' % i, event=event, author=author)
+            for i, (event, author) in enumerate(zip(self.pick(events, count), self.pick(users, count)))],
+            batch_size=BATCH_SIZE)
+        return list(Comment.objects.filter(event__schedule__owner__in=users).order_by('id'))
+
+    def create_replies(self, users, comments):
+        count = self.options['replies']
+        CommentReply.objects.bulk_create([
+            CommentReply(content='Reply %d' % i, reply_to=comment, event_id=comment.event_id, author=author,
+                         likes_count=0)
+            for i, (comment, author) in enumerate(zip(self.pick(comments, count), self.pick(users, count)))],
+            batch_size=BATCH_SIZE)
+        return list(CommentReply.objects.filter(event__schedule__owner__in=users).order_by('id'))
+
+    def create_likes(self, users, comments, replies):
+        total = len(comments) + len(replies)
+        if not total:
+            return
+        comment_likes = self.options['likes'] * len(comments) // total
+        for model, objects, count, field in ((Comment, comments, comment_likes, 'comment'),
+                                             (CommentReply, replies, self.options['likes'] - comment_likes,
+                                              'commentreply')):
+            through = model.liked_users.through
+            pairs = self.pick_pairs(objects, users, count)
+            through.objects.bulk_create([through(**{field: obj, 'user': user}) for obj, user in pairs],
+                                        batch_size=BATCH_SIZE)
+            likes = {}
+            for obj, _ in pairs:
+                likes[obj] = likes.get(obj, 0) + 1
+            for obj, likes_count in likes.items():
+                obj.likes_count = likes_count
+            model.objects.bulk_update(list(likes), ['likes_count'], batch_size=BATCH_SIZE)
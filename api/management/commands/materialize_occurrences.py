@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from api.occurrences import RECURRING, materialize_occurrences
+from main.models import Event
+
+BATCH_SIZE = 500
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds EventOccurrence rows of recurring events up to OCCURRENCE_HORIZON_DAYS ahead'
+
+    def handle(self, *args, **options):
+        events = Event.objects.filter(RECURRING).order_by('id')
+        count = 0
+        batch = []
+        for event in events.iterator(chunk_size=BATCH_SIZE):
+            batch.append(event)
+            if len(batch) == BATCH_SIZE:
+                with transaction.atomic():
+                    materialize_occurrences(batch)
+                count += len(batch)
+                batch = []
+        with transaction.atomic():
+            materialize_occurrences(batch)
+        count += len(batch)
+        self.stdout.write('materialized occurrences of %d events' % count)
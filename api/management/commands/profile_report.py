@@ -0,0 +1,40 @@
+import os
+import pstats
+from io import StringIO
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = 'Merges the profiles dumped by ProfilingMiddleware into the top hotspots of every view'
+
+    def add_arguments(self, parser):
+        parser.add_argument('views', nargs='*', help='only these views, e.g. schedule-detail')
+        parser.add_argument('--dir', default=getattr(settings, 'PROFILE_DIR', ''))
+        parser.add_argument('--top', type=int, default=20)
+        parser.add_argument('--sort', default='cumulative', choices=['cumulative', 'tottime', 'calls'])
+        parser.add_argument('--merge', action='store_true',
+                            help='also write the merged profile of every view to <view>.prof, e.g. for snakeviz')
+
+    def handle(self, *args, **options):
+        directory = options['dir']
+        if not directory or not os.path.isdir(directory):
+            raise CommandError('no profiles, set PROFILE_DIR or pass --dir')
+        views = sorted(options['views'] or (name for name in os.listdir(directory)
+                                             if os.path.isdir(os.path.join(directory, name))))
+        for view in views:
+            view_directory = os.path.join(directory, view)
+            files = sorted(os.path.join(view_directory, name) for name in os.listdir(view_directory)
+                           if name.endswith('.prof')) if os.path.isdir(view_directory) else []
+            if not files:
+                self.stdout.write('== %s: no profiles' % view)
+                continue
+            report = StringIO()
+            stats = pstats.Stats(*files, stream=report)
+            if options['merge']:
+                stats.dump_stats(os.path.join(directory, view + '.prof'))
+            stats.strip_dirs().sort_stats(options['sort']).print_stats(options['top'])
+            self.stdout.write('== %s: %d profiles, %.3fs in %d calls' % (
+                view, len(files), stats.total_tt, stats.total_calls))
+            self.stdout.write(report.getvalue())
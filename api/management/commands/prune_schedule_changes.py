@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+
+from api.changes import prune_changes
+
+
+class Command(BaseCommand):
+    help = 'Deletes change log rows and tombstones older than CHANGE_LOG_RETENTION_DAYS'
+
+    def handle(self, *args, **options):
+        self.stdout.write('pruned %d changes' % prune_changes())
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, F
+
+from main.models import Comment, CommentReply
+
+BATCH_SIZE = 500
+
+
+class Command(BaseCommand):
+    help = 'Recomputes likes_count of comments and replies from their liked_users'
+
+    def handle(self, *args, **options):
+        for model in (Comment, CommentReply):
+            drifted = (model.objects.annotate(actual_likes=Count('liked_users'))
+                       .exclude(likes_count=F('actual_likes')))
+            fixed = []
+            with transaction.atomic():
+                for obj in drifted.iterator(chunk_size=BATCH_SIZE):
+                    obj.likes_count = obj.actual_likes
+                    fixed.append(obj)
+                model.objects.bulk_update(fixed, ['likes_count'], batch_size=BATCH_SIZE)
+            self.stdout.write('%s: fixed %d counters' % (model._meta.verbose_name_plural, len(fixed)))
@@ -0,0 +1,87 @@
+import copy
+from datetime import timedelta
+from itertools import chain
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from main.models import EventOccurrence
+
+OCCURRENCE_HORIZON = timedelta(days=getattr(settings, 'OCCURRENCE_HORIZON_DAYS', 366))
+
+RECURRING = Q(recurrences__isnull=False) & ~Q(recurrences='')
+
+
+# Series with occurrences that may end at or after `start`
+def not_ended_before(start):
+    return Q(recurrence_end__isnull=True) | Q(recurrence_end__gte=start)
+
+
+def recurring_since(events, start):
+    recurring = events.filter(RECURRING)
+    if start:
+        recurring = recurring.filter(not_ended_before(start))
+    return recurring
+
+
+def materialization_enabled():
+    return getattr(settings, 'MATERIALIZE_OCCURRENCES', False)
+
+
+def occurrence_starts(event, start, end):
+    if not event.is_recurring:
+        return [event.start_date] if (start is None or event.start_date >= start) and event.start_date < end else []
+    starts = event.recurrences.between(start or event.start_date, end, inc=True, dtstart=event.start_date)
+    return [occurrence for occurrence in starts if occurrence < end]
+
+
+# An unsaved copy of the event moved to one of its occurrences. It keeps the
+# id of the event and every annotation, so it serializes like the event.
+def as_occurrence(event, start_date, end_date=None):
+    occurrence = copy.copy(event)
+    occurrence.start_date = start_date
+    occurrence.end_date = end_date or start_date + (event.end_date - event.start_date)
+    return occurrence
+
+
+def expand_event(event, start, end):
+    return [as_occurrence(event, occurrence) for occurrence in occurrence_starts(event, start, end)]
+
+
+# Events and occurrences of recurring events starting in [start, end),
+# ordered by (start_date, id). `events` may already be filtered and annotated.
+# Without an end, recurring events are expanded up to OCCURRENCE_HORIZON.
+def events_in_window(events, start, end):
+    plain = events.exclude(RECURRING)
+    if start:
+        plain = plain.filter(start_date__gte=start)
+    if end:
+        plain = plain.filter(start_date__lt=end)
+    else:
+        end = (start or timezone.now()) + OCCURRENCE_HORIZON
+    recurring = recurring_since(events, start).filter(start_date__lt=end)
+
+    if materialization_enabled():
+        rows = EventOccurrence.objects.filter(event__in=recurring.values('id'), start_date__lt=end)
+        if start:
+            rows = rows.filter(start_date__gte=start)
+        rows = list(rows.values_list('event_id', 'start_date', 'end_date'))
+        by_id = recurring.in_bulk({event_id for event_id, _, _ in rows})
+        occurrences = [as_occurrence(by_id[event_id], start_date, end_date)
+                       for event_id, start_date, end_date in rows]
+    else:
+        occurrences = chain.from_iterable(expand_event(event, start, end) for event in recurring)
+    return sorted(chain(plain, occurrences), key=lambda event: (event.start_date, event.id))
+
+
+def materialize_occurrences(events):
+    events = [event for event in events if event.pk]
+    horizon = timezone.now() + OCCURRENCE_HORIZON
+    EventOccurrence.objects.filter(event__in=events).delete()
+    EventOccurrence.objects.bulk_create([
+        EventOccurrence(event=event, schedule_id=event.schedule_id, start_date=occurrence.start_date,
+                        end_date=occurrence.end_date)
+        for event in events if event.is_recurring
+        for occurrence in expand_event(event, None, horizon)
+    ])
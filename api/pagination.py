@@ -0,0 +1,103 @@
+import base64
+import json
+
+from django.db.models import Q
+from rest_framework.exceptions import ValidationError
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """
+    Cursor pagination over a unique, totally ordered tuple of columns.
+
+    Instead of OFFSET, every page continues from the last row of the previous
+    one with `WHERE (a, b) > (last_a, last_b)`, so fetching page N costs the
+    same index range scan as fetching page 1.
+    """
+    ordering = ('id',)
+    page_size = 50
+    max_page_size = 500
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'limit'
+
+    def is_requested(self, request):
+        params = request.query_params
+        return self.cursor_query_param in params or self.page_size_query_param in params
+
+    def get_page_size(self, request):
+        value = request.query_params.get(self.page_size_query_param, None)
+        if value is None:
+            return self.page_size
+        try:
+            size = int(value)
+        except ValueError:
+            raise ValidationError(detail='invalid %s' % self.page_size_query_param)
+        if size <= 0:
+            raise ValidationError(detail='invalid %s' % self.page_size_query_param)
+        return min(size, self.max_page_size)
+
+    def encode_cursor(self, obj):
+        values = [str(getattr(obj, name)) for name in self.ordering]
+        return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+    def decode_cursor(self, model, cursor):
+        try:
+            values = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+            if len(values) != len(self.ordering):
+                raise ValueError
+            return [model._meta.get_field(name).to_python(value)
+                    for name, value in zip(self.ordering, values)]
+        except Exception:
+            raise ValidationError(detail='invalid cursor')
+
+    def keyset_filter(self, values):
+        # (a, b, c) > (x, y, z)  <=>  a > x OR (a = x AND b > y) OR (a = x AND b = y AND c > z)
+        condition = Q()
+        equal = {}
+        for name, value in zip(self.ordering, values):
+            condition |= Q(**equal, **{name + '__gt': value})
+            equal[name] = value
+        return condition
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        page_size = self.get_page_size(request)
+        cursor = request.query_params.get(self.cursor_query_param, None)
+        if isinstance(queryset, list):
+            page = self.paginate_list(queryset, cursor, page_size)
+        else:
+            queryset = queryset.order_by(*self.ordering)
+            if cursor:
+                queryset = queryset.filter(self.keyset_filter(self.decode_cursor(queryset.model, cursor)))
+            page = list(queryset[:page_size + 1])
+        self.has_next = len(page) > page_size
+        page = page[:page_size]
+        self.next_cursor = self.encode_cursor(page[-1]) if self.has_next else None
+        return page
+
+    # objects already sorted by self.ordering, e.g. expanded occurrences
+    def paginate_list(self, objects, cursor, page_size):
+        if cursor and objects:
+            values = tuple(self.decode_cursor(type(objects[0]), cursor))
+            objects = [obj for obj in objects
+                       if tuple(getattr(obj, name) for name in self.ordering) > values]
+        return objects[:page_size + 1]
+
+    def get_next_link(self):
+        if self.next_cursor is None:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.next_cursor)
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'cursor': self.next_cursor,
+            'results': data,
+        })
+
+
+class EventCursorPagination(KeysetPagination):
+    ordering = ('start_date', 'id')
@@ -0,0 +1,36 @@
+from django.conf import settings
+from django.core.cache import cache
+
+from main.models import SchedulePermission
+from mimcal.db_routers import primary_reads
+
+PERMISSION_CACHE_TIMEOUT = getattr(settings, 'PERMISSION_CACHE_TIMEOUT', 300)
+
+
+def _cache_key(user_id):
+    return 'schedule-permissions:%d' % user_id
+
+
+# {schedule_id: level} of the user's explicit permissions. Memoized on the user
+# instance for the rest of the request (like ModelBackend's _perm_cache) and
+# shared between requests through the default cache.
+def get_permission_map(user):
+    if not hasattr(user, '_schedule_permission_cache'):
+        key = _cache_key(user.id)
+        levels = cache.get(key)
+        if levels is None:
+            with primary_reads():
+                levels = dict(SchedulePermission.objects.filter(user=user).values_list('schedule_id', 'level'))
+            cache.set(key, levels, PERMISSION_CACHE_TIMEOUT)
+        user._schedule_permission_cache = levels
+    return user._schedule_permission_cache
+
+
+def get_user_permission_level(user, schedule):
+    if user.is_anonymous:
+        return None
+    return get_permission_map(user).get(schedule.id)
+
+
+def invalidate_permission_map(user_id):
+    cache.delete(_cache_key(user_id))
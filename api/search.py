@@ -0,0 +1,93 @@
+import re
+
+from django.conf import settings
+from django.db import connection
+
+from api.utils import annotate_is_checked, annotate_is_liked, filter_permitted_schedules
+from main.models import Schedule, Event, Comment, CommentReply
+from main.models import SchedulePermissionLevels as Level
+
+SEARCH_LIMIT = getattr(settings, 'SEARCH_LIMIT', 20)
+MAX_SEARCH_LIMIT = 100
+# longer queries are cut to their first terms
+MAX_SEARCH_TERMS = 8
+# a term in an event title counts as much as this many in its description
+TITLE_WEIGHT = 4.0
+
+# Ids of matching rows in readable schedules, best matches first, using the
+# indexes of main/migrations/0014_search_index.py. Every template takes the
+# query, the readable schedule ids subquery and the limit.
+SEARCH_SQL = {
+    'sqlite': {
+        'events': 'SELECT e.id FROM main_event_fts JOIN main_event e ON e.id = main_event_fts.rowid '
+                  'WHERE main_event_fts MATCH %s AND e.schedule_id IN ({schedules}) '
+                  'ORDER BY bm25(main_event_fts, {title_weight}, 1.0), e.id LIMIT %s',
+        'comments': 'SELECT c.id FROM main_comment_fts JOIN main_comment c ON c.id = main_comment_fts.rowid '
+                    'JOIN main_event e ON e.id = c.event_id '
+                    'WHERE main_comment_fts MATCH %s AND e.schedule_id IN ({schedules}) '
+                    'ORDER BY main_comment_fts.rank, c.id LIMIT %s',
+        'replies': 'SELECT r.id FROM main_commentreply_fts '
+                   'JOIN main_commentreply r ON r.id = main_commentreply_fts.rowid '
+                   'JOIN main_event e ON e.id = r.event_id '
+                   'WHERE main_commentreply_fts MATCH %s AND e.schedule_id IN ({schedules}) '
+                   'ORDER BY main_commentreply_fts.rank, r.id LIMIT %s',
+    },
+    'postgresql': {
+        'events': "SELECT e.id FROM main_event e, to_tsquery('simple', %s) query "
+                  'WHERE e.search_vector @@ query AND e.schedule_id IN ({schedules}) '
+                  'ORDER BY ts_rank(e.search_vector, query) DESC, e.id LIMIT %s',
+        'comments': "SELECT c.id FROM main_comment c JOIN main_event e ON e.id = c.event_id, "
+                    "to_tsquery('simple', %s) query "
+                    'WHERE c.search_vector @@ query AND e.schedule_id IN ({schedules}) '
+                    'ORDER BY ts_rank(c.search_vector, query) DESC, c.id LIMIT %s',
+        'replies': "SELECT r.id FROM main_commentreply r JOIN main_event e ON e.id = r.event_id, "
+                   "to_tsquery('simple', %s) query "
+                   'WHERE r.search_vector @@ query AND e.schedule_id IN ({schedules}) '
+                   'ORDER BY ts_rank(r.search_vector, query) DESC, r.id LIMIT %s',
+    },
+}
+SEARCH_KINDS = ('events', 'comments', 'replies')
+
+
+class SearchNotSupported(Exception):
+    pass
+
+
+# Every term has to match, as a prefix of a word. Terms are made of word
+# characters only, so they are never parsed as query syntax.
+def search_query(terms, vendor):
+    if vendor == 'sqlite':
+        return ' '.join('"%s"*' % term for term in terms)
+    return ' & '.join('%s:*' % term for term in terms)
+
+
+def search_ids(kind, terms, user, limit):
+    templates = SEARCH_SQL.get(connection.vendor)
+    if templates is None:
+        raise SearchNotSupported
+    schedules = filter_permitted_schedules(Schedule.objects.all(), user, Level.READ_ACCESS).values('id')
+    schedules_sql, schedules_params = schedules.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(templates[kind].format(schedules=schedules_sql, title_weight=TITLE_WEIGHT),
+                       [search_query(terms, connection.vendor), *schedules_params, limit])
+        return [row[0] for row in cursor.fetchall()]
+
+
+def search(query, user, kinds=SEARCH_KINDS, limit=SEARCH_LIMIT):
+    """
+    Returns {kind: objects} of the events, comments and replies matching
+    every term of the query, in the schedules the user can read, best
+    matches first. Objects carry the annotations their serializers read.
+    """
+    terms = re.findall(r'\w+', query.lower())[:MAX_SEARCH_TERMS]
+    querysets = {
+        'events': annotate_is_checked(Event.objects.all(), user),
+        'comments': annotate_is_liked(Comment.objects.select_related('author'), user),
+        'replies': annotate_is_liked(CommentReply.objects.select_related('author'), user),
+    }
+    results = {}
+    for kind in kinds:
+        ids = search_ids(kind, terms, user, limit) if terms else []
+        objects = querysets[kind].in_bulk(ids) if ids else {}
+        results[kind] = [objects[i] for i in ids if i in objects]
+    return results
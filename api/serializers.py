@@ -1,24 +1,79 @@
+import recurrence
+from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
+from recurrence.exceptions import DeserializationError
 from rest_framework import serializers
 
 from main.models import Schedule, EventType, Event, User, SchedulePermission
 
 from main.models import Comment, CommentReply
+from api.utils import annotate_is_checked, only_serialized
+from mimcal.middleware import timed_representation
 
+EMBEDDED_EVENTS_LIMIT = getattr(settings, 'EMBEDDED_EVENTS_LIMIT', 200)
 
-class EventTypeSerializer(serializers.ModelSerializer):
+
+class TimedSerializerMixin:
+    """
+    Reports the time spent representing objects, without the SQL run for
+    them, as serializer time of the request (see RequestMetricsMiddleware).
+    Nested serializers are counted in the outermost one.
+    """
+
+    def to_representation(self, instance):
+        return timed_representation(super().to_representation, instance)
+
+
+class SparseFieldsMixin:
+    """
+    Takes `fields`, the names of the fields to keep, and `expand`, a dict of
+    the expandable_fields to include with the fields to keep in each of them
+    (None for all). Expandable fields are left out unless expanded.
+    """
+    expandable_fields = ()
+
+    def __init__(self, *args, fields=None, expand=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.expand = expand or {}
+        for name in self.expandable_fields:
+            if name not in self.expand:
+                self.fields.pop(name, None)
+        if fields:
+            for name in set(self.fields) - set(fields) - set(self.expand):
+                self.fields.pop(name)
+
+
+class EventTypeSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = EventType
         fields = '__all__'
 
 
-class EventSerializer(serializers.ModelSerializer):
+class RecurrenceSerializerField(serializers.Field):
+    default_error_messages = {
+        'invalid': 'Expected RRULE, EXRULE, RDATE and EXDATE lines.',
+    }
+
+    def to_representation(self, value):
+        return recurrence.serialize(value) or None
+
+    def to_internal_value(self, data):
+        try:
+            return recurrence.deserialize(data)
+        except (DeserializationError, TypeError, ValueError):
+            self.fail('invalid')
+
+
+class EventSerializer(TimedSerializerMixin, SparseFieldsMixin, serializers.ModelSerializer):
     is_checked = serializers.SerializerMethodField('_is_checked')
+    recurrences = RecurrenceSerializerField(required=False, allow_null=True)
 
     def _is_checked(self, obj):
+        if hasattr(obj, 'is_checked'):
+            return obj.is_checked
         user_id = self.context.get("user_id", False)
-        if user_id:
-            return user_id in obj.users_marks.all()
+        if user_id and not user_id.is_anonymous:
+            return obj.users_marks.filter(pk=user_id.pk).exists()
         return False
 
     class Meta:
@@ -26,10 +81,12 @@ class EventSerializer(serializers.ModelSerializer):
         exclude = ('users_marks',)
 
 
-class ScheduleSerializer(serializers.ModelSerializer):
+class ScheduleSerializer(TimedSerializerMixin, SparseFieldsMixin, serializers.ModelSerializer):
     my_permission_level = serializers.SerializerMethodField('_my_permission_level')
 
     def _my_permission_level(self, obj):
+        if hasattr(obj, 'my_permission_level'):
+            return obj.my_permission_level
         user = self.context.get("user", False)
         if user and not user.is_anonymous:
             try:
@@ -44,16 +101,33 @@ class ScheduleSerializer(serializers.ModelSerializer):
         fields = ('id', 'name', 'owner_id', 'default_permission_level', 'my_permission_level')
 
 
+# Events are only embedded with ?expand=events, at most EMBEDDED_EVENTS_LIMIT
+# of them; events_truncated tells to page through the rest with /events/
 class ScheduleWithEventsSerializer(ScheduleSerializer):
-    events = serializers.ListField(read_only=True,
-                                   child=EventSerializer(), source='event_set.all')
     owner_id = serializers.PrimaryKeyRelatedField(queryset=User.objects.all())
+    expandable_fields = ('events',)
+
+    def embedded_events(self, obj):
+        user = self.context.get("user", False)
+        fields = self.expand['events']
+        events = annotate_is_checked(obj.event_set.all(), user)
+        if fields:
+            events = only_serialized(events, EventSerializer(fields=fields))
+        events = list(events[:EMBEDDED_EVENTS_LIMIT + 1])
+        return EventSerializer(events[:EMBEDDED_EVENTS_LIMIT], many=True, context={'user_id': user},
+                               fields=fields).data, len(events) > EMBEDDED_EVENTS_LIMIT
+
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        if 'events' in self.expand:
+            data['events'], data['events_truncated'] = self.embedded_events(instance)
+        return data
 
     class Meta(ScheduleSerializer.Meta):
-        fields = ('id', 'name', 'owner_id', 'events', 'default_permission_level', 'my_permission_level')
+        fields = ('id', 'name', 'owner_id', 'default_permission_level', 'my_permission_level')
 
 
-class BaseCommentSerializer(serializers.ModelSerializer):
+class BaseCommentSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     likes_count = serializers.IntegerField(read_only=True)
     is_liked_by_me = serializers.SerializerMethodField('_is_liked_by_me')
     author = serializers.SlugRelatedField(
@@ -63,9 +137,11 @@ class BaseCommentSerializer(serializers.ModelSerializer):
     )
 
     def _is_liked_by_me(self, obj):
+        if hasattr(obj, 'is_liked_by_me'):
+            return obj.is_liked_by_me
         user_id = self.context.get("user_id", False)
-        if user_id:
-            return user_id in obj.liked_users.all()
+        if user_id and not user_id.is_anonymous:
+            return obj.liked_users.filter(pk=user_id.pk).exists()
         return False
 
 
@@ -84,7 +160,22 @@ class CommentSerializer(BaseCommentSerializer):
         fields = ('id', 'content', 'replies', 'likes_count', 'event', 'is_liked_by_me', 'author')
 
 
-class SchedulePermissionSerializer(serializers.ModelSerializer):
+class CommentChangeSerializer(BaseCommentSerializer):
+    class Meta:
+        model = Comment
+        fields = ('id', 'content', 'likes_count', 'event', 'is_liked_by_me', 'author', 'updated_at')
+
+
+class CommentThreadSerializer(BaseCommentSerializer):
+    replies = CommentReplySerializer(many=True, read_only=True, source='thread_replies')
+    replies_count = serializers.IntegerField(read_only=True)
+
+    class Meta:
+        model = Comment
+        fields = ('id', 'content', 'replies', 'replies_count', 'likes_count', 'event', 'is_liked_by_me', 'author')
+
+
+class SchedulePermissionSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     user = serializers.SlugRelatedField(
         many=False,
         read_only=True,
@@ -93,4 +184,4 @@ class SchedulePermissionSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = SchedulePermission
-        fields = ('level', 'schedule', 'user')
+        fields = ('id', 'level', 'schedule', 'user')
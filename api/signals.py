@@ -0,0 +1,102 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+from rest_framework.authtoken.models import Token
+
+from api.authentication import invalidate_tokens
+from api.caching import bump_schedule_version
+from api.changes import record_change, record_message
+from api.occurrences import materialization_enabled, materialize_occurrences
+from api.permission_cache import invalidate_permission_map
+from main.models import Event, Schedule, SchedulePermission, Comment, CommentReply, User
+
+
+def _action(signal, created):
+    if signal is post_delete:
+        return 'deleted'
+    return 'created' if created else 'updated'
+
+
+# Schedule.default_permission_level is not part of the cached map, it is always
+# read from the schedule itself, so only explicit permissions need invalidating.
+@receiver([post_save, post_delete], sender=SchedulePermission)
+def invalidate_schedule_permissions(sender, instance, **kwargs):
+    invalidate_permission_map(instance.user_id)
+    # a concurrent request may have re-cached the old map before we commit
+    transaction.on_commit(lambda: invalidate_permission_map(instance.user_id))
+
+
+@receiver([post_save, post_delete], sender=SchedulePermission)
+def permission_changed(sender, instance, signal, created=False, **kwargs):
+    schedules_changed([instance.schedule_id])
+    record_change(instance.schedule_id, 'permission', _action(signal, created), instance.id)
+
+
+def schedules_changed(schedule_ids):
+    for schedule_id in set(schedule_ids):
+        bump_schedule_version(schedule_id, store=False)
+        transaction.on_commit(lambda schedule_id=schedule_id: bump_schedule_version(schedule_id))
+
+
+@receiver(pre_save, sender=Event)
+def remember_previous_schedule(sender, instance, **kwargs):
+    if instance.pk:
+        instance._previous_schedule_id = (Event.objects.filter(pk=instance.pk)
+                                          .values_list('schedule_id', flat=True).first())
+
+
+@receiver([post_save, post_delete], sender=Event)
+def event_changed(sender, instance, signal, created=False, **kwargs):
+    schedule_ids = [instance.schedule_id]
+    previous_schedule_id = getattr(instance, '_previous_schedule_id', None)
+    if previous_schedule_id is not None:
+        schedule_ids.append(previous_schedule_id)
+    schedules_changed(schedule_ids)
+    record_change(instance.schedule_id, 'event', _action(signal, created), instance.id)
+    if previous_schedule_id not in (None, instance.schedule_id):
+        record_change(previous_schedule_id, 'event', 'deleted', instance.id)
+
+
+@receiver(post_save, sender=Event)
+def event_saved(sender, instance, **kwargs):
+    if materialization_enabled():
+        materialize_occurrences([instance])
+
+
+@receiver([post_save, post_delete], sender=Schedule)
+def schedule_changed(sender, instance, signal, created=False, **kwargs):
+    schedules_changed([instance.id])
+    record_message(instance.id, 'schedule', _action(signal, created), id=instance.id)
+
+
+def event_schedule_id(instance):
+    if type(instance).event.is_cached(instance):
+        return instance.event.schedule_id
+    return Event.objects.filter(pk=instance.event_id).values_list('schedule_id', flat=True).first()
+
+
+@receiver([post_save, post_delete], sender=Comment)
+@receiver([post_save, post_delete], sender=CommentReply)
+def comment_changed(sender, instance, signal, created=False, **kwargs):
+    data = {'event': instance.event_id}
+    if sender is CommentReply:
+        data['reply_to'] = instance.reply_to_id
+    record_change(event_schedule_id(instance), sender._meta.model_name, _action(signal, created), instance.id, **data)
+
+
+# Cached tokens carry their user, so any change to the user (deactivation,
+# password, username, last_login) drops them, like deleting the token does
+@receiver(post_delete, sender=Token)
+def token_deleted(sender, instance, **kwargs):
+    invalidate_tokens([instance.key])
+    transaction.on_commit(lambda: invalidate_tokens([instance.key]))
+
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, created=False, **kwargs):
+    if created:
+        return
+    keys = list(Token.objects.filter(user=instance).values_list('key', flat=True))
+    if keys:
+        invalidate_tokens(keys)
+        transaction.on_commit(lambda: invalidate_tokens(keys))
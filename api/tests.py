@@ -1,6 +1,50 @@
+import json
+import os
+import tempfile
+import threading
+from datetime import datetime, timezone as dt_timezone
+from io import StringIO
+from unittest import mock
+
+import icalendar
+from asgiref.sync import async_to_sync
+
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.core.cache.backends.db import DatabaseCache
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.core.management.base import CommandError, SystemCheckError
+from django.db import connection
+from django.http import Http404, HttpResponse
+from django.test import LiveServerTestCase, RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
 from rest_framework import status
-from rest_framework.test import APITestCase
-from main.models import User, Schedule, EventType, Event, Comment
+from rest_framework.authtoken.models import Token
+from rest_framework.response import Response
+from rest_framework.test import APIRequestFactory, APITestCase, APITransactionTestCase, force_authenticate
+from rest_framework.views import APIView
+from main.models import User, Schedule, EventType, Event, Comment, CommentReply, SchedulePermission, \
+    ScheduleChange, FeedToken
+from main.models import SchedulePermissionLevels as Level
+from api import async_views
+from api import urls as api_urls
+from api.authentication import CachedTokenAuthentication
+from api.caching import bump_schedule_version, get_schedule_version
+from api.change_stream import InProcessBroker
+from api.changes import ChangeLogBroker
+from api.importers import EventImporter
+from api.checks import check_shared_cache
+from api.agenda import occurrence_stream
+from api.occurrences import materialize_occurrences, occurrence_starts
+from api.permission_cache import get_permission_map
+from api.utils import has_permission_to_schedule
+from api.serializers import EventSerializer
+from api.views import ReplicaRoutingViewMixin
+from mimcal.handlers import StreamingASGIHandler
+from mimcal.db_routers import PrimaryReplicaRouter, primary_reads, reset_replica, use_replica
+from mimcal.middleware import RequestMetrics, RequestMetricsMiddleware, _request_metrics, ProfilingMiddleware
 
 
 def create_test_account(client, username='test'):
@@ -18,7 +62,20 @@ def login_test_account(client, username='test'):
     return response
 
 
-class UserTests(APITestCase):
+def count_queries(func):
+    with CaptureQueriesContext(connection) as context:
+        func()
+    return len(context.captured_queries)
+
+
+# ids are reused between tests, so cached per-user and per-schedule data
+# must not leak from one test into the next
+class CacheClearingTestCase(APITestCase):
+    def setUp(self):
+        cache.clear()
+
+
+class UserTests(CacheClearingTestCase):
     def test_create_account(self):
         """
         Ensure we can create a new account object.
@@ -31,8 +88,9 @@ class UserTests(APITestCase):
         self.assertEqual(User.objects.get().username, 'test')
 
 
-class ScenarioTests(APITestCase):
+class ScenarioTests(CacheClearingTestCase):
     def setUp(self):
+        super().setUp()
         self.event_type_test = EventType.objects.create(name='egzamin')
 
         self.test_event_data = {'title': 'jakiś-egzamin',
@@ -257,3 +315,1551 @@ class ScenarioTests(APITestCase):
         url = '/api/v1/schedules/1/to_webcal/'
         response = self.client.get(url)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+class ScheduleEventsTests(CacheClearingTestCase):
+    def setUp(self):
+        super().setUp()
+        create_test_account(self.client)
+        login_test_account(self.client)
+        self.lecture = EventType.objects.create(name='wykład')
+        self.exam = EventType.objects.create(name='egzamin')
+        self.schedule = Schedule.objects.create(name='mimuw', default_permission_level=1,
+                                                owner=User.objects.get(username='test'))
+        for day in range(1, 21):
+            Event.objects.create(title='event %d' % day, start_date='2021-03-%02dT10:00' % day,
+                                 end_date='2021-03-%02dT12:00' % day, schedule=self.schedule,
+                                 type=self.exam if day % 5 == 0 else self.lecture)
+
+    def test_window_and_type_filters(self):
+        url = '/api/v1/schedules/%d/events/' % self.schedule.id
+        response = self.client.get(url, {'from': '2021-03-05', 'to': '2021-03-12'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([e['title'] for e in response.data], ['event %d' % d for d in range(5, 12)])
+
+        response = self.client.get(url, {'type': self.exam.id})
+        self.assertEqual([e['title'] for e in response.data], ['event 5', 'event 10', 'event 15', 'event 20'])
+
+        response = self.client.get(url, {'from': 'yesterday'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_cursor_pagination(self):
+        # events sharing a start date have to be ordered by id, not skipped
+        Event.objects.create(title='event 10b', start_date='2021-03-10T10:00', end_date='2021-03-10T12:00',
+                             schedule=self.schedule, type=self.lecture)
+        url = '/api/v1/schedules/%d/events/' % self.schedule.id
+        titles = []
+        params = {'limit': 3, 'from': '2021-03-02'}
+        while True:
+            response = self.client.get(url, params)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertLessEqual(len(response.data['results']), 3)
+            titles += [e['title'] for e in response.data['results']]
+            if response.data['cursor'] is None:
+                break
+            params['cursor'] = response.data['cursor']
+        expected = ['event %d' % d for d in range(2, 21)]
+        expected.insert(expected.index('event 10') + 1, 'event 10b')
+        self.assertEqual(titles, expected)
+
+        response = self.client.get(url, {'cursor': 'garbage'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_is_checked_in_bulk(self):
+        user = User.objects.get(username='test')
+        for event in Event.objects.filter(type=self.exam):
+            event.users_marks.add(user)
+        events_url = '/api/v1/schedules/%d/events/' % self.schedule.id
+        schedule_url = '/api/v1/schedules/%d/?expand=events' % self.schedule.id
+
+        response = self.client.get(events_url)
+        self.assertEqual([e['title'] for e in response.data if e['is_checked']],
+                         ['event 5', 'event 10', 'event 15', 'event 20'])
+        response = self.client.get(schedule_url)
+        self.assertEqual(len([e for e in response.data['events'] if e['is_checked']]), 4)
+        response = self.client.get('/api/v1/events/%d/' % Event.objects.get(title='event 5').id)
+        self.assertEqual(response.data['is_checked'], True)
+
+        few_events = count_queries(lambda: self.client.get(events_url))
+        few_schedule = count_queries(lambda: self.client.get(schedule_url))
+        for day in range(1, 21):
+            event = Event.objects.create(title='extra %d' % day, start_date='2021-04-%02dT10:00' % day,
+                                         end_date='2021-04-%02dT12:00' % day, schedule=self.schedule,
+                                         type=self.lecture)
+            event.users_marks.add(user)
+        self.assertEqual(count_queries(lambda: self.client.get(events_url)), few_events)
+        self.assertEqual(count_queries(lambda: self.client.get(schedule_url)), few_schedule)
+
+
+class SchedulePermissionLevelTests(CacheClearingTestCase):
+    def setUp(self):
+        super().setUp()
+        create_test_account(self.client, username='owner')
+        create_test_account(self.client, username='test')
+        login_test_account(self.client, username='test')
+        self.owner = User.objects.get(username='owner')
+        self.user = User.objects.get(username='test')
+
+    def create_schedules(self, count):
+        for i in range(count):
+            schedule = Schedule.objects.create(name='schedule %d' % i, default_permission_level=i % 2,
+                                               owner=self.owner)
+            if i % 3 == 0:
+                SchedulePermission.objects.create(schedule=schedule, user=self.user, level=i % 4)
+
+    def test_list_levels(self):
+        self.create_schedules(12)
+        response = self.client.get('/api/v1/schedules/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        levels = {s['name']: s['my_permission_level'] for s in response.data}
+        expected = {}
+        for i in range(12):
+            level = i % 4 if i % 3 == 0 else i % 2
+            if i % 2 >= 1 or level >= 1:
+                expected['schedule %d' % i] = level
+        self.assertEqual(levels, expected)
+
+        few = count_queries(lambda: self.client.get('/api/v1/schedules/'))
+        self.create_schedules(30)
+        self.assertEqual(count_queries(lambda: self.client.get('/api/v1/schedules/')), few)
+
+
+class PermissionCacheTests(CacheClearingTestCase):
+    def setUp(self):
+        super().setUp()
+        create_test_account(self.client, username='owner')
+        create_test_account(self.client, username='test')
+        self.owner = User.objects.get(username='owner')
+        self.schedule = Schedule.objects.create(name='mimuw', default_permission_level=0, owner=self.owner)
+
+    def has_permission(self, level):
+        # a fresh instance per call, like a new request
+        return has_permission_to_schedule(User.objects.get(username='test'), level, self.schedule)
+
+    def test_cached_and_invalidated(self):
+        self.assertFalse(self.has_permission(Level.READ_ACCESS))
+        permission = SchedulePermission.objects.create(schedule=self.schedule, level=Level.READ_ACCESS,
+                                                       user=User.objects.get(username='test'))
+        self.assertTrue(self.has_permission(Level.READ_ACCESS))
+        self.assertFalse(self.has_permission(Level.READ_WRITE_ACCESS))
+
+        user = User.objects.get(username='test')
+        with self.assertNumQueries(0):
+            self.assertTrue(has_permission_to_schedule(user, Level.READ_ACCESS, self.schedule))
+
+        permission.level = Level.READ_WRITE_ACCESS
+        permission.save()
+        self.assertTrue(self.has_permission(Level.READ_WRITE_ACCESS))
+
+        permission.delete()
+        self.assertFalse(self.has_permission(Level.READ_ACCESS))
+
+        self.schedule.default_permission_level = Level.READ_ACCESS
+        self.schedule.save()
+        self.assertTrue(self.has_permission(Level.READ_ACCESS))
+
+
+class EventFeedTests(CacheClearingTestCase):
+    def setUp(self):
+        super().setUp()
+        create_test_account(self.client)
+        self.event_type = EventType.objects.create(name='wykład')
+        self.schedule = Schedule.objects.create(name='mimuw', default_permission_level=1,
+                                                owner=User.objects.get(username='test'))
+        self.other = Schedule.objects.create(name='other', default_permission_level=1,
+                                             owner=User.objects.get(username='test'))
+        self.url = '/api/v1/schedules/%d/to_webcal/' % self.schedule.id
+
+    def create_event(self, title, schedule=None, day=1):
+        return Event.objects.create(title=title, start_date='2021-03-%02dT10:00' % day,
+                                    end_date='2021-03-%02dT12:00' % day,
+                                    schedule=schedule or self.schedule, type=self.event_type)
+
+    def get_feed(self, **extra):
+        response = self.client.get(self.url, **extra)
+        # unfold long content lines
+        response.text = response.content.decode().replace('\r\n ', '')
+        return response
+
+    def test_conditional_get_and_cached_body(self):
+        event = self.create_event('wykład 1')
+        response = self.get_feed()
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn('SUMMARY:wykład 1', response.text)
+        etag = response['ETag']
+        self.assertTrue(response.has_header('Last-Modified'))
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        # the body is served from the cache, events are not queried again
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(any('main_event' in q['sql'] for q in queries.captured_queries))
+
+        # other schedules do not invalidate this feed
+        self.create_event('elsewhere', schedule=self.other)
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code,
+                         status.HTTP_304_NOT_MODIFIED)
+
+        event.title = 'wykład 2'
+        event.save()
+        response = self.get_feed(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn('SUMMARY:wykład 2', response.text)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_version_is_kept_on_the_schedule(self):
+        self.create_event('wykład 1')
+        # the test transaction never commits, the token is only stored on commit
+        bump_schedule_version(self.schedule.id)
+        etag = self.client.get(self.url)['ETag']
+        # e.g. the cache lost the entry
+        cache.clear()
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code,
+                         status.HTTP_304_NOT_MODIFIED)
+        bump_schedule_version(self.schedule.id)
+        cache.clear()
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, status.HTTP_200_OK)
+
+    def test_moving_event_invalidates_previous_schedule(self):
+        event = self.create_event('wykład 1')
+        etag = self.client.get(self.url)['ETag']
+        event.schedule = self.other
+        event.save()
+        response = self.get_feed(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotIn('wykład 1', response.text)
+
+    def test_streamed_feed_matches_rendered_feed(self):
+        for day in range(1, 8):
+            Event.objects.create(title='wykład %d' % day, desc='opis ' * day * 10,
+                                 start_date='2021-03-%02dT10:00' % day, end_date='2021-03-%02dT12:00' % day,
+                                 schedule=self.schedule, type=self.event_type)
+
+        def without_timestamps(content):
+            return [line for line in content.split(b'\r\n') if not line.startswith(b'DTSTAMP')]
+
+        rendered = self.client.get(self.url, {'stream': '0'})
+        with mock.patch('api.ical_views.FEED_STREAM_CHUNK_SIZE', 3):
+            streamed = self.client.get(self.url, {'stream': '1'})
+        self.assertTrue(streamed.streaming)
+        self.assertEqual(streamed['ETag'], rendered['ETag'])
+        self.assertEqual(without_timestamps(b''.join(streamed.streaming_content)),
+                         without_timestamps(rendered.content))
+
+    def test_feed_window(self):
+        for day in range(1, 8):
+            self.create_event('wykład %d' % day, day=day)
+        for stream in ('0', '1'):
+            response = self.client.get(self.url, {'from': '2021-03-03', 'to': '2021-03-05', 'stream': stream})
+            content = b''.join(response.streaming_content) if response.streaming else response.content
+            self.assertEqual(content.count(b'BEGIN:VEVENT'), 2)
+        self.assertEqual(self.client.get(self.url, {'from': 'soon'}).status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class CommentThreadTests(CacheClearingTestCase):
+    def setUp(self):
+        super().setUp()
+        create_test_account(self.client, username='test')
+        create_test_account(self.client, username='test2')
+        login_test_account(self.client, username='test')
+        self.user = User.objects.get(username='test')
+        self.other = User.objects.get(username='test2')
+        schedule = Schedule.objects.create(name='mimuw', default_permission_level=1, owner=self.user)
+        self.event = Event.objects.create(title='egzamin', start_date='2021-03-01T10:00',
+                                          end_date='2021-03-01T12:00', schedule=schedule,
+                                          type=EventType.objects.create(name='egzamin'))
+        self.url = '/api/v1/events/%d/thread/' % self.event.id
+
+    def create_comments(self, count, replies=4):
+        for i in range(count):
+            comment = Comment.objects.create(content='comment %d' % i, author=self.other, event=self.event)
+            if i % 2 == 0:
+                comment.liked_users.add(self.user)
+            for j in range(replies):
+                reply = CommentReply.objects.create(content='reply %d.%d' % (i, j), author=self.user,
+                                                    event=self.event, reply_to=comment, likes_count=0)
+                if j == 1:
+                    reply.liked_users.add(self.user)
+
+    def test_thread(self):
+        self.create_comments(5)
+        response = self.client.get(self.url, {'limit': 2, 'replies': 2})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        comments = response.data['results']
+        self.assertEqual([c['content'] for c in comments], ['comment 0', 'comment 1'])
+        self.assertEqual([c['is_liked_by_me'] for c in comments], [True, False])
+        self.assertEqual(comments[0]['author'], 'test2')
+        self.assertEqual(comments[0]['replies_count'], 4)
+        self.assertEqual([r['content'] for r in comments[1]['replies']], ['reply 1.0', 'reply 1.1'])
+        self.assertEqual([r['is_liked_by_me'] for r in comments[1]['replies']], [False, True])
+
+        response = self.client.get(self.url, {'limit': 2, 'replies': 2, 'cursor': response.data['cursor']})
+        self.assertEqual([c['content'] for c in response.data['results']], ['comment 2', 'comment 3'])
+
+        response = self.client.get('/api/v1/events/%d/comments/' % self.event.id)
+        self.assertEqual(len(response.data), 5)
+        self.assertEqual(len(response.data[0]['replies']), 4)
+        self.assertEqual(response.data[0]['replies'][1]['is_liked_by_me'], True)
+
+    def test_constant_queries(self):
+        self.create_comments(3)
+        # the first request also caches the token lookup
+        self.client.get(self.url)
+        thread = count_queries(lambda: self.client.get(self.url))
+        comments = count_queries(lambda: self.client.get('/api/v1/events/%d/comments/' % self.event.id))
+        self.create_comments(20, replies=6)
+        self.assertEqual(count_queries(lambda: self.client.get(self.url)), thread)
+        self.assertEqual(count_queries(lambda: self.client.get('/api/v1/events/%d/comments/' % self.event.id)),
+                         comments)
+
+    def test_likes_are_idempotent(self):
+        self.create_comments(1, replies=1)
+        comment = Comment.objects.get()
+        reply = CommentReply.objects.get()
+        reply.liked_users.clear()
+        comment.liked_users.clear()
+        for _ in range(2):
+            self.assertEqual(self.client.post('/api/v1/comments/%d/like/' % comment.id).status_code, 200)
+            self.assertEqual(self.client.post('/api/v1/commentReplies/%d/like/' % reply.id).status_code, 200)
+        comment.refresh_from_db()
+        reply.refresh_from_db()
+        self.assertEqual((comment.likes_count, reply.likes_count), (1, 1))
+
+        for _ in range(2):
+            self.client.post('/api/v1/comments/%d/unlike/' % comment.id)
+            self.client.post('/api/v1/commentReplies/%d/unlike/' % reply.id)
+        comment.refresh_from_db()
+        reply.refresh_from_db()
+        self.assertEqual((comment.likes_count, reply.likes_count), (0, 0))
+
+        self.client.credentials()
+        response = self.client.post('/api/v1/commentReplies/%d/like/' % reply.id)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_reconcile_like_counts(self):
+        self.create_comments(3, replies=2)
+        Comment.objects.update(likes_count=7)
+        call_command('reconcile_like_counts', stdout=StringIO())
+        self.assertEqual([c.likes_count for c in Comment.objects.order_by('id')], [1, 0, 1])
+        self.assertEqual([r.likes_count for r in CommentReply.objects.order_by('id')], [0, 1] * 3)
+
+
+class BulkEventTests(CacheClearingTestCase):
+    def setUp(self):
+        super().setUp()
+        create_test_account(self.client, username='test')
+        create_test_account(self.client, username='test2')
+        login_test_account(self.client, username='test')
+        self.user = User.objects.get(username='test')
+        self.event_type = EventType.objects.create(name='wykład')
+        self.schedule = Schedule.objects.create(name='mimuw', default_permission_level=1, owner=self.user)
+        SchedulePermission.objects.create(schedule=self.schedule, user=self.user, level=Level.MANAGE_ACCESS)
+        self.foreign = Schedule.objects.create(name='foreign', default_permission_level=1,
+                                               owner=User.objects.get(username='test2'))
+        self.events = [Event.objects.create(title='event %d' % i, start_date='2021-03-01T10:00',
+                                            end_date='2021-03-01T12:00', schedule=self.schedule,
+                                            type=self.event_type) for i in range(3)]
+        self.url = '/api/v1/events/bulk/'
+
+    def event_data(self, title, schedule=None):
+        return {'title': title, 'desc': '', 'start_date': '2021-03-02T10:00', 'end_date': '2021-03-02T12:00',
+                'type': self.event_type.id, 'schedule': (schedule or self.schedule).id}
+
+    def test_bulk_operations(self):
+        operations = [
+            {'op': 'create', 'data': self.event_data('new 1')},
+            {'op': 'update', 'id': self.events[0].id, 'data': {'title': 'renamed'}},
+            {'op': 'delete', 'id': self.events[1].id},
+            {'op': 'create', 'data': self.event_data('new 2')},
+        ]
+        response = self.client.post(self.url, operations, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        results = response.data['results']
+        self.assertEqual([r['status'] for r in results], ['created', 'updated', 'deleted', 'created'])
+        self.assertEqual(Event.objects.get(id=results[0]['id']).title, 'new 1')
+        self.assertEqual(Event.objects.get(id=results[3]['id']).title, 'new 2')
+        self.assertEqual(Event.objects.get(id=self.events[0].id).title, 'renamed')
+        self.assertFalse(Event.objects.filter(id=self.events[1].id).exists())
+
+    def test_invalid_batch_is_not_applied(self):
+        operations = [
+            {'op': 'create', 'data': self.event_data('new 1')},
+            {'op': 'update', 'id': 999, 'data': {'title': 'renamed'}},
+            {'op': 'create', 'data': {'title': 'no dates', 'type': self.event_type.id,
+                                      'schedule': self.schedule.id}},
+            {'op': 'rename'},
+            {'op': 'delete', 'id': self.events[1].id},
+            {'op': 'delete', 'id': self.events[1].id},
+        ]
+        response = self.client.post(self.url, operations, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual([r['status'] for r in response.data['results']],
+                         ['valid', 'invalid', 'invalid', 'invalid', 'valid', 'invalid'])
+        self.assertIn('start_date', response.data['results'][2]['errors'])
+        self.assertEqual(Event.objects.count(), 3)
+
+    def test_event_must_not_end_before_it_starts(self):
+        backwards = dict(self.event_data('backwards'), end_date='2021-03-02T09:00')
+        operations = [{'op': 'create', 'data': backwards},
+                      {'op': 'update', 'id': self.events[0].id, 'data': {'end_date': '2021-03-01T09:00'}},
+                      {'op': 'update', 'id': self.events[1].id, 'data': {'end_date': '2021-03-01T11:00'}}]
+        response = self.client.post(self.url, operations, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual([r['status'] for r in response.data['results']], ['invalid', 'invalid', 'valid'])
+        self.assertIn('end_date', response.data['results'][1]['errors'])
+
+    def test_permission_checked_per_schedule(self):
+        operations = [{'op': 'create', 'data': self.event_data('new %d' % i)} for i in range(5)]
+        operations.append({'op': 'create', 'data': self.event_data('intruder', schedule=self.foreign)})
+        response = self.client.post(self.url, operations, format='json')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.assertEqual(Event.objects.count(), 3)
+
+        few = count_queries(lambda: self.client.post(self.url, operations[:1], format='json'))
+        many = count_queries(lambda: self.client.post(self.url, operations[:5], format='json'))
+        # only the inserts themselves grow with the batch on backends without bulk insert ids
+        self.assertLessEqual(many - few, 4 * 2)
+
+
+class EventImportTests(CacheClearingTestCase):
+    ICS = '\r\n'.join([
+        'BEGIN:VCALENDAR', 'VERSION:2.0', 'PRODID:-//test//EN',
+        'BEGIN:VEVENT', 'UID:1', 'SUMMARY:Analiza', 'CATEGORIES:wykład',
+        'DTSTART:20210301T100000Z', 'DTEND:20210301T120000Z',
+        'DESCRIPTION:a very long description that is folded over more than one line by the',
+        '  exporting calendar',
+        'BEGIN:VALARM', 'ACTION:DISPLAY', 'TRIGGER:-PT15M', 'END:VALARM', 'END:VEVENT',
+        'BEGIN:VEVENT', 'UID:2', 'SUMMARY:Analiza', 'CATEGORIES:wykład',
+        'DTSTART:20210308T100000Z', 'DTEND:20210308T120000Z', 'END:VEVENT',
+        'BEGIN:VEVENT', 'UID:3', 'SUMMARY:Rektorskie', 'DTSTART;VALUE=DATE:20210310', 'END:VEVENT',
+        'BEGIN:VEVENT', 'UID:4', 'SUMMARY:Broken', 'END:VEVENT',
+        'END:VCALENDAR', ''])
+
+    def setUp(self):
+        super().setUp()
+        create_test_account(self.client)
+        login_test_account(self.client)
+        self.schedule = Schedule.objects.create(name='mimuw', default_permission_level=1,
+                                                owner=User.objects.get(username='test'))
+        SchedulePermission.objects.create(schedule=self.schedule, user=User.objects.get(username='test'),
+                                          level=Level.READ_WRITE_ACCESS)
+        self.url = '/api/v1/schedules/%d/import_events/' % self.schedule.id
+
+    def upload(self, name, content):
+        file = SimpleUploadedFile(name, content.encode())
+        return self.client.post(self.url, {'file': file}, format='multipart')
+
+    def test_import_ics(self):
+        response = self.upload('plan.ics', self.ICS)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual((response.data['inserted'], response.data['skipped'], response.data['failed']), (3, 0, 1))
+        analiza = Event.objects.filter(title='Analiza').first()
+        self.assertEqual(analiza.type.name, 'wykład')
+        self.assertIn('folded over more than one line by the exporting calendar', analiza.desc)
+        holiday = Event.objects.get(title='Rektorskie')
+        self.assertEqual((holiday.start_date.day, holiday.end_date.day, holiday.type.name), (10, 11, 'inne'))
+
+        # importing the same file again only skips
+        response = self.upload('plan.ics', self.ICS)
+        self.assertEqual((response.data['inserted'], response.data['skipped']), (0, 3))
+
+    def test_import_recurring_ics(self):
+        ics = '\r\n'.join([
+            'BEGIN:VCALENDAR', 'VERSION:2.0', 'PRODID:-//test//EN',
+            'BEGIN:VEVENT', 'UID:1', 'SUMMARY:Analiza', 'DTSTART:20210301T100000Z', 'DTEND:20210301T120000Z',
+            'RRULE:FREQ=WEEKLY;UNTIL=20210329T100000Z', 'EXDATE:20210315T100000Z',
+            'RDATE;TZID=Europe/Warsaw:20210319T110000', 'END:VEVENT',
+            'BEGIN:VEVENT', 'UID:2', 'SUMMARY:Broken', 'DTSTART:20210301T100000Z', 'RRULE:FREQ=SOMETIMES',
+            'END:VEVENT', 'END:VCALENDAR', ''])
+        response = self.upload('plan.ics', ics)
+        self.assertEqual((response.data['inserted'], response.data['failed']), (1, 1))
+        analiza = Event.objects.get(title='Analiza')
+        self.assertEqual([start.day for start in occurrence_starts(analiza, None, datetime(2021, 4, 30))],
+                         [1, 8, 19, 22, 29])
+
+    def test_import_csv_in_chunks(self):
+        rows = ['title,desc,start_date,end_date,type']
+        rows += ['zajęcia %d,,2021-03-01T%02d:00,2021-03-01T%02d:30,%s' % (i, i % 24, i % 24, ['lab', 'wykład'][i % 2])
+                 for i in range(25)]
+        rows += ['bez daty,,,,lab', 'zajęcia 0,,2021-03-01T00:00,2021-03-01T00:30,lab']
+        EventType.objects.create(name='lab')
+        with mock.patch('api.importers.IMPORT_CHUNK_SIZE', 10):
+            response = self.upload('plan.csv', '\n'.join(rows))
+        self.assertEqual((response.data['inserted'], response.data['skipped'], response.data['failed']), (25, 1, 1))
+        self.assertEqual(response.data['errors'][0]['line'], 27)
+        self.assertEqual(EventType.objects.filter(name='lab').count(), 1)
+
+        response = self.upload('plan.csv', 'name,when\nx,y\n')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_import_commits_chunks(self):
+        rows = ['title,start_date,end_date'] + ['zajęcia %d,2021-03-01T10:00,2021-03-01T12:00' % i
+                                                for i in range(400)]
+        content = '\n'.join(rows).encode() + '\nzaj\u0119cia,2021-03-02T10:00,2021-03-02T12:00\n'.encode('iso-8859-2')
+        importer_flush = EventImporter.flush
+
+        def flush(importer, chunk):
+            importer_flush(importer, chunk)
+            # another request adding an event to the schedule meanwhile
+            Event.objects.create(title='concurrent', start_date='2021-03-01T10:00', end_date='2021-03-01T12:00',
+                                 schedule=self.schedule, type=EventType.objects.get_or_create(name='lab')[0])
+
+        with mock.patch('api.importers.IMPORT_CHUNK_SIZE', 100), \
+                mock.patch.object(EventImporter, 'flush', autospec=True, side_effect=flush):
+            response = self.client.post(self.url, {'file': SimpleUploadedFile('plan.csv', content)},
+                                        format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertGreater(response.data['inserted'], 0)
+        self.assertEqual(response.data['failed'], 1)
+        self.assertEqual(response.data['errors'][-1]['error'], 'the file is not UTF-8 encoded')
+        self.assertEqual(Event.objects.filter(title__startswith='zaj').count(), response.data['inserted'])
+        logged = ScheduleChange.objects.filter(schedule=self.schedule, kind='event').values_list('object_id',
+                                                                                                flat=True)
+        self.assertEqual(sorted(logged), sorted(Event.objects.filter(schedule=self.schedule).values_list('id',
+                                                                                                          flat=True)))
+
+    def test_import_csv_not_in_utf8(self):
+        content = 'title,start_date,end_date\nzajęcia,2021-03-01T10:00,2021-03-01T12:00\n'.encode('iso-8859-2')
+        file = SimpleUploadedFile('plan.csv', content)
+        response = self.client.post(self.url, {'file': file}, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(Event.objects.filter(title__startswith='zaj').exists())
+
+        # a field over csv.field_size_limit()
+        file = SimpleUploadedFile('plan.csv', ('title,start_date,end_date\n%s,y,z\n' % ('x' * 200000)).encode())
+        response = self.client.post(self.url, {'file': file}, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class RecurringEventTests(CacheClearingTestCase):
+    def setUp(self):
+        super().setUp()
+        create_test_account(self.client)
+        login_test_account(self.client)
+        self.user = User.objects.get(username='test')
+        self.schedule = Schedule.objects.create(name='mimuw', default_permission_level=1, owner=self.user)
+        SchedulePermission.objects.create(schedule=self.schedule, user=self.user, level=Level.MANAGE_ACCESS)
+        self.event_type = EventType.objects.create(name='wykład')
+        # weekly lecture, 10 weeks, without the 3rd one which moved to Friday
+        response = self.client.post('/api/v1/events/', {
+            'title': 'Analiza', 'desc': '', 'start_date': '2021-03-01T10:00', 'end_date': '2021-03-01T12:00',
+            'type': self.event_type.id, 'schedule': self.schedule.id,
+            'recurrences': 'RRULE:FREQ=WEEKLY;COUNT=10\nEXDATE:20210315T100000\nRDATE:20210319T100000',
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.lecture = Event.objects.get(title='Analiza')
+        Event.objects.create(title='egzamin', start_date='2021-03-10T09:00', end_date='2021-03-10T11:00',
+                             schedule=self.schedule, type=self.event_type)
+        self.url = '/api/v1/schedules/%d/events/' % self.schedule.id
+
+    def get_window(self, **params):
+        response = self.client.get(self.url, {'from': '2021-03-08', 'to': '2021-03-29', **params})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data['results'] if 'results' in response.data else response.data
+
+    def assertWindow(self, events):
+        self.assertEqual([(e['title'], e['start_date'], e['end_date']) for e in events], [
+            ('Analiza', '2021-03-08T10:00:00', '2021-03-08T12:00:00'),
+            ('egzamin', '2021-03-10T09:00:00', '2021-03-10T11:00:00'),
+            ('Analiza', '2021-03-19T10:00:00', '2021-03-19T12:00:00'),
+            ('Analiza', '2021-03-22T10:00:00', '2021-03-22T12:00:00'),
+        ])
+
+    def test_lazy_expansion(self):
+        self.assertWindow(self.get_window())
+        events = self.get_window(limit=2)
+        self.assertEqual(len(events), 2)
+        response = self.client.get(self.url)
+        self.assertEqual(len(response.data), 2)
+        self.assertTrue(response.data[0]['recurrences'].startswith('RRULE:FREQ=WEEKLY;COUNT=10'))
+
+    def test_cursor_over_occurrences(self):
+        titles, params = [], {'limit': 1}
+        while True:
+            response = self.client.get(self.url, {'from': '2021-03-08', 'to': '2021-03-29', **params})
+            titles += [(e['title'], e['start_date']) for e in response.data['results']]
+            if response.data['cursor'] is None:
+                break
+            params['cursor'] = response.data['cursor']
+        self.assertEqual(len(titles), 4)
+        self.assertEqual(titles[2], ('Analiza', '2021-03-19T10:00:00'))
+
+    def test_materialized_occurrences(self):
+        with self.settings(MATERIALIZE_OCCURRENCES=True):
+            call_command('materialize_occurrences', stdout=StringIO())
+            self.assertEqual(self.lecture.occurrences.count(), 10)
+            self.assertWindow(self.get_window())
+
+            self.lecture.recurrences = 'RRULE:FREQ=WEEKLY;COUNT=2'
+            self.lecture.save()
+            self.assertEqual(self.lecture.occurrences.count(), 2)
+
+    def test_feed_has_rrule(self):
+        response = self.client.get('/api/v1/schedules/%d/to_webcal/' % self.schedule.id)
+        content = response.content.decode()
+        self.assertEqual(content.count('BEGIN:VEVENT'), 2)
+        self.assertIn('RRULE:FREQ=WEEKLY;COUNT=10', content)
+        self.assertIn('EXDATE:20210315T100000', content)
+        self.assertIn('RDATE:20210319T100000', content)
+        response = self.client.get('/api/v1/schedules/%d/to_webcal/' % self.schedule.id,
+                                   {'from': '2021-03-20', 'to': '2021-04-01'})
+        self.assertEqual(response.content.decode().count('BEGIN:VEVENT'), 1)
+
+
+class ReplicaRoutedView(ReplicaRoutingViewMixin, APIView):
+    permission_classes = []
+    router = PrimaryReplicaRouter()
+
+    def get(self, request):
+        return Response({'read_db': self.router.db_for_read(Event)})
+
+    post = get
+
+
+class ReplicaRoutingTests(CacheClearingTestCase):
+    def setUp(self):
+        super().setUp()
+        self.factory = APIRequestFactory()
+        self.router = PrimaryReplicaRouter()
+        self.view = ReplicaRoutedView.as_view()
+        patcher = mock.patch('mimcal.db_routers.replica_configured', return_value=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_routing(self):
+        first = Token.objects.create(user=User.objects.create(username='first'))
+        second = Token.objects.create(user=User.objects.create(username='second'))
+        response = self.view(self.factory.get('/', HTTP_AUTHORIZATION='Token ' + first.key))
+        self.assertEqual(response.data['read_db'], 'replica')
+        self.assertEqual(self.router.db_for_read(Event), 'default')
+
+        response = self.view(self.factory.post('/', HTTP_AUTHORIZATION='Token ' + first.key))
+        self.assertEqual(response.data['read_db'], 'default')
+        self.assertIn('primary_pin', response.cookies)
+
+        # read your writes, whatever the credentials
+        request = self.factory.get('/')
+        force_authenticate(request, first.user)
+        self.assertEqual(self.view(request).data['read_db'], 'default')
+        response = self.view(self.factory.get('/', HTTP_AUTHORIZATION='Token ' + second.key))
+        self.assertEqual(response.data['read_db'], 'replica')
+        request = self.factory.get('/')
+        request.COOKIES['primary_pin'] = '1'
+        self.assertEqual(self.view(request).data['read_db'], 'default')
+
+    def test_failed_write_does_not_pin(self):
+        response = self.view(self.factory.post('/', HTTP_AUTHORIZATION='Token unknown'))
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertNotIn('primary_pin', response.cookies)
+        self.assertEqual(self.router.db_for_read(Event), 'default')
+
+    # the replica isn't configured in the tests, reading from it would fail
+    @override_settings(DATABASE_ROUTERS=['mimcal.db_routers.PrimaryReplicaRouter'])
+    def test_cache_fills_read_primary(self):
+        user = User.objects.create(username='first')
+        token = Token.objects.create(user=user)
+        schedule = Schedule.objects.create(name='mimuw', default_permission_level=1, owner=user)
+        replica = use_replica(True)
+        try:
+            with primary_reads():
+                self.assertEqual(self.router.db_for_read(Event), 'default')
+            self.assertEqual(self.router.db_for_read(Event), 'replica')
+            self.assertEqual(CachedTokenAuthentication().authenticate_credentials(token.key)[0], user)
+            self.assertEqual(get_permission_map(user), {})
+            cache.clear()
+            self.assertEqual(get_schedule_version(schedule.id)['token'], schedule.version_token)
+        finally:
+            reset_replica(replica)
+
+    def test_unused_without_replica(self):
+        with mock.patch('mimcal.db_routers.replica_configured', return_value=False):
+            response = self.view(self.factory.get('/'))
+        self.assertEqual(response.data['read_db'], 'default')
+
+    def test_database_cache_reads_primary(self):
+        entry = DatabaseCache('mimcal_cache', {}).cache_model_class
+        token = use_replica(True)
+        try:
+            self.assertEqual(self.router.db_for_read(Event), 'replica')
+            self.assertEqual(self.router.db_for_read(entry), 'default')
+        finally:
+            reset_replica(token)
+
+
+@override_settings(REQUEST_METRICS=True, REQUEST_METRICS_SLOW_QUERY_MS=0)
+class RequestMetricsTests(CacheClearingTestCase):
+    def setUp(self):
+        super().setUp()
+        user = User.objects.create(username='test')
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + Token.objects.create(user=user).key)
+        self.schedule = Schedule.objects.create(name='mimuw', default_permission_level=1, owner=user)
+        event_type = EventType.objects.create(name='egzamin')
+        for i in range(3):
+            Event.objects.create(title='e%d' % i, start_date='2021-02-02T10:00', end_date='2021-02-02T12:00',
+                                 type=event_type, schedule=self.schedule)
+
+    def test_server_timing_and_log(self):
+        with self.assertLogs('mimcal.request_metrics', 'INFO') as logs:
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get('/api/v1/schedules/%d/events/' % self.schedule.id)
+        self.assertEqual(len(response.data), 3)
+        timings = dict(timing.split(';', 1) for timing in response['Server-Timing'].split(', '))
+        self.assertEqual(set(timings), {'db', 'serializer', 'view', 'total'})
+        self.assertIn('desc="%d queries"' % len(queries), timings['db'])
+
+        line = json.loads(logs.records[0].getMessage())
+        self.assertEqual((line['view'], line['status'], line['sql_count']), ('schedule-events', 200, len(queries)))
+        self.assertGreater(line['serializer_ms'] + line['view_ms'], 0)
+        slow = json.loads(logs.records[1].getMessage())
+        self.assertEqual(slow['view'], 'schedule-events')
+        self.assertIn('SELECT', slow['slow_query'])
+
+    def test_serializer_time(self):
+        metrics = RequestMetrics()
+        token = _request_metrics.set(metrics)
+        events = list(Event.objects.all())
+        try:
+            with mock.patch('mimcal.middleware.time.perf_counter', side_effect=[1.0, 2.0] * 3):
+                data = EventSerializer(events, many=True).data
+        finally:
+            _request_metrics.reset(token)
+        self.assertEqual(len(data), 3)
+        self.assertEqual(metrics.serializer_time, 3.0)
+
+    def test_unused_when_disabled(self):
+        with self.settings(REQUEST_METRICS=False):
+            with self.assertRaises(MiddlewareNotUsed):
+                RequestMetricsMiddleware(HttpResponse)
+
+
+class ProfilingTests(CacheClearingTestCase):
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        settings = self.settings(PROFILE_DIR=self.directory.name, PROFILE_SAMPLE_RATE=0, PROFILE_KEEP=2)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.user = User.objects.create(username='test')
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + Token.objects.create(user=self.user).key)
+
+    def profiles(self, view='schedule-list'):
+        directory = os.path.join(self.directory.name, view)
+        return sorted(os.listdir(directory)) if os.path.isdir(directory) else []
+
+    def test_profiled_requests(self):
+        self.client.get('/api/v1/schedules/', HTTP_X_PROFILE='1')
+        self.assertEqual(self.profiles(), [])
+
+        self.user.is_staff = True
+        self.user.save()
+        self.client.get('/api/v1/schedules/')
+        self.assertEqual(self.profiles(), [])
+        for _ in range(3):
+            self.client.get('/api/v1/schedules/', HTTP_X_PROFILE='1')
+        self.assertEqual(len(self.profiles()), 2)
+
+        with self.settings(PROFILE_SAMPLE_RATE=1):
+            # middleware settings are read when the handler loads it
+            self.client_class().get('/api/v1/events/0/')
+        self.assertEqual(len(self.profiles('event-detail')), 1)
+
+        out = StringIO()
+        call_command('profile_report', '--top', '5', '--merge', stdout=out)
+        report = out.getvalue()
+        self.assertIn('== event-detail: 1 profiles', report)
+        self.assertIn('== schedule-list: 2 profiles', report)
+        self.assertIn('get_response', report)
+        self.assertTrue(os.path.isfile(os.path.join(self.directory.name, 'schedule-list.prof')))
+
+    def test_token_resolved_once(self):
+        self.user.is_staff = True
+        self.user.save()
+        resolve = CachedTokenAuthentication.authenticate_credentials
+        with mock.patch.object(CachedTokenAuthentication, 'authenticate_credentials', autospec=True,
+                               side_effect=resolve) as credentials:
+            self.client.get('/api/v1/schedules/', HTTP_X_PROFILE='1')
+        self.assertEqual(credentials.call_count, 1)
+        self.assertEqual(len(self.profiles()), 1)
+
+    def test_session_staff(self):
+        self.user.is_staff = True
+        self.user.save()
+        self.client.credentials()
+        self.client.force_login(self.user)
+        self.client.get('/api/v1/schedules/', HTTP_X_PROFILE='1')
+        self.assertEqual(len(self.profiles()), 1)
+
+    def test_unused_without_directory(self):
+        with self.settings(PROFILE_DIR=''):
+            with self.assertRaises(MiddlewareNotUsed):
+                ProfilingMiddleware(HttpResponse)
+
+
+class AsyncReadViewTests(APITransactionTestCase):
+    # the async views query from pooled threads, which only see committed data
+    def setUp(self):
+        cache.clear()
+        create_test_account(self.client, username='test')
+        self.token = login_test_account(self.client, username='test').data['token']
+        self.user = User.objects.get(username='test')
+        self.schedule = Schedule.objects.create(name='mimuw', default_permission_level=0, owner=self.user)
+        SchedulePermission.objects.create(user=self.user, schedule=self.schedule, level=Level.READ_ACCESS)
+        event_type = EventType.objects.create(name='egzamin')
+        for day in range(1, 4):
+            event = Event.objects.create(title='egzamin %d' % day, start_date='2021-03-0%dT10:00' % day,
+                                         end_date='2021-03-0%dT12:00' % day, schedule=self.schedule,
+                                         type=event_type)
+        Comment.objects.create(content='comment', author=self.user, event=event)
+        self.event = event
+        self.factory = RequestFactory()
+
+    def get(self, view, path, authorized=True, **kwargs):
+        extra = {'HTTP_AUTHORIZATION': 'Token ' + self.token} if authorized else {}
+        request = self.factory.get(path, **extra)
+        # set by AuthenticationMiddleware, which the feed relies on
+        request.user = self.user if authorized else AnonymousUser()
+        return async_to_sync(view)(request, **kwargs)
+
+    def test_async_routes(self):
+        with self.settings(ASYNC_READ_VIEWS=True):
+            urls = api_urls.router_urls()
+        self.assertEqual([url.name for url in urls], [url.name for url in api_urls.router.urls])
+        replaced = {url.name: url.callback for url in urls if url.name in api_urls.async_read_views}
+        self.assertEqual(replaced, api_urls.async_read_views)
+
+    def test_async_views(self):
+        url = '/api/v1/schedules/%d/events/' % self.schedule.id
+        response = self.get(async_views.schedule_events, url + '?limit=2', pk=self.schedule.id)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = json.loads(response.content)
+        self.assertEqual([e['title'] for e in data['results']], ['egzamin 1', 'egzamin 2'])
+        self.assertEqual(response.content, self.client.get(url, {'limit': 2}).content)
+        self.assertEqual(self.get(async_views.schedule_events, url, authorized=False,
+                                  pk=self.schedule.id).status_code, status.HTTP_404_NOT_FOUND)
+
+        url = '/api/v1/events/%d/thread/' % self.event.id
+        response = self.get(async_views.event_thread, url, pk=self.event.id)
+        self.assertEqual([c['content'] for c in json.loads(response.content)['results']], ['comment'])
+
+        url = '/api/v1/schedules/%d/to_webcal/' % self.schedule.id
+        response = self.get(async_views.event_feed, url + '?stream=1', schedule_id=self.schedule.id)
+        # not buffered, the handler sends one chunk of events at a time
+        self.assertTrue(response.streaming)
+        messages = []
+
+        async def send(message):
+            messages.append(message)
+
+        with mock.patch('api.ical_views.FEED_STREAM_CHUNK_SIZE', 1):
+            async_to_sync(StreamingASGIHandler().send_response)(response, send)
+        self.assertEqual(messages[0]['status'], status.HTTP_200_OK)
+        body = [message['body'] for message in messages[1:-1]]
+        self.assertEqual(len(body), 5)
+        self.assertEqual(messages[-1], {'type': 'http.response.body'})
+        content = b''.join(body)
+        self.assertEqual(content.count(b'BEGIN:VEVENT'), 3)
+        without_timestamps = [line for line in content.split(b'\r\n') if not line.startswith(b'DTSTAMP')]
+        rendered = self.get(async_views.event_feed, url, schedule_id=self.schedule.id).content
+        self.assertEqual(without_timestamps,
+                         [line for line in rendered.split(b'\r\n') if not line.startswith(b'DTSTAMP')])
+        with self.assertRaises(Http404):
+            self.get(async_views.event_feed, url, authorized=False, schedule_id=self.schedule.id)
+
+
+class BenchmarkConcurrencyTests(LiveServerTestCase):
+    def test_benchmark(self):
+        schedule = Schedule.objects.create(name='mimuw', default_permission_level=1,
+                                           owner=User.objects.create(username='test'))
+        out = StringIO()
+        call_command('benchmark_concurrency', 'wsgi=' + self.live_server_url,
+                     '--path', '/api/v1/schedules/%d/events/' % schedule.id,
+                     '--requests', '6', '--concurrency', '2', '--slow-clients', '1', stdout=out)
+        label, rate, p50, p95, longest, errors = out.getvalue().splitlines()[1].split()
+        self.assertEqual((label, errors), ('wsgi', '0'))
+
+
+class BenchmarkSuiteTests(CacheClearingTestCase):
+    def setUp(self):
+        super().setUp()
+        call_command('generate_dataset', '--users', '5', '--schedules', '3', '--permissions', '4', '--events', '40',
+                     '--checks', '10', '--comments', '30', '--replies', '40', '--likes', '50', stdout=StringIO())
+
+    def test_generated_dataset(self):
+        self.assertEqual(User.objects.filter(username__startswith='bench-').count(), 5)
+        self.assertEqual(Event.objects.count(), 40)
+        self.assertEqual(CommentReply.objects.count(), 40)
+        busiest = Schedule.objects.get(name='Schedule 0')
+        self.assertEqual(busiest.default_permission_level, Level.READ_ACCESS)
+        self.assertGreater(Event.objects.filter(schedule=busiest).count(), 40 // 3)
+        for comment in Comment.objects.all():
+            self.assertEqual(comment.likes_count, comment.liked_users.count())
+        with self.assertRaises(CommandError):
+            call_command('generate_dataset', stdout=StringIO())
+
+    def test_query_budgets(self):
+        with tempfile.NamedTemporaryFile('r') as output:
+            call_command('benchmark_endpoints', '--iterations', '2', '--cold', '--output', output.name,
+                         stdout=StringIO())
+            results = json.load(output)['results']
+        self.assertEqual(len(results), 13)
+        for result in results:
+            self.assertLessEqual(result['queries'], result['budget'], result['endpoint'])
+
+        with tempfile.NamedTemporaryFile('w', suffix='.json') as budgets:
+            json.dump({'thread': 1}, budgets)
+            budgets.flush()
+            with self.assertRaisesMessage(CommandError, 'query budget exceeded: thread'):
+                call_command('benchmark_endpoints', '--iterations', '1', '--endpoint', 'thread', '--endpoint', 'event',
+                             '--budgets', budgets.name, stdout=StringIO())
+
+
+class ChangePollTests(APITransactionTestCase):
+    # changes are published on commit
+    def setUp(self):
+        cache.clear()
+        patcher = mock.patch('api.change_stream._broker', InProcessBroker())
+        self.broker = patcher.start()
+        self.addCleanup(patcher.stop)
+        create_test_account(self.client, username='test')
+        login_test_account(self.client, username='test')
+        self.user = User.objects.get(username='test')
+        self.schedule = Schedule.objects.create(name='mimuw', default_permission_level=0, owner=self.user)
+        SchedulePermission.objects.create(user=self.user, schedule=self.schedule, level=Level.MANAGE_ACCESS)
+        self.event_type = EventType.objects.create(name='egzamin')
+        self.url = '/api/v1/schedules/%d/poll/' % self.schedule.id
+
+    def async_poll(self, cursor):
+        token = Token.objects.get(user=self.user).key
+        request = RequestFactory().get(self.url, {'cursor': cursor}, HTTP_AUTHORIZATION='Token ' + token)
+        response = async_to_sync(async_views.schedule_poll)(request, pk=self.schedule.id)
+        return json.loads(response.content)
+
+    def test_poll(self):
+        # a sync worker doesn't wait for changes, the client comes back for them
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual((response.data['changes'], response.data['retry_after']), ([], 5))
+        self.assertEqual(dict(self.broker.subscriptions), {})
+        cursor = response.data['cursor']
+
+        response_data = self.client.post('/api/v1/events/', {
+            'title': 'egzamin', 'desc': '', 'start_date': '2021-03-01T10:00', 'end_date': '2021-03-01T12:00',
+            'type': self.event_type.id, 'schedule': self.schedule.id}, format='json').data
+        event = Event.objects.get(id=response_data['id'])
+        comment = Comment.objects.create(content='comment', author=self.user, event=event)
+        self.client.post('/api/v1/comments/%d/like/' % comment.id)
+        other = Schedule.objects.create(name='other', default_permission_level=0, owner=self.user)
+        Event.objects.create(title='other', start_date='2021-03-01T10:00', end_date='2021-03-01T12:00',
+                             schedule=other, type=self.event_type)
+
+        response = self.client.get(self.url, {'cursor': cursor})
+        self.assertEqual(response.data['changes'], [
+            {'kind': 'event', 'action': 'created', 'id': event.id},
+            {'kind': 'comment', 'action': 'created', 'id': comment.id, 'event': event.id},
+            {'kind': 'comment', 'action': 'liked', 'id': comment.id, 'likes_count': 1},
+        ])
+        self.assertGreater(response.data['cursor'], cursor)
+        self.assertEqual(dict(self.broker.subscriptions), {})
+        self.assertEqual(self.client.get(self.url, {'cursor': 'x'}).status_code, status.HTTP_400_BAD_REQUEST)
+
+        self.client.credentials()
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    @mock.patch('api.async_views.CHANGE_POLL_WAIT', 0.05)
+    def test_replay(self):
+        events = [Event.objects.create(title='egzamin %d' % i, start_date='2021-03-01T10:00',
+                                       end_date='2021-03-01T12:00', schedule=self.schedule, type=self.event_type)
+                  for i in range(2)]
+        cursor = self.broker.history[self.schedule.id][-1][0]
+        self.client.post('/api/v1/events/bulk/', [{'op': 'delete', 'id': event.id} for event in events],
+                         format='json')
+        data = self.async_poll(cursor)
+        self.assertCountEqual(data['changes'], [
+            {'kind': 'event', 'action': 'deleted', 'id': event.id} for event in events])
+        self.assertEqual(data['retry_after'], 0)
+
+        self.assertEqual(self.async_poll(data['cursor'])['changes'], [])
+        self.assertEqual(dict(self.broker.subscriptions), {})
+
+    @mock.patch('api.async_views.CHANGE_POLL_WAIT', 5)
+    def test_poll_waits_for_changes(self):
+        cursor = self.client.get(self.url).data['cursor']
+        message = {'kind': 'schedule', 'action': 'updated', 'id': self.schedule.id}
+        timer = threading.Timer(0.1, self.broker.publish, (self.schedule.id, message))
+        timer.start()
+        self.addCleanup(timer.cancel)
+        data = self.async_poll(cursor)
+        self.assertEqual(data['changes'], [message])
+        self.assertEqual(dict(self.broker.subscriptions), {})
+
+    @mock.patch('api.changes.CHANGES_SETTLE_SECONDS', 0)
+    @mock.patch('api.changes.CHANGE_STREAM_POLL_INTERVAL', 0.05)
+    def test_change_log_broker(self):
+        # another broker stands in for another process, it only shares the log
+        broker = ChangeLogBroker()
+        subscription = broker.subscribe([self.schedule.id])
+        last_event_id = subscription.cursor
+        event = Event.objects.create(title='egzamin', start_date='2021-03-01T10:00', end_date='2021-03-01T12:00',
+                                     schedule=self.schedule, type=self.event_type)
+        Event.objects.create(title='other', start_date='2021-03-01T10:00', end_date='2021-03-01T12:00',
+                             schedule=Schedule.objects.create(name='other', default_permission_level=0, owner=self.user),
+                             type=self.event_type)
+        message = {'kind': 'event', 'action': 'created', 'id': event.id}
+        self.assertEqual([m for _, m in subscription.get(5)], [message])
+        thread = broker.thread
+        subscription.close()
+        thread.join(5)
+        self.assertIsNone(broker.thread)
+
+        subscription = ChangeLogBroker().subscribe([self.schedule.id], last_event_id)
+        self.assertEqual([m for _, m in subscription.drain()], [message])
+        self.assertGreater(subscription.cursor, last_event_id)
+        subscription.close()
+
+
+@mock.patch('api.changes.CHANGES_SETTLE_SECONDS', 0)
+class ChangeSyncTests(CacheClearingTestCase):
+    def setUp(self):
+        super().setUp()
+        create_test_account(self.client, username='test')
+        create_test_account(self.client, username='test2')
+        login_test_account(self.client, username='test')
+        self.user = User.objects.get(username='test')
+        self.schedule = Schedule.objects.create(name='mimuw', default_permission_level=0, owner=self.user)
+        SchedulePermission.objects.create(user=self.user, schedule=self.schedule, level=Level.MANAGE_ACCESS)
+        self.event_type = EventType.objects.create(name='egzamin')
+        self.url = '/api/v1/schedules/%d/changes/' % self.schedule.id
+
+    def create_event(self, title):
+        return self.client.post('/api/v1/events/', {
+            'title': title, 'desc': '', 'start_date': '2021-03-01T10:00', 'end_date': '2021-03-01T12:00',
+            'type': self.event_type.id, 'schedule': self.schedule.id}, format='json').data
+
+    def test_changes(self):
+        token = self.client.get(self.url).data['token']
+        first, second = self.create_event('first'), self.create_event('second')
+        self.client.patch('/api/v1/events/%d/' % first['id'], {'title': 'renamed', 'schedule': self.schedule.id},
+                          format='json')
+        self.client.delete('/api/v1/events/%d/' % second['id'])
+        comment = Comment.objects.create(content='comment', author=self.user, event_id=first['id'])
+        self.client.post('/api/v1/comments/%d/like/' % comment.id)
+        self.client.post('/api/v1/schedules/%d/change_user_permission/?username=test2&level=1' % self.schedule.id)
+
+        response = self.client.get(self.url, {'since': token})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([e['title'] for e in response.data['events']], ['renamed'])
+        self.assertGreater(response.data['events'][0]['updated_at'], first['updated_at'])
+        self.assertEqual([(c['id'], c['likes_count'], c['is_liked_by_me']) for c in response.data['comments']],
+                         [(comment.id, 1, True)])
+        self.assertEqual([p['user'] for p in response.data['permissions']], ['test2'])
+        self.assertEqual(response.data['deleted'], {'events': [second['id']], 'comments': [], 'replies': [],
+                                                    'permissions': []})
+        self.assertFalse(response.data['more'])
+        self.assertGreater(response.data['token'], token)
+
+        response = self.client.get(self.url, {'since': response.data['token']})
+        self.assertEqual((response.data['events'], response.data['deleted']['events']), ([], []))
+
+    def test_paging_and_expiry(self):
+        token = self.client.get(self.url).data['token']
+        events = [self.create_event('event %d' % i) for i in range(3)]
+        with mock.patch('api.changes.CHANGES_PAGE_SIZE', 2):
+            response = self.client.get(self.url, {'since': token})
+            self.assertEqual([e['id'] for e in response.data['events']], [e['id'] for e in events[:2]])
+            self.assertTrue(response.data['more'])
+            response = self.client.get(self.url, {'since': response.data['token']})
+            self.assertEqual([e['id'] for e in response.data['events']], [events[2]['id']])
+            self.assertFalse(response.data['more'])
+
+        # recent changes are sent again until they settle
+        with mock.patch('api.changes.CHANGES_SETTLE_SECONDS', 60):
+            self.create_event('unsettled')
+            response = self.client.get(self.url, {'since': response.data['token']})
+            self.assertEqual([e['title'] for e in response.data['events']], ['unsettled'])
+            self.assertEqual(self.client.get(self.url, {'since': response.data['token']}).data['events'],
+                             response.data['events'])
+
+        ScheduleChange.objects.update(created_at='2020-01-01T00:00')
+        call_command('prune_schedule_changes', stdout=StringIO())
+        self.assertEqual(self.client.get(self.url, {'since': token}).status_code, status.HTTP_410_GONE)
+        self.assertEqual(self.client.get(self.url, {'since': 'x'}).status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class SparseFieldsTests(CacheClearingTestCase):
+    def setUp(self):
+        super().setUp()
+        create_test_account(self.client, username='test')
+        login_test_account(self.client, username='test')
+        self.schedule = Schedule.objects.create(name='mimuw', default_permission_level=1,
+                                                owner=User.objects.get(username='test'))
+        event_type = EventType.objects.create(name='egzamin')
+        for day in range(1, 6):
+            Event.objects.create(title='event %d' % day, desc='x' * 4096, start_date='2021-03-%02dT10:00' % day,
+                                 end_date='2021-03-%02dT12:00' % day, schedule=self.schedule, type=event_type)
+        self.url = '/api/v1/schedules/%d/' % self.schedule.id
+
+    def selected_columns(self, url, params):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url, params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response, ' '.join(query['sql'] for query in context.captured_queries)
+
+    def test_fields(self):
+        response, sql = self.selected_columns(self.url + 'events/', {'fields': 'id,title,start_date,end_date'})
+        self.assertEqual(set(response.data[0]), {'id', 'title', 'start_date', 'end_date'})
+        self.assertNotIn('"main_event"."desc"', sql)
+
+        response, sql = self.selected_columns(self.url + 'events/', {'fields': 'id,title', 'from': '2021-03-03',
+                                                                     'limit': 2})
+        self.assertEqual([e['title'] for e in response.data['results']], ['event 3', 'event 4'])
+        self.assertEqual(set(response.data['results'][0]), {'id', 'title'})
+
+        event_id = self.schedule.event_set.first().id
+        response, sql = self.selected_columns('/api/v1/events/%d/' % event_id, {'fields': 'id,title'})
+        self.assertEqual(response.data, {'id': event_id, 'title': 'event 1'})
+        self.assertNotIn('"main_event"."desc"', sql)
+
+        response, sql = self.selected_columns('/api/v1/schedules/', {'fields': 'id,name'})
+        self.assertEqual(response.data, [{'id': self.schedule.id, 'name': 'mimuw'}])
+
+    def test_expand_events(self):
+        response = self.client.get(self.url)
+        self.assertNotIn('events', response.data)
+        self.assertEqual(response.data['name'], 'mimuw')
+
+        with mock.patch('api.serializers.EMBEDDED_EVENTS_LIMIT', 3):
+            response, sql = self.selected_columns(self.url, {'fields': 'id,name', 'expand': 'events',
+                                                             'fields[events]': 'id,title'})
+        self.assertEqual(set(response.data), {'id', 'name', 'events', 'events_truncated'})
+        self.assertEqual(response.data['events'], [{'id': e.id, 'title': e.title}
+                                                   for e in self.schedule.event_set.all()[:3]])
+        self.assertTrue(response.data['events_truncated'])
+        self.assertNotIn('"main_event"."desc"', sql)
+
+        response = self.client.get(self.url, {'expand': 'events'})
+        self.assertEqual(len(response.data['events']), 5)
+        self.assertFalse(response.data['events_truncated'])
+        self.assertEqual(len(response.data['events'][0]['desc']), 4096)
+
+
+class AnonymousResponseCacheTests(CacheClearingTestCase):
+    def setUp(self):
+        super().setUp()
+        create_test_account(self.client, username='test')
+        self.user = User.objects.get(username='test')
+        self.schedule = Schedule.objects.create(name='mimuw', default_permission_level=1, owner=self.user)
+        self.event_type = EventType.objects.create(name='egzamin')
+        self.event = Event.objects.create(title='egzamin', start_date='2021-03-01T10:00',
+                                          end_date='2021-03-01T12:00', schedule=self.schedule, type=self.event_type)
+        self.url = '/api/v1/schedules/%d/' % self.schedule.id
+
+    def assertCached(self, url, params=None):
+        response = self.client.get(url, params)
+        with self.assertNumQueries(0):
+            cached = self.client.get(url, params)
+        self.assertEqual((cached.status_code, cached.content), (response.status_code, response.content))
+        return response
+
+    def test_anonymous_reads(self):
+        self.assertCached(self.url, {'expand': 'events'})
+        response = self.assertCached(self.url + 'events/')
+        self.assertEqual([e['title'] for e in response.json()], ['egzamin'])
+
+        self.event.title = 'zmieniony'
+        self.event.save()
+        self.assertEqual([e['title'] for e in self.client.get(self.url + 'events/').json()], ['zmieniony'])
+        self.assertEqual(self.client.get(self.url + 'events/', {'fields': 'id'}).json(), [{'id': self.event.id}])
+
+        # a private schedule is never served from the cache
+        self.schedule.default_permission_level = 0
+        self.schedule.save()
+        self.assertEqual(self.client.get(self.url + 'events/').status_code, status.HTTP_404_NOT_FOUND)
+
+        SchedulePermission.objects.create(user=self.user, schedule=self.schedule, level=Level.READ_ACCESS)
+        login_test_account(self.client, username='test')
+        self.client.get(self.url)
+        self.assertGreater(count_queries(lambda: self.client.get(self.url)), 0)
+
+    def test_file_backend(self):
+        with tempfile.TemporaryDirectory() as location, self.settings(CACHES={'default': {
+                'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': location}}):
+            self.assertCached(self.url + 'events/')
+            Event.objects.create(title='nowy', start_date='2021-03-02T10:00', end_date='2021-03-02T12:00',
+                                 schedule=self.schedule, type=self.event_type)
+            self.assertEqual(len(self.assertCached(self.url + 'events/').json()), 2)
+
+
+class CachedTokenAuthenticationTests(CacheClearingTestCase):
+    def setUp(self):
+        super().setUp()
+        create_test_account(self.client, username='test')
+        login_test_account(self.client, username='test')
+        self.user = User.objects.get(username='test')
+        self.url = '/api/v1/schedules/'
+
+    def token_queries(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(self.url)
+        return response.status_code, len([q for q in context.captured_queries if 'authtoken_token' in q['sql']])
+
+    def test_cached_tokens(self):
+        self.assertEqual(self.token_queries(), (status.HTTP_200_OK, 1))
+        self.assertEqual(self.token_queries(), (status.HTTP_200_OK, 0))
+
+        self.user.set_password('456')
+        self.user.save()
+        self.assertEqual(self.token_queries(), (status.HTTP_200_OK, 1))
+
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.client.get(self.url).status_code, status.HTTP_401_UNAUTHORIZED)
+        self.user.is_active = True
+        self.user.save()
+        self.assertEqual(self.token_queries(), (status.HTTP_200_OK, 1))
+
+        self.client.post('/api/v1/auth/logout/', {'revoke_token': True}, format='json')
+        self.assertEqual(self.client.get(self.url).status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_cache_must_be_shared(self):
+        with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}):
+            self.assertEqual([error.id for error in check_shared_cache(None)], ['api.E001'])
+            # a single development process is fine, deployments are checked
+            call_command('check', '--tag', 'caches', stdout=StringIO())
+            with self.assertRaises(SystemCheckError):
+                call_command('check', '--deploy', '--tag', 'caches', stdout=StringIO(), stderr=StringIO())
+        for backend in ('django.core.cache.backends.db.DatabaseCache', 'django.core.cache.backends.dummy.DummyCache'):
+            with override_settings(CACHES={'default': {'BACKEND': backend, 'LOCATION': 'mimcal_cache'}}):
+                self.assertEqual(check_shared_cache(None), [])
+
+
+class SearchTests(CacheClearingTestCase):
+    def setUp(self):
+        super().setUp()
+        create_test_account(self.client, username='test')
+        create_test_account(self.client, username='test2')
+        self.user, self.owner = User.objects.get(username='test'), User.objects.get(username='test2')
+        event_type = EventType.objects.create(name='egzamin')
+        self.public = Schedule.objects.create(name='public', default_permission_level=Level.READ_ACCESS,
+                                              owner=self.owner)
+        self.private = Schedule.objects.create(name='private', default_permission_level=Level.RESTRICTED_ACCESS,
+                                               owner=self.owner)
+        SchedulePermission.objects.create(schedule=self.private, user=self.owner, level=Level.MANAGE_ACCESS)
+        self.exam = Event.objects.create(title='Egzamin z analizy', desc='sala 4420', schedule=self.public,
+                                         type=event_type, start_date='2021-02-02T10:00', end_date='2021-02-02T12:00')
+        self.test = Event.objects.create(title='Kolokwium', desc='analiza matematyczna', schedule=self.private,
+                                         type=event_type, start_date='2021-02-03T10:00', end_date='2021-02-03T12:00')
+        self.comment = Comment.objects.create(content='Czy będzie całka?', event=self.exam, author=self.user)
+        CommentReply.objects.create(content='Będą całki', event=self.exam, reply_to=self.comment,
+                                    author=self.owner, likes_count=0)
+        Comment.objects.create(content='całka oznaczona', event=self.test, author=self.owner)
+        self.url = '/api/v1/search/'
+
+    def search(self, q, **params):
+        response = self.client.get(self.url, dict(params, q=q))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return {kind: [obj.get('title', obj.get('content')) for obj in objects]
+                for kind, objects in response.data.items()}
+
+    def test_search_is_permission_filtered(self):
+        self.assertEqual(self.search('analiz'), {'events': ['Egzamin z analizy'], 'comments': [], 'replies': []})
+        # diacritics are ignored, every term has to match
+        self.assertEqual(self.search('CAŁK', type='comments,replies'),
+                         {'comments': ['Czy będzie całka?'], 'replies': ['Będą całki']})
+        self.assertEqual(self.search('egzamin kolokwium')['events'], [])
+        self.assertEqual(self.search('"analiz* (')['events'], ['Egzamin z analizy'])
+        self.assertEqual(self.search(''), {'events': [], 'comments': [], 'replies': []})
+
+        login_test_account(self.client, username='test2')
+        results = self.search('analiz')
+        self.assertCountEqual(results['events'], ['Egzamin z analizy', 'Kolokwium'])
+        self.assertEqual(len(self.search('całka')['comments']), 2)
+        self.assertEqual(self.search('analiz', limit=1)['events'], ['Egzamin z analizy'])
+
+        # a restricting permission doesn't hide a public schedule
+        login_test_account(self.client, username='test')
+        SchedulePermission.objects.create(schedule=self.public, user=self.user, level=Level.RESTRICTED_ACCESS)
+        SchedulePermission.objects.create(schedule=self.private, user=self.user, level=Level.READ_ACCESS)
+        cache.clear()
+        self.assertCountEqual(self.search('analiz')['events'], ['Egzamin z analizy', 'Kolokwium'])
+
+    def test_index_follows_writes(self):
+        self.exam.title = 'Egzamin z algebry'
+        self.exam.save()
+        self.assertEqual(self.search('analizy')['events'], [])
+        self.assertEqual(self.search('algebr')['events'], ['Egzamin z algebry'])
+        Event.objects.filter(id=self.exam.id).update(desc='sala 3180')
+        self.assertEqual(self.search('3180')['events'], ['Egzamin z algebry'])
+        Event.objects.bulk_create([Event(title='Algebra %d' % i, schedule=self.public, type=self.exam.type,
+                                         start_date='2021-02-04T10:00', end_date='2021-02-04T12:00')
+                                   for i in range(2)])
+        self.assertEqual(len(self.search('algebr')['events']), 3)
+        self.comment.delete()
+        self.assertEqual(self.search('całka'), {'events': [], 'comments': [], 'replies': []})
+
+    def test_invalid_params(self):
+        self.assertEqual(self.client.get(self.url, {'q': 'a', 'type': 'users'}).status_code,
+                         status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.get(self.url, {'q': 'a', 'limit': '0'}).status_code,
+                         status.HTTP_400_BAD_REQUEST)
+        with mock.patch('api.search.SEARCH_SQL', {}):
+            self.assertEqual(self.client.get(self.url, {'q': 'a'}).status_code, status.HTTP_501_NOT_IMPLEMENTED)
+
+
+class FreeBusyTests(CacheClearingTestCase):
+    def setUp(self):
+        super().setUp()
+        create_test_account(self.client, username='test')
+        create_test_account(self.client, username='test2')
+        login_test_account(self.client, username='test')
+        self.user, owner = User.objects.get(username='test'), User.objects.get(username='test2')
+        self.event_type = EventType.objects.create(name='egzamin')
+        public = Schedule.objects.create(name='public', default_permission_level=Level.READ_ACCESS, owner=owner)
+        shared = Schedule.objects.create(name='shared', default_permission_level=Level.RESTRICTED_ACCESS, owner=owner)
+        private = Schedule.objects.create(name='private', default_permission_level=Level.RESTRICTED_ACCESS,
+                                          owner=owner)
+        SchedulePermission.objects.create(schedule=shared, user=self.user, level=Level.READ_ACCESS)
+        self.create(public, '2021-02-28T22:00', '2021-03-01T02:00')
+        self.create(public, '2021-03-01T10:00', '2021-03-01T12:00')
+        self.create(public, '2021-03-01T11:00', '2021-03-01T13:00')
+        self.create(shared, '2021-03-01T13:00', '2021-03-01T14:00')
+        self.checked = self.create(shared, '2021-03-01T16:00', '2021-03-01T17:00')
+        self.create(private, '2021-03-01T08:00', '2021-03-01T09:00')
+        self.create(public, '2021-02-22T18:00', '2021-02-22T19:00', recurrences='RRULE:FREQ=WEEKLY;COUNT=3')
+        self.create(public, '2021-03-02T10:00', '2021-03-02T11:00')
+        self.url = '/api/v1/schedules/freebusy/'
+        self.window = {'from': '2021-03-01', 'to': '2021-03-02'}
+
+    def create(self, schedule, start, end, **kwargs):
+        return Event.objects.create(title='e', schedule=schedule, type=self.event_type, start_date=start,
+                                    end_date=end, **kwargs)
+
+    def busy(self, **params):
+        response = self.client.get(self.url, dict(self.window, **params))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [(interval['start'].strftime('%H:%M'), interval['end'].strftime('%H:%M'))
+                for interval in response.data['busy']]
+
+    def test_merged_busy_intervals(self):
+        with CaptureQueriesContext(connection) as context:
+            busy = self.busy()
+        self.assertEqual(busy, [('00:00', '02:00'), ('10:00', '14:00'), ('16:00', '17:00'), ('18:00', '19:00')])
+        self.assertEqual(len([q for q in context.captured_queries if 'main_event' in q['sql']]), 1)
+
+        self.checked.users_marks.add(self.user)
+        self.assertEqual(self.busy(checked=1), [('16:00', '17:00')])
+
+        self.client.credentials()
+        self.assertEqual(self.busy()[1], ('10:00', '13:00'))
+        self.assertEqual(self.client.get(self.url, dict(self.window, checked=1)).status_code,
+                         status.HTTP_403_FORBIDDEN)
+
+    def test_ended_series_are_skipped(self):
+        self.create(Schedule.objects.get(name='public'), '2020-01-06T09:00', '2020-01-06T10:00',
+                    recurrences='RRULE:FREQ=WEEKLY;COUNT=3')
+        with mock.patch('api.freebusy.occurrence_starts', wraps=occurrence_starts) as starts:
+            self.busy()
+        self.assertNotIn(datetime(2020, 1, 6, 9, 0), [call.args[0].start_date for call in starts.call_args_list])
+
+    @override_settings(MATERIALIZE_OCCURRENCES=True)
+    def test_materialized_busy_intervals(self):
+        materialize_occurrences(list(Event.objects.all()))
+        with mock.patch('api.freebusy.occurrence_starts') as starts:
+            self.assertEqual(self.busy(), [('00:00', '02:00'), ('10:00', '14:00'), ('16:00', '17:00'),
+                                           ('18:00', '19:00')])
+        starts.assert_not_called()
+
+    def test_vfreebusy(self):
+        response = self.client.get(self.url, dict(self.window, format='ics'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response['Content-Type'].startswith('text/calendar'))
+        calendar = icalendar.Calendar.from_ical(response.content)
+        freebusy = calendar.walk('VFREEBUSY')[0]
+        self.assertEqual(freebusy.decoded('dtstart'), datetime(2021, 3, 1, tzinfo=dt_timezone.utc))
+        self.assertIn(b'FREEBUSY:20210301T100000Z/20210301T140000Z', response.content)
+        self.assertEqual(len(freebusy['freebusy']), 4)
+
+    def test_invalid_window(self):
+        for params in ({'from': '2021-03-01'}, {'from': '2021-03-02', 'to': '2021-03-01'},
+                       {'from': '2021-01-01', 'to': '2021-06-01'}):
+            response = self.client.get(self.url, dict(params, format='ics'))
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class AgendaTests(CacheClearingTestCase):
+    def setUp(self):
+        super().setUp()
+        create_test_account(self.client, username='test')
+        create_test_account(self.client, username='test2')
+        login_test_account(self.client, username='test')
+        self.user, self.owner = User.objects.get(username='test'), User.objects.get(username='test2')
+        self.event_type = EventType.objects.create(name='egzamin')
+        public = Schedule.objects.create(name='public', default_permission_level=Level.READ_ACCESS, owner=self.owner)
+        shared = Schedule.objects.create(name='shared', default_permission_level=Level.RESTRICTED_ACCESS,
+                                         owner=self.owner)
+        private = Schedule.objects.create(name='private', default_permission_level=Level.RESTRICTED_ACCESS,
+                                          owner=self.owner)
+        SchedulePermission.objects.create(schedule=shared, user=self.user, level=Level.READ_ACCESS)
+        self.create(public, 'past', '2021-02-01T10:00')
+        self.create(public, 'a', '2021-03-01T10:00')
+        self.create(shared, 'c', '2021-03-01T10:00')
+        self.create(public, 'r', '2021-03-02T09:00', recurrences='RRULE:FREQ=WEEKLY;COUNT=3')
+        self.create(private, 'p', '2021-03-02T10:00')
+        self.create(public, 'b', '2021-03-03T10:00')
+        self.create(shared, 'd', '2021-03-05T10:00')
+        self.url = '/api/v1/events/agenda/'
+
+    def create(self, schedule, title, start, **kwargs):
+        return Event.objects.create(title=title, schedule=schedule, type=self.event_type, start_date=start,
+                                    end_date=start[:-5] + '23:00', **kwargs)
+
+    def agenda(self, **params):
+        titles = []
+        params = dict({'from': '2021-03-01'}, **params)
+        while True:
+            response = self.client.get(self.url, params)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            titles += [event['title'] for event in response.data['results']]
+            if response.data['cursor'] is None:
+                return titles
+            params['cursor'] = response.data['cursor']
+
+    def test_merged_agenda(self):
+        self.assertEqual(self.agenda(limit=2), ['a', 'c', 'r', 'b', 'd', 'r', 'r'])
+        self.assertEqual(self.agenda(limit=100, to='2021-03-09'), ['a', 'c', 'r', 'b', 'd'])
+        response = self.client.get(self.url, {'from': '2021-03-08', 'limit': 1, 'fields': 'id,start_date'})
+        self.assertEqual(response.data['results'][0]['start_date'], '2021-03-09T09:00:00')
+        self.assertEqual(set(response.data['results'][0]), {'id', 'start_date'})
+
+        self.client.credentials()
+        self.assertEqual(self.agenda(limit=3), ['a', 'r', 'b', 'r', 'r'])
+
+    def test_ended_series_are_skipped(self):
+        old = self.create(Schedule.objects.get(name='public'), 'old', '2020-01-06T09:00',
+                          recurrences='RRULE:FREQ=WEEKLY;COUNT=3')
+        self.assertEqual(old.recurrence_end, datetime(2020, 1, 20, 23, 0))
+        with mock.patch('api.agenda.occurrence_stream', wraps=occurrence_stream) as stream:
+            self.assertEqual(self.agenda(limit=100), ['a', 'c', 'r', 'b', 'd', 'r', 'r'])
+        self.assertEqual({call.args[0].title for call in stream.call_args_list}, {'r'})
+
+    @override_settings(MATERIALIZE_OCCURRENCES=True)
+    def test_materialized_agenda(self):
+        materialize_occurrences(list(Event.objects.all()))
+        with mock.patch('api.agenda.occurrence_stream') as stream:
+            self.assertEqual(self.agenda(limit=2), ['a', 'c', 'r', 'b', 'd', 'r', 'r'])
+            self.assertEqual(self.agenda(limit=100, to='2021-03-09'), ['a', 'c', 'r', 'b', 'd'])
+        stream.assert_not_called()
+
+    def test_cost_is_independent_of_schedules(self):
+        self.client.get(self.url)
+        queries = count_queries(lambda: self.client.get(self.url, {'from': '2021-03-01', 'limit': 3}))
+        for i in range(30):
+            schedule = Schedule.objects.create(name='s%d' % i, default_permission_level=Level.READ_ACCESS,
+                                               owner=self.owner)
+            self.create(schedule, 's%d' % i, '2021-04-%02dT10:00' % (i + 1))
+        self.assertEqual(count_queries(lambda: self.client.get(self.url, {'from': '2021-03-01', 'limit': 3})),
+                         queries)
+        self.assertEqual(self.agenda(limit=10)[-3:], ['s27', 's28', 's29'])
+
+
+class UserFeedTests(CacheClearingTestCase):
+    def setUp(self):
+        super().setUp()
+        create_test_account(self.client, username='test')
+        create_test_account(self.client, username='test2')
+        login_test_account(self.client, username='test')
+        self.user, self.owner = User.objects.get(username='test'), User.objects.get(username='test2')
+        self.event_type = EventType.objects.create(name='wykład')
+        own = Schedule.objects.create(name='own', default_permission_level=Level.RESTRICTED_ACCESS, owner=self.user)
+        self.shared = Schedule.objects.create(name='shared', default_permission_level=Level.RESTRICTED_ACCESS,
+                                              owner=self.owner)
+        subscribed = Schedule.objects.create(name='subscribed', default_permission_level=Level.READ_ACCESS,
+                                             owner=self.owner)
+        public = Schedule.objects.create(name='public', default_permission_level=Level.READ_ACCESS, owner=self.owner)
+        private = Schedule.objects.create(name='private', default_permission_level=Level.RESTRICTED_ACCESS,
+                                          owner=self.owner)
+        # owners get MANAGE_ACCESS when they create a schedule through the API
+        SchedulePermission.objects.create(schedule=own, user=self.user, level=Level.MANAGE_ACCESS)
+        self.permission = SchedulePermission.objects.create(schedule=self.shared, user=self.user,
+                                                            level=Level.READ_ACCESS)
+        SchedulePermission.objects.create(schedule=subscribed, user=self.user, level=Level.RESTRICTED_ACCESS)
+        SchedulePermission.objects.create(schedule=private, user=self.user, level=Level.RESTRICTED_ACCESS)
+        self.event = self.create(own, 'own event')
+        self.create(self.shared, 'shared event')
+        self.create(subscribed, 'subscribed event')
+        self.create(public, 'public event')
+        self.create(private, 'private event')
+        response = self.client.post('/api/v1/feed_token/')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.url = response.data['url']
+        self.assertTrue(self.url.endswith('/api/v1/feeds/%s/' % response.data['token']))
+        # calendar apps poll the URL without credentials
+        self.client.credentials()
+
+    def create(self, schedule, title):
+        return Event.objects.create(title=title, schedule=schedule, type=self.event_type,
+                                    start_date='2021-03-01T10:00', end_date='2021-03-01T12:00')
+
+    def get_feed(self, url=None, **extra):
+        response = self.client.get(url or self.url, **extra)
+        response.text = response.content.decode().replace('\r\n ', '')
+        return response
+
+    def test_feed_combines_readable_schedules(self):
+        response = self.get_feed()
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        summaries = {line[len('SUMMARY:'):] for line in response.text.split('\r\n') if line.startswith('SUMMARY:')}
+        self.assertEqual(summaries, {'own event', 'shared event', 'subscribed event'})
+
+        self.permission.delete()
+        self.assertNotIn('shared event', self.get_feed().text)
+
+    def test_token(self):
+        self.assertEqual(self.client.get('/api/v1/feed_token/').status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertEqual(self.client.get('/api/v1/feeds/nope/').status_code, status.HTTP_404_NOT_FOUND)
+
+        login_test_account(self.client, username='test')
+        self.assertEqual(self.client.get('/api/v1/feed_token/').status_code, status.HTTP_200_OK)
+        # only a hash of the key is stored
+        key = self.url.rstrip('/').rsplit('/', 1)[1]
+        self.assertEqual(FeedToken.objects.get(user=self.user).key_hash, FeedToken.hash_key(key))
+        self.assertFalse(FeedToken.objects.filter(key_hash=key).exists())
+
+        response = self.client.post('/api/v1/feed_token/')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertNotEqual(response.data['url'], self.url)
+        self.client.credentials()
+        self.assertEqual(self.client.get(self.url).status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.client.get(response.data['url']).status_code, status.HTTP_200_OK)
+
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.client.get(response.data['url']).status_code, status.HTTP_404_NOT_FOUND)
+
+        # reading doesn't issue a token
+        login_test_account(self.client, username='test2')
+        self.assertEqual(self.client.get('/api/v1/feed_token/').status_code, status.HTTP_404_NOT_FOUND)
+        self.assertFalse(FeedToken.objects.filter(user=self.owner).exists())
+
+    def test_cached_per_user_until_a_schedule_changes(self):
+        etag = self.client.get(self.url)['ETag']
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code,
+                         status.HTTP_304_NOT_MODIFIED)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get(self.url).status_code, status.HTTP_200_OK)
+        self.assertFalse(any('main_event' in q['sql'] for q in queries.captured_queries))
+
+        self.event.title = 'renamed'
+        self.event.save()
+        response = self.get_feed(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn('SUMMARY:renamed', response.text)
+
+        # the owner's feed of the same schedules is cached separately
+        key = FeedToken.generate_key()
+        FeedToken.objects.create(user=self.owner, key_hash=FeedToken.hash_key(key))
+        self.assertNotIn('own event', self.get_feed('/api/v1/feeds/%s/' % key).text)
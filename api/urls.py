@@ -1,19 +1,44 @@
+from django.conf import settings
 from django.urls import path, include
+from django.urls.resolvers import URLPattern
 from rest_framework.routers import DefaultRouter
 
 # Create a router and register our viewsets with it.
 import api.views as views
-from api.ical_views import EventFeed
+from api.ical_views import EventFeed, UserFeed
+import api.async_views as async_views
 
 router = DefaultRouter()
 router.register('schedules', views.ScheduleViewSet)
 router.register('events', views.EventViewSet)
 router.register('comments', views.CommentViewSet)
 router.register('commentReplies', views.CommentReplyViewSet)
+router.register('search', views.SearchViewSet, basename='search')
+router.register('feed_token', views.FeedTokenViewSet, basename='feed_token')
+
+# Under ASGI the heaviest read endpoints are served by async views, at the
+# routes of the views they replace
+async_read_views = {
+    'schedule-events': async_views.schedule_events,
+    'event-thread': async_views.event_thread,
+    'schedule-poll': async_views.schedule_poll,
+}
+
+
+def read_view(view, async_view):
+    return async_view if settings.ASYNC_READ_VIEWS else view
+
+
+def router_urls():
+    return [URLPattern(url.pattern, read_view(url.callback, async_read_views[url.name]), url.default_args, url.name)
+            if url.name in async_read_views else url
+            for url in router.urls]
+
 
 # The API URLs are now determined automatically by the router.
 urlpatterns = [
-    path('schedules/<int:schedule_id>/to_webcal/', EventFeed()),
-    path('', include(router.urls)),
+    path('schedules/<int:schedule_id>/to_webcal/', read_view(EventFeed(), async_views.event_feed)),
+    path('feeds/<str:key>/', read_view(UserFeed(), async_views.user_feed), name='user-feed'),
+    path('', include(router_urls())),
     path('auth/', include('rest_registration.api.urls')),
 ]
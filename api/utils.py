@@ -1,21 +1,161 @@
-from django.core.exceptions import ObjectDoesNotExist
-from rest_framework.exceptions import PermissionDenied
+from datetime import datetime, time
 
-from main.models import SchedulePermission
+from django.core.exceptions import FieldDoesNotExist
+from django.db import transaction
+from django.db.models import BooleanField, Count, Exists, F, OuterRef, Prefetch, Q, Subquery, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from rest_framework.exceptions import PermissionDenied, ValidationError
+
+from api.changes import record_change
+from api.occurrences import events_in_window
+from api.permission_cache import get_user_permission_level
+from main.models import Comment, CommentReply, Event, SchedulePermission
 
 
 def has_permission_to_schedule(user, level, schedule):
     if schedule.default_permission_level >= level:
         return True
-    if user.is_anonymous:
-        return False
-    try:
-        return SchedulePermission.objects.get(user=user, schedule=schedule).level >= level
-    except ObjectDoesNotExist:
-        return False
+    user_level = get_user_permission_level(user, schedule)
+    return user_level is not None and user_level >= level
 
 
 def check_permission_to_schedule(user, level, schedule):
     if not has_permission_to_schedule(user, level, schedule):
         raise PermissionDenied({"message": "You don't have permission to access",
                                 "object_id": schedule.id})
+
+
+def parse_datetime_param(query_params, name):
+    value = query_params.get(name, None)
+    if not value:
+        return None
+    try:
+        parsed = parse_datetime(value)
+        if parsed is None:
+            day = parse_date(value)
+            parsed = datetime.combine(day, time.min) if day else None
+    except ValueError:
+        parsed = None
+    if parsed is None:
+        raise ValidationError(detail='invalid %s' % name)
+    if timezone.is_aware(parsed):
+        parsed = timezone.make_naive(parsed)
+    return parsed
+
+
+# Events starting in [from, to), served by the (schedule, start_date) index.
+# With a window, recurring events are expanded into their occurrences and a
+# sorted list is returned instead of a queryset.
+def filter_events(events, query_params):
+    types = query_params.get('type', None)
+    if types:
+        try:
+            events = events.filter(type__in=[int(t) for t in types.split(',')])
+        except ValueError:
+            raise ValidationError(detail='invalid type')
+    start = parse_datetime_param(query_params, 'from')
+    end = parse_datetime_param(query_params, 'to')
+    if start or end:
+        return events_in_window(events, start, end)
+    return events
+
+
+# Resolves EventSerializer.is_checked for a whole queryset in the same query
+# Defers every column the serializer (e.g. one with sparse fields) doesn't
+# read, except for `extra` ones the caller needs itself
+def only_serialized(queryset, serializer, extra=()):
+    model = queryset.model
+    columns = {model._meta.pk.name, *extra}
+    for field in serializer.fields.values():
+        try:
+            model_field = model._meta.get_field(field.source.split('.')[0])
+        except FieldDoesNotExist:
+            continue
+        if model_field.concrete and not model_field.many_to_many:
+            columns.add(model_field.name)
+    return queryset.only(*columns)
+
+
+def annotate_is_checked(events, user):
+    if not user or user.is_anonymous:
+        return events.annotate(is_checked=Value(False, output_field=BooleanField()))
+    return events.annotate(is_checked=Exists(Event.users_marks.through.objects
+                                             .filter(event=OuterRef('pk'), user=user)))
+
+
+# user_permission_level is the user's explicit level (or None),
+# my_permission_level is the level ScheduleSerializer reports
+def annotate_permission_level(schedules, user):
+    if not user or user.is_anonymous:
+        return schedules.annotate(my_permission_level=F('default_permission_level'))
+    user_level = SchedulePermission.objects.filter(schedule=OuterRef('pk'), user=user).values('level')[:1]
+    return schedules.annotate(user_permission_level=Subquery(user_level),
+                              my_permission_level=Coalesce('user_permission_level', 'default_permission_level'))
+
+
+# Schedules the user has at least needed_level on. RESTRICTED_ACCESS is below
+# every needed level, so a restricting permission only ever grants what the
+# default level grants.
+def filter_permitted_schedules(schedules, user, needed_level):
+    schedules = annotate_permission_level(schedules, user)
+    if not user or user.is_anonymous:
+        return schedules.filter(default_permission_level__gte=needed_level)
+    return schedules.filter(Q(default_permission_level__gte=needed_level) |
+                            Q(user_permission_level__gte=needed_level))
+
+
+# Resolves BaseCommentSerializer.is_liked_by_me for Comment and CommentReply querysets
+def annotate_is_liked(comments, user):
+    if not user or user.is_anonymous:
+        return comments.annotate(is_liked_by_me=Value(False, output_field=BooleanField()))
+    model = comments.model
+    likes = model.liked_users.through.objects.filter(**{model._meta.model_name: OuterRef('pk'), 'user': user})
+    return comments.annotate(is_liked_by_me=Exists(likes))
+
+
+# Comments of an event with authors, replies and like flags, loaded in two
+# queries. With replies_limit only the first replies of every comment are
+# loaded (into thread_replies), together with replies_count.
+def comment_threads(event, user, replies_limit=None):
+    replies = annotate_is_liked(CommentReply.objects.select_related('author'), user).order_by('id')
+    comments = annotate_is_liked(Comment.objects.filter(event=event).select_related('author'), user)
+    if replies_limit is None:
+        return comments.prefetch_related(Prefetch('commentreply_set', queryset=replies))
+    first_replies = (CommentReply.objects.filter(reply_to=OuterRef('reply_to'))
+                     .order_by('id').values('id')[:replies_limit])
+    replies = replies.filter(id__in=Subquery(first_replies))
+    return (comments.annotate(replies_count=Count('commentreply'))
+            .prefetch_related(Prefetch('commentreply_set', queryset=replies, to_attr='thread_replies')))
+
+
+# Likes are idempotent: likes_count only moves when a liked_users row was
+# actually inserted or deleted, and then with a single UPDATE of that column.
+def add_like(comment, user):
+    model = type(comment)
+    with transaction.atomic():
+        _, created = model.liked_users.through.objects.get_or_create(**{model._meta.model_name: comment,
+                                                                         'user': user})
+        if created:
+            model.objects.filter(pk=comment.pk).update(likes_count=F('likes_count') + 1, updated_at=timezone.now())
+            _publish_likes(comment, 'liked')
+    return created
+
+
+def remove_like(comment, user):
+    model = type(comment)
+    with transaction.atomic():
+        deleted, _ = model.liked_users.through.objects.filter(**{model._meta.model_name: comment,
+                                                                 'user': user}).delete()
+        if deleted:
+            model.objects.filter(pk=comment.pk).update(likes_count=F('likes_count') - 1, updated_at=timezone.now())
+            _publish_likes(comment, 'unliked')
+    return bool(deleted)
+
+
+def _publish_likes(comment, action):
+    model = type(comment)
+    likes_count, schedule_id = (model.objects.filter(pk=comment.pk)
+                                .values_list('likes_count', 'event__schedule_id').get())
+    record_change(schedule_id, model._meta.model_name, action, comment.pk, likes_count=likes_count)
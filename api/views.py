@@ -1,10 +1,17 @@
+from datetime import timedelta
+
+from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist
-from django.db.models import Q, Exists, OuterRef
+from django.http import HttpResponse
+from django.urls import reverse
+from django.utils import timezone
 from rest_framework.decorators import action
-from rest_framework.exceptions import PermissionDenied, ValidationError
+from rest_framework.exceptions import NotFound, PermissionDenied, ValidationError
+from rest_framework.parsers import MultiPartParser
 from rest_framework.permissions import SAFE_METHODS
+from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
-from rest_framework import permissions, mixins
+from rest_framework import permissions, mixins, status
 from rest_framework import viewsets
 from rest_framework.viewsets import GenericViewSet
 
@@ -13,12 +20,114 @@ from api.serializers import ScheduleSerializer, EventSerializer, ScheduleWithEve
 from main.models import Schedule, Event, User, SchedulePermission, SchedulePermissionLevels
 from main.models import SchedulePermissionLevels as Level
 
-from api.serializers import CommentSerializer, CommentReplySerializer
-from main.models import Comment, CommentReply
-from api.utils import check_permission_to_schedule
-
-
-class ScheduleViewSet(viewsets.ModelViewSet):
+from api.serializers import CommentSerializer, CommentReplySerializer, CommentThreadSerializer, \
+    CommentChangeSerializer
+from main.models import Comment, CommentReply, FeedToken
+from api.utils import check_permission_to_schedule, filter_events, annotate_is_checked, \
+    filter_permitted_schedules, annotate_is_liked, comment_threads, add_like, remove_like, only_serialized, \
+    parse_datetime_param
+from api.pagination import EventCursorPagination, KeysetPagination
+from api.bulk import apply_event_operations, BULK_EVENTS_LIMIT
+from api.importers import import_events, EventImportError
+from api.change_stream import CHANGE_POLL_SYNC_RETRY, ChangePollResponse, get_broker, poll_data
+from api.changes import ChangeTokenExpired, changes_since, current_token
+from api.caching import RESPONSE_CACHE_TIMEOUT, response_cache_key
+from api.agenda import agenda_events
+from api.freebusy import FREEBUSY_MAX_DAYS, FreeBusyRenderer, busy_intervals
+from api.search import SEARCH_KINDS, SEARCH_LIMIT, MAX_SEARCH_LIMIT, SearchNotSupported, search
+from mimcal.db_routers import end_request, read_from_primary, route_request
+
+THREAD_REPLIES = 3
+MAX_THREAD_REPLIES = 50
+DEFAULT_IMPORT_TYPE = 'inne'
+EVENT_WINDOW_FIELDS = ('start_date', 'end_date', 'recurrences')
+
+
+def split_param(value):
+    return [name for name in value.split(',') if name] if value else None
+
+
+class SparseFieldsViewMixin:
+    """
+    ?fields=id,title keeps only these fields of the response objects and
+    loads only their columns, ?expand=events includes an expandable field,
+    ?fields[events]=id,title picks the fields of the expanded one.
+    """
+    sparse_actions = ('list', 'retrieve')
+    # columns get_queryset needs whatever fields are asked for
+    sparse_extra_columns = ()
+
+    def get_sparse_fields(self):
+        params = self.request.query_params
+        expand = split_param(params.get('expand', None)) or []
+        return {'fields': split_param(params.get('fields', None)),
+                'expand': {name: split_param(params.get('fields[%s]' % name, None)) for name in expand}}
+
+    def get_serializer(self, *args, **kwargs):
+        if self.request.method in SAFE_METHODS:
+            kwargs.update(self.get_sparse_fields())
+        return super().get_serializer(*args, **kwargs)
+
+    def only_serialized(self, queryset):
+        sparse = self.get_sparse_fields()
+        if self.action not in self.sparse_actions or not sparse['fields']:
+            return queryset
+        return only_serialized(queryset, self.get_serializer_class()(**sparse), extra=self.sparse_extra_columns)
+
+
+class ReplicaRoutingViewMixin:
+    """
+    Serves read-only requests from the replica once DRF has authenticated
+    them, and pins clients that wrote something to the primary.
+    """
+    replica_token = None
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        self.replica_token = route_request(request)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        end_request(request, response, self.replica_token)
+        return super().finalize_response(request, response, *args, **kwargs)
+
+
+class AnonymousResponseCacheMixin:
+    """
+    Rendered responses to anonymous reads of a schedule are cached under its
+    version token, so any change to the schedule or its events replaces them
+    at once. Only readable schedules ever get an entry, a hit runs no query.
+    """
+    response_cache_key = None
+
+    def get_cached_response(self):
+        request = self.request
+        if request.method != 'GET' or not request.user.is_anonymous:
+            return None
+        try:
+            schedule_id = int(self.kwargs['pk'])
+        except ValueError:
+            return None
+        self.response_cache_key = response_cache_key(
+            schedule_id, '%s|%s' % (request.get_full_path(), request.accepted_renderer.format))
+        cached = cache.get(self.response_cache_key)
+        if cached is None:
+            # the response is cached under the current version, which the replica may not have yet
+            read_from_primary()
+            return None
+        content, content_type = cached
+        return HttpResponse(content, content_type=content_type)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        key = self.response_cache_key
+        if key is not None and isinstance(response, Response) and response.status_code == status.HTTP_200_OK:
+            response.add_post_render_callback(
+                lambda rendered: cache.set(key, (rendered.content, rendered['Content-Type']), RESPONSE_CACHE_TIMEOUT))
+        return response
+
+
+class ScheduleViewSet(ReplicaRoutingViewMixin, AnonymousResponseCacheMixin, SparseFieldsViewMixin,
+                      viewsets.ModelViewSet):
     queryset = Schedule.objects.all()
     permission_classes = [permissions.IsAuthenticatedOrReadOnly]
 
@@ -34,24 +143,20 @@ class ScheduleViewSet(viewsets.ModelViewSet):
             needed_level = SchedulePermissionLevels.MANAGE_ACCESS
         else:
             needed_level = SchedulePermissionLevels.READ_WRITE_ACCESS
-        if self.request.user.is_anonymous:
-            return Schedule.objects.filter(default_permission_level__gte=needed_level)
-        return Schedule.objects.filter(
-            Q(default_permission_level__gte=needed_level) |
-            (Q(Exists(SchedulePermission.objects
-                      .filter(schedule=OuterRef('id'),
-                              user=self.request.user,
-                              level__gte=needed_level))) &
-             ~Q(Exists(SchedulePermission.objects
-                       .filter(schedule=OuterRef('id'),
-                               user=self.request.user,
-                               level=Level.RESTRICTED_ACCESS)))))
+        return self.only_serialized(filter_permitted_schedules(Schedule.objects.all(), self.request.user,
+                                                               needed_level))
 
     def get_serializer_class(self):
         if self.action == 'list' or self.action == 'create':
             return ScheduleSerializer
         return ScheduleWithEventsSerializer
 
+    def retrieve(self, request, *args, **kwargs):
+        cached = self.get_cached_response()
+        if cached is not None:
+            return cached
+        return super().retrieve(request, *args, **kwargs)
+
     def perform_create(self, serializer):
         obj = serializer.save(owner=self.request.user)
         perm = SchedulePermission.objects.create(user=self.request.user, level=Level.MANAGE_ACCESS, schedule=obj)
@@ -59,17 +164,130 @@ class ScheduleViewSet(viewsets.ModelViewSet):
 
     @action(detail=True, methods=['GET'])
     def events(self, request, pk=None):
+        cached = self.get_cached_response()
+        if cached is not None:
+            return cached
         schedule = self.get_object()
 
         check_permission_to_schedule(self.request.user, 0, schedule)
-        events = Event.objects.filter(schedule=schedule)
+        fields = self.get_sparse_fields()['fields']
+        events = annotate_is_checked(Event.objects.filter(schedule=schedule), request.user)
+        if fields:
+            # columns for ordering, paging and expanding the window
+            events = only_serialized(events, EventSerializer(fields=fields), extra=EVENT_WINDOW_FIELDS)
+        events = filter_events(events, self.request.query_params)
+
+        paginator = EventCursorPagination()
+        if paginator.is_requested(request):
+            page = paginator.paginate_queryset(events, request, view=self)
+            serializer = EventSerializer(page, many=True, context={'user_id': request.user}, fields=fields)
+            return paginator.get_paginated_response(serializer.data)
+
         n = self.request.query_params.get('n', None)
         if n:
             events = events[:int(n)]
 
-        serializer = EventSerializer(events, many=True, context={'user_id': request.user})
+        serializer = EventSerializer(events, many=True, context={'user_id': request.user}, fields=fields)
         return Response(serializer.data)
 
+    # multipart upload of an .ics or CSV (title,desc,start_date,end_date,type) file
+    @action(detail=True, methods=['POST'], parser_classes=[MultiPartParser])
+    def import_events(self, request, pk=None):
+        schedule = self.get_object()
+        file = request.FILES.get('file', None)
+        if file is None:
+            raise ValidationError(detail='missing file')
+        try:
+            report = import_events(schedule, file, request.data.get('default_type', None) or DEFAULT_IMPORT_TYPE)
+        except EventImportError as e:
+            raise ValidationError(detail=str(e))
+        return Response(report)
+
+    # Delta sync: ?since=<token> returns the events, comments, replies and
+    # permissions created, updated or deleted after the token was issued,
+    # and the token for the next call. Without since only the current token
+    # is returned, to be taken before downloading the whole schedule.
+    @action(detail=True, methods=['GET'])
+    def changes(self, request, pk=None):
+        schedule = self.get_object()
+        since = request.query_params.get('since', None)
+        if since is None:
+            return Response({'token': current_token()})
+        try:
+            since = int(since)
+        except ValueError:
+            raise ValidationError(detail='invalid since')
+        try:
+            token, upserted, deleted, more = changes_since(schedule.id, since)
+        except ChangeTokenExpired:
+            return Response({'detail': 'token expired, download the schedule again'}, status=status.HTTP_410_GONE)
+
+        kinds = (
+            ('event', 'events', EventSerializer,
+             annotate_is_checked(Event.objects.filter(schedule=schedule), request.user)),
+            ('comment', 'comments', CommentChangeSerializer,
+             annotate_is_liked(Comment.objects.filter(event__schedule=schedule).select_related('author'),
+                               request.user)),
+            ('commentreply', 'replies', CommentReplySerializer,
+             annotate_is_liked(CommentReply.objects.filter(event__schedule=schedule).select_related('author'),
+                               request.user)),
+            ('permission', 'permissions', SchedulePermissionSerializer,
+             SchedulePermission.objects.filter(schedule=schedule).select_related('user')),
+        )
+        data = {'token': token, 'more': more, 'deleted': {}}
+        for kind, name, serializer_class, queryset in kinds:
+            ids = upserted.get(kind, [])
+            objects = list(queryset.filter(id__in=ids)) if ids else []
+            # deleted or moved to another schedule later on
+            gone = set(ids).difference(obj.id for obj in objects)
+            data[name] = serializer_class(objects, many=True, context={'user_id': request.user}).data
+            data['deleted'][name] = sorted(deleted.get(kind, []) + list(gone))
+        return Response(data)
+
+    # Long polling of changes to the schedule, its events and comments: the
+    # response lists the changes after ?cursor= (the cursor of the previous
+    # response) and the cursor to poll with next. This is not a push: sync
+    # workers answer at once and ask the client to come back after
+    # retry_after seconds; under ASGI (async_views.schedule_poll) the
+    # response waits up to CHANGE_POLL_WAIT seconds for the next changes.
+    @action(detail=True, methods=['GET'])
+    def poll(self, request, pk=None):
+        schedule = self.get_object()
+        cursor = request.query_params.get('cursor', None)
+        try:
+            cursor = int(cursor) if cursor else None
+        except ValueError:
+            raise ValidationError(detail='invalid cursor')
+        subscription = get_broker().subscribe([schedule.id], cursor)
+        if getattr(request, 'wait_for_changes', False):
+            return ChangePollResponse(subscription)
+        try:
+            messages = subscription.drain()
+        finally:
+            subscription.close()
+        response = Response(poll_data(subscription, messages, CHANGE_POLL_SYNC_RETRY))
+        response['Cache-Control'] = 'no-cache'
+        return response
+
+    # ?from=&to= (at most FREEBUSY_MAX_DAYS apart) returns the merged busy
+    # intervals of all readable schedules, with ?checked=1 only those of the
+    # events the user checked; ?format=ics returns a VFREEBUSY instead
+    @action(detail=False, methods=['GET'], renderer_classes=[JSONRenderer, FreeBusyRenderer])
+    def freebusy(self, request):
+        start = parse_datetime_param(request.query_params, 'from')
+        end = parse_datetime_param(request.query_params, 'to')
+        if start is None or end is None or end <= start:
+            raise ValidationError(detail='from and to are required, from before to')
+        if end - start > timedelta(days=FREEBUSY_MAX_DAYS):
+            raise ValidationError(detail='the window can be at most %d days long' % FREEBUSY_MAX_DAYS)
+        checked = request.query_params.get('checked', '') not in ('', '0', 'false')
+        if checked and request.user.is_anonymous:
+            raise PermissionDenied(detail='You have to be logged in to use checked events')
+        busy = busy_intervals(request.user, start, end, checked)
+        return Response({'from': start, 'to': end,
+                         'busy': [{'start': interval_start, 'end': interval_end}
+                                  for interval_start, interval_end in busy]})
+
     @action(detail=True, methods=['GET'])
     def permitted_users(self, request, pk=None):
         schedule = self.get_object()
@@ -121,7 +339,8 @@ class ScheduleViewSet(viewsets.ModelViewSet):
         return Response({'status': 'changed permission level'})
 
 
-class EventViewSet(mixins.CreateModelMixin,
+class EventViewSet(ReplicaRoutingViewMixin, SparseFieldsViewMixin,
+                   mixins.CreateModelMixin,
                    mixins.UpdateModelMixin,
                    mixins.DestroyModelMixin,
                    mixins.RetrieveModelMixin,
@@ -129,6 +348,10 @@ class EventViewSet(mixins.CreateModelMixin,
     queryset = Event.objects.all()
     serializer_class = EventSerializer
     permission_classes = [permissions.AllowAny]
+    sparse_extra_columns = ('schedule',)
+
+    def get_queryset(self):
+        return self.only_serialized(annotate_is_checked(Event.objects.select_related('schedule'), self.request.user))
 
     def get_serializer_context(self):
         context = super(EventViewSet, self).get_serializer_context()
@@ -149,6 +372,40 @@ class EventViewSet(mixins.CreateModelMixin,
         check_permission_to_schedule(self.request.user, Level.READ_WRITE_ACCESS, instance.schedule)
         instance.delete()
 
+    # Body: [{"op": "create", "data": {...}}, {"op": "update", "id": 1, "data": {...}},
+    #        {"op": "delete", "id": 2}, ...], applied all together or not at all
+    @action(detail=False, methods=['post'])
+    def bulk(self, request):
+        operations = request.data
+        if isinstance(operations, dict):
+            operations = operations.get('operations', None)
+        if not isinstance(operations, list):
+            raise ValidationError(detail='expected a list of operations')
+        if len(operations) > BULK_EVENTS_LIMIT:
+            raise ValidationError(detail='at most %d operations are allowed' % BULK_EVENTS_LIMIT)
+        applied, results = apply_event_operations(operations, request.user)
+        return Response({'results': results},
+                        status=status.HTTP_200_OK if applied else status.HTTP_400_BAD_REQUEST)
+
+    # Upcoming events of every readable schedule ordered by start_date, from
+    # ?from= (now by default) to ?to=, paged with ?cursor= and ?limit=
+    @action(detail=False, methods=['get'])
+    def agenda(self, request):
+        start = parse_datetime_param(request.query_params, 'from') or timezone.now().replace(microsecond=0)
+        end = parse_datetime_param(request.query_params, 'to')
+        fields = self.get_sparse_fields()['fields']
+        events = Event.objects.all()
+        if fields:
+            events = only_serialized(events, EventSerializer(fields=fields), extra=EVENT_WINDOW_FIELDS)
+
+        paginator = EventCursorPagination()
+        cursor = request.query_params.get(paginator.cursor_query_param, None)
+        after = tuple(paginator.decode_cursor(Event, cursor)) if cursor else None
+        events = agenda_events(request.user, start, end, after, paginator.get_page_size(request) + 1, events)
+        page = paginator.paginate_queryset(events, request, view=self)
+        serializer = EventSerializer(page, many=True, context={'user_id': request.user}, fields=fields)
+        return paginator.get_paginated_response(serializer.data)
+
     @action(detail=True, methods=['post'])
     def check(self, request, pk=None):
         event = self.get_object()
@@ -156,7 +413,6 @@ class EventViewSet(mixins.CreateModelMixin,
             raise PermissionDenied(detail='You have to be logged in to check events')
         check_permission_to_schedule(request.user, Level.READ_ACCESS, event.schedule)
         event.users_marks.add(request.user)
-        event.save()
         return Response({'status': 'event checked'})
 
     @action(detail=True, methods=['post'])
@@ -166,69 +422,128 @@ class EventViewSet(mixins.CreateModelMixin,
             raise PermissionDenied(detail='You have to be logged in to uncheck events')
         check_permission_to_schedule(request.user, Level.READ_ACCESS, event.schedule)
         event.users_marks.remove(request.user)
-        event.save()
         return Response({'status': 'event unchecked'})
 
     @action(detail=True, methods=['get'])
     def comments(self, request, pk=None):
         event = self.get_object()
         check_permission_to_schedule(request.user, Level.READ_ACCESS, event.schedule)
-        comments = Comment.objects.filter(event=event)
+        comments = comment_threads(event, request.user)
         serializer = CommentSerializer(comments, many=True, context={'user_id': request.user})
         return Response(serializer.data)
 
+    # Top-level comments are paginated with ?cursor=/&limit=, every comment
+    # embeds at most ?replies= of its first replies
+    @action(detail=True, methods=['get'])
+    def thread(self, request, pk=None):
+        event = self.get_object()
+        check_permission_to_schedule(request.user, Level.READ_ACCESS, event.schedule)
+        try:
+            replies_limit = int(request.query_params.get('replies', THREAD_REPLIES))
+        except ValueError:
+            raise ValidationError(detail='invalid replies')
+        replies_limit = max(0, min(replies_limit, MAX_THREAD_REPLIES))
 
-class CommentViewSet(mixins.CreateModelMixin,
-                     mixins.UpdateModelMixin,
-                     mixins.DestroyModelMixin,
-                     GenericViewSet):
-    queryset = Comment.objects.all()
-    serializer_class = CommentSerializer
-    permission_classes = [permissions.IsAuthenticatedOrReadOnly]
+        paginator = KeysetPagination()
+        page = paginator.paginate_queryset(comment_threads(event, request.user, replies_limit), request, view=self)
+        serializer = CommentThreadSerializer(page, many=True, context={'user_id': request.user})
+        return paginator.get_paginated_response(serializer.data)
 
-    def perform_create(self, serializer):
-        obj = serializer.save(author=self.request.user, likes_count=0)
+
+class LikeMixin:
+    like_name = 'comment'
 
     @action(detail=True, methods=['post'])
     def like(self, request, pk=None):
         comment = self.get_object()
-        comment.liked_users.add(request.user)
-        comment.likes_count += 1
-        comment.save()
-        return Response({'status': 'comment liked'})
+        if request.user.is_anonymous:
+            raise PermissionDenied(detail='You have to be logged in to like comments')
+        add_like(comment, request.user)
+        return Response({'status': '%s liked' % self.like_name})
 
     @action(detail=True, methods=['post'])
     def unlike(self, request, pk=None):
         comment = self.get_object()
-        comment.liked_users.remove(request.user)
-        comment.likes_count -= 1
-        comment.save()
-        return Response({'status': 'comment unliked'})
+        if request.user.is_anonymous:
+            raise PermissionDenied(detail='You have to be logged in to unlike comments')
+        remove_like(comment, request.user)
+        return Response({'status': '%s unliked' % self.like_name})
 
 
-class CommentReplyViewSet(mixins.CreateModelMixin,
+class CommentViewSet(ReplicaRoutingViewMixin, LikeMixin,
+                     mixins.CreateModelMixin,
+                     mixins.UpdateModelMixin,
+                     mixins.DestroyModelMixin,
+                     GenericViewSet):
+    queryset = Comment.objects.all()
+    serializer_class = CommentSerializer
+    permission_classes = [permissions.IsAuthenticatedOrReadOnly]
+    like_name = 'comment'
+
+    def perform_create(self, serializer):
+        obj = serializer.save(author=self.request.user, likes_count=0)
+
+
+class CommentReplyViewSet(ReplicaRoutingViewMixin, LikeMixin,
+                          mixins.CreateModelMixin,
                           mixins.UpdateModelMixin,
                           mixins.DestroyModelMixin,
                           GenericViewSet):
     queryset = CommentReply.objects.all()
     serializer_class = CommentReplySerializer
     permission_classes = [permissions.AllowAny]
+    like_name = 'reply'
 
     def perform_create(self, serializer):
         obj = serializer.save(author=self.request.user, likes_count=0)
 
-    @action(detail=True, methods=['post'])
-    def like(self, request, pk=None):
-        comment = self.get_object()
-        comment.liked_users.add(request.user)
-        comment.likes_count += 1
-        comment.save()
-        return Response({'status': 'reply liked'})
 
-    @action(detail=True, methods=['post'])
-    def unlike(self, request, pk=None):
-        comment = self.get_object()
-        comment.liked_users.remove(request.user)
-        comment.likes_count -= 1
-        comment.save()
-        return Response({'status': 'reply unliked'})
+# ?q=<terms> searches event titles and descriptions, comments and replies of
+# the readable schedules; ?type=events,comments,replies and ?limit=
+# (per type) narrow it down
+class SearchViewSet(ReplicaRoutingViewMixin, viewsets.ViewSet):
+    permission_classes = [permissions.AllowAny]
+
+    def list(self, request):
+        query = request.query_params.get('q', '')
+        kinds = split_param(request.query_params.get('type', None)) or SEARCH_KINDS
+        if not set(kinds).issubset(SEARCH_KINDS):
+            raise ValidationError(detail='invalid type, expected some of %s' % ','.join(SEARCH_KINDS))
+        try:
+            limit = int(request.query_params.get('limit', SEARCH_LIMIT))
+        except ValueError:
+            raise ValidationError(detail='invalid limit')
+        if limit <= 0:
+            raise ValidationError(detail='invalid limit')
+        try:
+            results = search(query, request.user, kinds, min(limit, MAX_SEARCH_LIMIT))
+        except SearchNotSupported:
+            return Response({'detail': 'search is not supported by this database'},
+                            status=status.HTTP_501_NOT_IMPLEMENTED)
+        serializers = {'events': EventSerializer, 'comments': CommentChangeSerializer,
+                       'replies': CommentReplySerializer}
+        return Response({kind: serializers[kind](objects, many=True, context={'user_id': request.user}).data
+                         for kind, objects in results.items()})
+
+
+# GET returns the URL of the user's combined iCal feed, creating it on first
+# use; POST replaces it with a new one, the old URL stops working
+class FeedTokenViewSet(ReplicaRoutingViewMixin, viewsets.ViewSet):
+    permission_classes = [permissions.IsAuthenticated]
+
+    def list(self, request):
+        try:
+            token = FeedToken.objects.get(user=request.user)
+        except ObjectDoesNotExist:
+            raise NotFound
+        # the key is only shown by create
+        return Response({'created': token.created})
+
+    def create(self, request):
+        key = FeedToken.generate_key()
+        FeedToken.objects.update_or_create(user=request.user, defaults={'key_hash': FeedToken.hash_key(key),
+                                                                        'created': timezone.now()})
+        return Response(self.feed_url(request, key), status=status.HTTP_201_CREATED)
+
+    def feed_url(self, request, key):
+        return {'token': key, 'url': request.build_absolute_uri(reverse('user-feed', args=[key]))}
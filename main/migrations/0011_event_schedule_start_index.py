@@ -0,0 +1,17 @@
+# Generated by Django 3.1.14 on 2026-10-17 20:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0010_auto_20210121_0346'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='event',
+            index=models.Index(fields=['schedule', 'start_date'], name='main_event_schedule_start_idx'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 3.1.14 on 2026-10-17 20:26
+
+from django.db import migrations, models
+import django.db.models.deletion
+import recurrence.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0011_event_schedule_start_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='event',
+            name='recurrences',
+            field=recurrence.fields.RecurrenceField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='EventOccurrence',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('start_date', models.DateTimeField()),
+                ('end_date', models.DateTimeField()),
+                ('event', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='occurrences', to='main.event')),
+                ('schedule', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='main.schedule')),
+            ],
+            options={
+                'ordering': ['start_date'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='eventoccurrence',
+            index=models.Index(fields=['schedule', 'start_date'], name='main_occur_schedule_start_idx'),
+        ),
+    ]
@@ -0,0 +1,85 @@
+from django.db import migrations
+
+# Full-text indexes of event titles and descriptions and of comment and reply
+# contents, kept in sync by the database itself so bulk writes are covered:
+# FTS5 tables maintained by triggers on SQLite, generated tsvector columns
+# with GIN indexes on PostgreSQL. Other backends get no index (see api.search).
+#
+# SQLite drops the triggers when Django remakes one of these tables, so a
+# later migration altering main_event, main_comment or main_commentreply
+# must run the SQLite statements for that table again.
+SEARCHED_COLUMNS = {
+    'main_event': ['title', '"desc"'],
+    'main_comment': ['content'],
+    'main_commentreply': ['content'],
+}
+
+
+def sqlite_index(table, columns):
+    new = ', '.join('new.%s' % column for column in columns)
+    old = ', '.join('old.%s' % column for column in columns)
+    return [
+        "CREATE VIRTUAL TABLE {table}_fts USING fts5({columns}, content='{table}', content_rowid='id', "
+        "tokenize='unicode61 remove_diacritics 2')",
+        "CREATE TRIGGER {table}_fts_insert AFTER INSERT ON {table} BEGIN "
+        "INSERT INTO {table}_fts(rowid, {columns}) VALUES (new.id, {new}); END",
+        "CREATE TRIGGER {table}_fts_delete AFTER DELETE ON {table} BEGIN "
+        "INSERT INTO {table}_fts({table}_fts, rowid, {columns}) VALUES ('delete', old.id, {old}); END",
+        "CREATE TRIGGER {table}_fts_update AFTER UPDATE OF {columns} ON {table} BEGIN "
+        "INSERT INTO {table}_fts({table}_fts, rowid, {columns}) VALUES ('delete', old.id, {old}); "
+        "INSERT INTO {table}_fts(rowid, {columns}) VALUES (new.id, {new}); END",
+        "INSERT INTO {table}_fts({table}_fts) VALUES ('rebuild')",
+    ], [
+        'DROP TRIGGER {table}_fts_insert',
+        'DROP TRIGGER {table}_fts_delete',
+        'DROP TRIGGER {table}_fts_update',
+        'DROP TABLE {table}_fts',
+    ], dict(table=table, columns=', '.join(columns), new=new, old=old)
+
+
+def postgresql_index(table, columns):
+    # the first column (e.g. a title) weighs the most in ts_rank
+    document = ' || '.join("setweight(to_tsvector('simple', coalesce(%s, '')), '%s')" % (column, weight)
+                           for column, weight in zip(columns, 'ABCD'))
+    return [
+        "ALTER TABLE {table} ADD COLUMN search_vector tsvector "
+        "GENERATED ALWAYS AS ({document}) STORED",
+        'CREATE INDEX {table}_search_idx ON {table} USING GIN (search_vector)',
+    ], [
+        'ALTER TABLE {table} DROP COLUMN search_vector',
+    ], dict(table=table, document=document)
+
+
+INDEXES = {
+    'sqlite': sqlite_index,
+    'postgresql': postgresql_index,
+}
+
+
+def run(schema_editor, forward):
+    index = INDEXES.get(schema_editor.connection.vendor)
+    if index is None:
+        return
+    for table, columns in SEARCHED_COLUMNS.items():
+        create, drop, names = index(table, columns)
+        for statement in create if forward else drop:
+            schema_editor.execute(statement.format(**names))
+
+
+def create_indexes(apps, schema_editor):
+    run(schema_editor, forward=True)
+
+
+def drop_indexes(apps, schema_editor):
+    run(schema_editor, forward=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0013_change_tracking'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_indexes, reverse_code=drop_indexes),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 3.1.14 on 2026-10-17 21:18
+
+from django.db import migrations, models
+import django.utils.timezone
+import main.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0015_feed_token'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='schedule',
+            name='version_modified',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='schedule',
+            name='version_token',
+            field=models.CharField(default=main.models.new_version_token, max_length=32),
+        ),
+    ]
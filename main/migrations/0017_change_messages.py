@@ -0,0 +1,18 @@
+# Generated by Django 3.1.14 on 2026-10-17 21:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0016_schedule_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='schedulechange',
+            name='message',
+            field=models.JSONField(null=True),
+        ),
+    ]
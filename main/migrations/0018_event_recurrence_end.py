@@ -0,0 +1,50 @@
+# Generated by Django 3.1.14 on 2026-10-17 21:40
+
+from importlib import import_module
+
+from django.db import migrations, models
+
+from main.models import recurrence_end
+
+search_index = import_module('main.migrations.0014_search_index')
+
+
+def fill_recurrence_end(apps, schema_editor):
+    Event = apps.get_model('main', 'Event')
+    events = Event.objects.exclude(recurrences__isnull=True).exclude(recurrences='')
+    for event in events.iterator():
+        if event.recurrences.rrules or event.recurrences.rdates:
+            event.recurrence_end = recurrence_end(event.recurrences, event.start_date, event.end_date)
+            event.save(update_fields=['recurrence_end'])
+
+
+# SQLite remakes main_event for the new column, which drops its full-text
+# triggers (see 0014_search_index); the FTS table itself is kept
+def restore_search_triggers(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    create, _, names = search_index.sqlite_index('main_event', search_index.SEARCHED_COLUMNS['main_event'])
+    for statement in create[1:]:
+        schema_editor.execute(statement.format(**names))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0017_change_messages'),
+    ]
+
+    operations = [
+        migrations.RunPython(migrations.RunPython.noop, reverse_code=restore_search_triggers),
+        migrations.AddField(
+            model_name='event',
+            name='recurrence_end',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='event',
+            index=models.Index(fields=['schedule', 'recurrence_end'], name='main_event_schedule_rend_idx'),
+        ),
+        migrations.RunPython(restore_search_triggers, reverse_code=migrations.RunPython.noop),
+        migrations.RunPython(fill_recurrence_end, reverse_code=migrations.RunPython.noop),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 3.1.14 on 2026-10-17 23:40
+
+import hashlib
+
+from django.db import migrations
+
+
+# issued URLs keep working, their keys are replaced by the hashes
+def hash_keys(apps, schema_editor):
+    FeedToken = apps.get_model('main', 'FeedToken')
+    for token in FeedToken.objects.all():
+        token.key_hash = hashlib.sha256(token.key_hash.encode()).hexdigest()
+        token.save(update_fields=['key_hash'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0018_event_recurrence_end'),
+    ]
+
+    operations = [
+        migrations.RenameField(
+            model_name='feedtoken',
+            old_name='key',
+            new_name='key_hash',
+        ),
+        migrations.RunPython(hash_keys, migrations.RunPython.noop),
+    ]
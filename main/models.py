@@ -1,5 +1,12 @@
+import hashlib
+import secrets
+import uuid
+from datetime import datetime
+
 from django.contrib.auth.models import AbstractUser
 from django.db import models
+from django.utils import timezone
+from recurrence.fields import RecurrenceField
 
 MAX_TEXT_FIELD_LENGTH = 4096
 
@@ -14,6 +21,10 @@ class User(AbstractUser):
     pass
 
 
+def new_version_token():
+    return uuid.uuid4().hex
+
+
 # Class = SQL table
 # Field = SQL column
 # Column with id is added automatically
@@ -22,6 +33,9 @@ class Schedule(models.Model):
     owner = models.ForeignKey(User, related_name='owned_schedules', on_delete=models.CASCADE)
     permitted_users = models.ManyToManyField(User, through='SchedulePermission')
     default_permission_level = models.IntegerField()
+    # replaced whenever the schedule or its events change, see api.caching
+    version_token = models.CharField(max_length=32, default=new_version_token)
+    version_modified = models.DateTimeField(default=timezone.now)
 
     def __str__(self):
         return self.name
@@ -38,6 +52,7 @@ class SchedulePermission(models.Model):
     level = models.IntegerField(choices=SchedulePermissionLevels.choices)
     schedule = models.ForeignKey(Schedule, on_delete=models.CASCADE)
     user = models.ForeignKey(User, on_delete=models.CASCADE)
+    updated_at = models.DateTimeField(auto_now=True)
 
 
 class EventType(models.Model):
@@ -48,6 +63,14 @@ class EventType(models.Model):
 
 
 # ManyToManyField automatically creates new table
+# End of the last occurrence of a recurring event, None when a rule repeats forever
+def recurrence_end(recurrences, start_date, end_date):
+    if any(rule.count is None and rule.until is None for rule in recurrences.rrules):
+        return None
+    last = recurrences.to_dateutil_rruleset(dtstart=start_date).before(datetime.max, inc=True)
+    return (last or start_date) + (end_date - start_date)
+
+
 class Event(models.Model):
     title = models.TextField(max_length=MAX_TEXT_FIELD_LENGTH)
     desc = models.TextField(max_length=MAX_TEXT_FIELD_LENGTH, blank=True)
@@ -56,12 +79,57 @@ class Event(models.Model):
     users_marks = models.ManyToManyField(User, blank=True)
     type = models.ForeignKey(EventType, on_delete=models.CASCADE)
     schedule = models.ForeignKey(Schedule, on_delete=models.CASCADE)
+    # RRULE/EXRULE/RDATE/EXDATE lines, start_date is the first occurrence;
+    # single occurrences are cancelled with EXDATE and moved with EXDATE + RDATE
+    recurrences = RecurrenceField(null=True, blank=True)
+    # kept by save(), bulk writes call update_recurrence_end(); range queries
+    # skip the series that ended before them
+    recurrence_end = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         return self.title
 
+    @property
+    def is_recurring(self):
+        return bool(self.recurrences and (self.recurrences.rrules or self.recurrences.rdates))
+
+    def update_recurrence_end(self):
+        if not self.is_recurring:
+            self.recurrence_end = None
+            return
+        # dates may still be strings, as given to create()
+        start_date, end_date = (self._meta.get_field(name).to_python(getattr(self, name))
+                                for name in ('start_date', 'end_date'))
+        self.recurrence_end = recurrence_end(self.recurrences, start_date, end_date)
+
+    def save(self, *args, **kwargs):
+        self.update_recurrence_end()
+        if kwargs.get('update_fields') is not None:
+            kwargs['update_fields'] = set(kwargs['update_fields']) | {'recurrence_end'}
+        super().save(*args, **kwargs)
+
+    class Meta:
+        ordering = ['start_date']
+        indexes = [
+            models.Index(fields=['schedule', 'start_date'], name='main_event_schedule_start_idx'),
+            models.Index(fields=['schedule', 'recurrence_end'], name='main_event_schedule_rend_idx'),
+        ]
+
+
+# Optional materialized occurrences of recurring events (see
+# MATERIALIZE_OCCURRENCES), so that range queries over them use an index
+class EventOccurrence(models.Model):
+    event = models.ForeignKey(Event, related_name='occurrences', on_delete=models.CASCADE)
+    schedule = models.ForeignKey(Schedule, on_delete=models.CASCADE)
+    start_date = models.DateTimeField()
+    end_date = models.DateTimeField()
+
     class Meta:
         ordering = ['start_date']
+        indexes = [
+            models.Index(fields=['schedule', 'start_date'], name='main_occur_schedule_start_idx'),
+        ]
 
 
 class Comment(models.Model):
@@ -70,6 +138,7 @@ class Comment(models.Model):
     author = models.ForeignKey(User, related_name='comments', on_delete=models.CASCADE)
     event = models.ForeignKey(Event, on_delete=models.CASCADE)
     liked_users = models.ManyToManyField(User, related_name='liked_comments', blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         return self.content
@@ -82,6 +151,44 @@ class CommentReply(models.Model):
     author = models.ForeignKey(User, related_name='reply_comments', on_delete=models.CASCADE)
     event = models.ForeignKey(Event, on_delete=models.CASCADE)
     liked_users = models.ManyToManyField(User, related_name='liked_reply_comments', blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         return self.content
+
+
+# Secret of the URL of a user's combined iCal feed (api.ical_views.UserFeed).
+# Calendar apps can't send an Authorization header, so the URL itself is the
+# credential; regenerating the key revokes the old URL. URLs end up in client
+# configs and logs, so only a hash of the key is stored and it is shown once.
+class FeedToken(models.Model):
+    key_hash = models.CharField(max_length=64, unique=True)
+    user = models.OneToOneField(User, related_name='feed_token', on_delete=models.CASCADE)
+    created = models.DateTimeField(auto_now_add=True)
+
+    @staticmethod
+    def generate_key():
+        return secrets.token_urlsafe(32)
+
+    @staticmethod
+    def hash_key(key):
+        return hashlib.sha256(key.encode()).hexdigest()
+
+
+# Append-only log of what changed in a schedule, the id is the sync token
+# clients pass back as ?since=. Deleted objects stay as tombstones until the
+# log is pruned, rows of deleted schedules are left for pruning too.
+class ScheduleChange(models.Model):
+    schedule = models.ForeignKey(Schedule, on_delete=models.DO_NOTHING, db_constraint=False)
+    kind = models.CharField(max_length=16)
+    object_id = models.IntegerField()
+    deleted = models.BooleanField(default=False)
+    # sent to the schedule's change stream, see api.changes.ChangeLogBroker
+    message = models.JSONField(null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['schedule', 'id'], name='main_change_schedule_id_idx'),
+            models.Index(fields=['created_at'], name='main_change_created_idx'),
+        ]
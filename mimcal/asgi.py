@@ -9,8 +9,14 @@ https://docs.djangoproject.com/en/3.1/howto/deployment/asgi/
 
 import os
 
-from django.core.asgi import get_asgi_application
+import django
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'mimcal.settings')
+os.environ.setdefault('ASYNC_READ_VIEWS', '1')
 
-application = get_asgi_application()
+django.setup(set_prefix=False)
+
+# streamed responses (large iCal feeds) are rendered chunk by chunk in a thread
+from mimcal.handlers import StreamingASGIHandler  # noqa: E402
+
+application = StreamingASGIHandler()
@@ -0,0 +1,94 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.cache import cache
+
+REPLICA_DATABASE = 'replica'
+# of the entries of the database cache
+CACHE_APP_LABEL = 'django_cache'
+PIN_COOKIE = 'primary_pin'
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+# set by route_request() for read-only requests
+_use_replica = ContextVar('use_replica', default=False)
+
+
+def use_replica(value):
+    return _use_replica.set(value)
+
+
+def reset_replica(token):
+    _use_replica.reset(token)
+
+
+# Reads that fill a cache keyed by a version token or a credential: the token
+# may already be newer than the replica, which would store stale data under it
+@contextmanager
+def primary_reads():
+    token = _use_replica.set(False)
+    try:
+        yield
+    finally:
+        _use_replica.reset(token)
+
+
+# The rest of the request reads from the primary
+def read_from_primary():
+    _use_replica.set(False)
+
+
+def replica_configured():
+    return REPLICA_DATABASE in settings.DATABASES
+
+
+def _pin_key(user):
+    return 'primary-pin:%d' % user.id
+
+
+# Called once the request is authenticated: read-only requests go to the
+# replica unless the client wrote something in the last REPLICA_PIN_SECONDS,
+# so it reads its own writes while the replica catches up. Users are pinned
+# by id, whatever credentials they send next, anonymous clients by a cookie.
+# Returns the token end_request() needs.
+def route_request(request):
+    if not replica_configured() or request.method not in SAFE_METHODS:
+        return None
+    user = request.user
+    if PIN_COOKIE in request.COOKIES or (user.is_authenticated and cache.get(_pin_key(user)) is not None):
+        return None
+    return use_replica(True)
+
+
+def end_request(request, response, token):
+    if token is not None:
+        reset_replica(token)
+    if not replica_configured() or request.method in SAFE_METHODS or response.status_code >= 400:
+        return
+    pin_seconds = getattr(settings, 'REPLICA_PIN_SECONDS', 10)
+    if request.user.is_authenticated:
+        cache.set(_pin_key(request.user), True, pin_seconds)
+    response.set_cookie(PIN_COOKIE, '1', max_age=pin_seconds, httponly=True)
+
+
+class PrimaryReplicaRouter:
+    """
+    Sends reads of requests routed to the replica (see route_request()) to
+    it and everything else to the primary ('default'). A read-only request
+    that writes reads its writes back in primary_reads().
+    """
+
+    def db_for_read(self, model, **hints):
+        # a lagging copy of the shared cache would hand out stale versions
+        if _use_replica.get() and model._meta.app_label != CACHE_APP_LABEL:
+            return REPLICA_DATABASE
+        return 'default'
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == 'default'
@@ -0,0 +1,44 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.handlers.asgi import ASGIHandler
+from django.db import connections
+
+
+class StreamingASGIHandler(ASGIHandler):
+    """
+    Django 3.1 iterates streaming responses in the event loop, where the ORM
+    can't be used. Here their content is produced by a thread of their own,
+    one chunk at a time, so e.g. a large iCal feed is sent as it is rendered
+    and never held in memory as a whole.
+    """
+
+    async def send_response(self, response, send):
+        if not response.streaming:
+            return await super().send_response(response, send)
+        headers = [(header.encode('ascii') if isinstance(header, str) else header,
+                    value.encode('latin1') if isinstance(value, str) else value)
+                   for header, value in response.items()]
+        headers += [(b'Set-Cookie', cookie.output(header='').encode('ascii').strip())
+                    for cookie in response.cookies.values()]
+        await send({'type': 'http.response.start', 'status': response.status_code, 'headers': headers})
+
+        loop = asyncio.get_event_loop()
+        # one thread for the whole response, so its queries share a connection
+        executor = ThreadPoolExecutor(max_workers=1)
+        chunks = iter(response)
+        try:
+            while True:
+                chunk = await loop.run_in_executor(executor, next, chunks, None)
+                if chunk is None:
+                    break
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body'})
+        finally:
+            await loop.run_in_executor(executor, self.close_response, response)
+            executor.shutdown(wait=False)
+
+    @staticmethod
+    def close_response(response):
+        response.close()
+        connections.close_all()
@@ -0,0 +1,185 @@
+import cProfile
+import json
+import logging
+import os
+import random
+import re
+import time
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+from api.authentication import token_user
+
+logger = logging.getLogger('mimcal.request_metrics')
+
+_request_metrics = ContextVar('request_metrics', default=None)
+
+
+class RequestMetrics:
+    def __init__(self):
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.slowest_query = (0.0, None)
+        self.serializer_time = 0.0
+        self.serializing = False
+        self.view_started = None
+
+
+def record_query(execute, sql, params, many, context):
+    metrics = _request_metrics.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        duration = time.perf_counter() - started
+        metrics.sql_count += 1
+        metrics.sql_time += duration
+        if duration > metrics.slowest_query[0]:
+            metrics.slowest_query = (duration, sql)
+
+
+def install_query_recorder(connection, **kwargs):
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+# Called by api.serializers.TimedSerializerMixin for every object it represents
+def timed_representation(to_representation, instance):
+    metrics = _request_metrics.get()
+    if metrics is None or metrics.serializing:
+        return to_representation(instance)
+    metrics.serializing = True
+    started, sql_time = time.perf_counter(), metrics.sql_time
+    try:
+        return to_representation(instance)
+    finally:
+        metrics.serializing = False
+        # querysets evaluated while serializing are counted as SQL time
+        metrics.serializer_time += time.perf_counter() - started - (metrics.sql_time - sql_time)
+
+
+def view_name(request):
+    match = getattr(request, 'resolver_match', None)
+    return match.view_name if match is not None else None
+
+
+class RequestMetricsMiddleware:
+    """
+    Reports the SQL count and time, serializer time, view time and total
+    time of every request in a Server-Timing header and a JSON log line.
+    The slowest query of a request is logged with the view name when it
+    took at least REQUEST_METRICS_SLOW_QUERY_MS.
+
+    Enabled with REQUEST_METRICS, otherwise it is not even loaded. SQL is
+    recorded by an execute wrapper on every connection, serializer time by
+    the serializers of api.serializers; both only do work while a request
+    is being measured.
+    """
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'REQUEST_METRICS', False):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.slow_query_seconds = getattr(settings, 'REQUEST_METRICS_SLOW_QUERY_MS', 100) / 1000
+        connection_created.connect(install_query_recorder)
+        for connection in connections.all():
+            install_query_recorder(connection)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        metrics = _request_metrics.get()
+        if metrics is not None:
+            metrics.view_started = time.perf_counter()
+
+    def __call__(self, request):
+        metrics = RequestMetrics()
+        token = _request_metrics.set(metrics)
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _request_metrics.reset(token)
+        finished = time.perf_counter()
+        view_time = finished - metrics.view_started if metrics.view_started is not None else 0.0
+
+        timings = [
+            'db;dur=%.1f;desc="%d queries"' % (metrics.sql_time * 1000, metrics.sql_count),
+            'serializer;dur=%.1f' % (metrics.serializer_time * 1000),
+            'view;dur=%.1f' % (view_time * 1000),
+            'total;dur=%.1f' % ((finished - started) * 1000),
+        ]
+        if response.has_header('Server-Timing'):
+            timings.insert(0, response['Server-Timing'])
+        response['Server-Timing'] = ', '.join(timings)
+
+        name = view_name(request)
+        logger.info(json.dumps({
+            'method': request.method, 'path': request.path, 'view': name, 'status': response.status_code,
+            'sql_count': metrics.sql_count, 'sql_ms': round(metrics.sql_time * 1000, 1),
+            'serializer_ms': round(metrics.serializer_time * 1000, 1), 'view_ms': round(view_time * 1000, 1),
+            'total_ms': round((finished - started) * 1000, 1),
+        }))
+        duration, sql = metrics.slowest_query
+        if sql is not None and duration >= self.slow_query_seconds:
+            logger.warning(json.dumps({'slow_query': sql, 'ms': round(duration * 1000, 1), 'view': name,
+                                       'path': request.path}))
+        return response
+
+
+class ProfilingMiddleware:
+    """
+    Profiles a PROFILE_SAMPLE_RATE fraction of requests, and requests of
+    staff users sending an X-Profile header, with cProfile. Profiles are
+    dumped to PROFILE_DIR/<view name>/, where only the newest PROFILE_KEEP
+    files of every view are kept; manage.py profile_report merges them.
+
+    It follows AuthenticationMiddleware, so staff logged in with a session
+    are recognized; a token resolved here is not resolved again by DRF.
+    cProfile records only the thread it was enabled in: the async read views
+    served by mimcal.asgi run their queries in pool threads, and their
+    profiles show little more than the wait for them.
+    """
+    header = 'HTTP_X_PROFILE'
+
+    def __init__(self, get_response):
+        self.directory = getattr(settings, 'PROFILE_DIR', '')
+        if not self.directory:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.sample_rate = getattr(settings, 'PROFILE_SAMPLE_RATE', 0)
+        self.keep = getattr(settings, 'PROFILE_KEEP', 100)
+
+    def is_staff(self, request):
+        user = getattr(request, 'user', None)
+        if user is None or not user.is_authenticated:
+            user = token_user(request)
+        return user is not None and user.is_staff
+
+    def __call__(self, request):
+        if not (random.random() < self.sample_rate or (self.header in request.META and self.is_staff(request))):
+            return self.get_response(request)
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            response = self.get_response(request)
+        finally:
+            profiler.disable()
+        self.dump(profiler, view_name(request) or 'unresolved')
+        return response
+
+    def dump(self, profiler, name):
+        directory = os.path.join(self.directory, re.sub(r'[^\w.-]', '_', name))
+        os.makedirs(directory, exist_ok=True)
+        profiler.dump_stats(os.path.join(directory, '%d-%d.prof' % (time.time_ns(), os.getpid())))
+        # names start with the time, so the oldest sort first
+        files = sorted(f for f in os.listdir(directory) if f.endswith('.prof'))
+        for old in files[:-self.keep]:
+            try:
+                os.remove(os.path.join(directory, old))
+            except FileNotFoundError:
+                pass
@@ -9,6 +9,8 @@ https://docs.djangoproject.com/en/3.1/topics/settings/
 For the full list of settings and their values, see
 https://docs.djangoproject.com/en/3.1/ref/settings/
 """
+import os
+import dj_database_url
 import django_heroku
 from pathlib import Path
 
@@ -36,12 +38,13 @@ INSTALLED_APPS = [
     'rest_framework',
     'rest_framework.authtoken',
     'rest_registration',
+    'recurrence',
     'main',
-    'api'
+    'api.apps.ApiConfig',
 ]
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework.authentication.TokenAuthentication',
+        'api.authentication.CachedTokenAuthentication',
     ),
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticated',
@@ -52,16 +55,20 @@ REST_REGISTRATION = {
     'REGISTER_VERIFICATION_ENABLED': False,
     'REGISTER_EMAIL_VERIFICATION_ENABLED': False,
     'RESET_PASSWORD_VERIFICATION_ENABLED': False,
+    # login only looks for TokenAuthentication itself, not its subclasses
+    'LOGIN_RETRIEVE_TOKEN': True,
     'USER_PUBLIC_FIELDS': ['username']
 }
 
 MIDDLEWARE = [
+    'mimcal.middleware.RequestMetricsMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'mimcal.middleware.ProfilingMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -101,6 +108,102 @@ DATABASES = {
     }
 }
 
+# Version tokens, permission maps, resolved API tokens, rendered responses and
+# replica pins are invalidated by writing to this cache, so every process must
+# reach the same one: redis at REDIS_URL (e.g. the Heroku Redis add-on), or
+# another shared backend named by CACHE_BACKEND and CACHE_LOCATION, e.g.
+# memcached. The database cache doesn't fit: it removes no queries, it moves
+# them (and its culling on every set) to another table. Without either the
+# cache is LocMemCache, a copy per process where invalidation only reaches the
+# process that wrote; it serves development and the tests, and
+# manage.py check --deploy refuses it.
+if os.environ.get('CACHE_BACKEND'):
+    CACHES = {'default': {'BACKEND': os.environ['CACHE_BACKEND'], 'LOCATION': os.environ.get('CACHE_LOCATION', '')}}
+elif os.environ.get('REDIS_URL'):
+    CACHES = {'default': {'BACKEND': 'django_redis.cache.RedisCache', 'LOCATION': os.environ['REDIS_URL']}}
+else:
+    CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+# Anonymous reads of a schedule and its events are cached for
+# RESPONSE_CACHE_TIMEOUT seconds under the schedule's version token
+RESPONSE_CACHE_TIMEOUT = 60 * 60
+
+# Seconds a schedule's version token (kept on the schedule) stays in the cache
+VERSION_CACHE_TIMEOUT = 60 * 60
+
+# Seconds a resolved API token (with its user) stays in the cache
+AUTH_TOKEN_CACHE_TIMEOUT = 300
+
+# Seconds a user's {schedule_id: level} map stays in the cache
+PERMISSION_CACHE_TIMEOUT = 300
+
+# iCal feeds: rendered bodies are cached, feeds above the threshold are streamed
+FEED_CACHE_TIMEOUT = 60 * 60 * 24
+FEED_STREAM_THRESHOLD = 2000
+FEED_STREAM_CHUNK_SIZE = 500
+
+# Most events embedded in a schedule retrieved with ?expand=events
+EMBEDDED_EVENTS_LIMIT = 200
+
+# Longest window of /api/v1/schedules/freebusy/
+FREEBUSY_MAX_DAYS = 92
+
+# Results per type of /api/v1/search/ without ?limit=
+SEARCH_LIMIT = 20
+
+# Recurring events: occurrences are expanded lazily per requested window,
+# or kept in the EventOccurrence table up to OCCURRENCE_HORIZON_DAYS ahead
+MATERIALIZE_OCCURRENCES = False
+OCCURRENCE_HORIZON_DAYS = 366
+
+# Read replica, e.g. REPLICA_DATABASE_URL=sqlite:///replica.sqlite3 with a copy
+# of db.sqlite3 standing in for it locally. Read-only API and feed requests are
+# served from it, clients that wrote through the API are pinned to the primary
+# for REPLICA_PIN_SECONDS.
+if os.environ.get('REPLICA_DATABASE_URL'):
+    DATABASES['replica'] = dj_database_url.parse(os.environ['REPLICA_DATABASE_URL'])
+    DATABASES['replica']['TEST'] = {'MIRROR': 'default'}
+    DATABASE_ROUTERS = ['mimcal.db_routers.PrimaryReplicaRouter']
+REPLICA_PIN_SECONDS = 10
+
+# Set by mimcal.asgi: events listing, comment threads and iCal feeds are
+# served by async views, e.g. gunicorn mimcal.asgi -k uvicorn.workers.UvicornWorker
+ASYNC_READ_VIEWS = os.environ.get('ASYNC_READ_VIEWS', '0') == '1'
+
+# Long polling of schedule changes (schedules/<id>/poll/), not a push. Sync
+# workers answer at once and clients come back after CHANGE_POLL_SYNC_RETRY
+# seconds; under ASGI a poll waits up to CHANGE_POLL_WAIT seconds for changes
+# without a thread. The change log broker reads the messages every process
+# writes to the ScheduleChange log every CHANGE_STREAM_POLL_INTERVAL seconds;
+# api.change_stream.InProcessBroker only reaches clients of the same process
+# and is for development.
+CHANGE_STREAM_BROKER = 'api.changes.ChangeLogBroker'
+CHANGE_STREAM_POLL_INTERVAL = 1
+CHANGE_STREAM_REPLAY = 100
+CHANGE_POLL_WAIT = 15
+CHANGE_POLL_SYNC_RETRY = 5
+
+# Delta sync over the ScheduleChange log. Clients whose token is older than
+# CHANGE_LOG_RETENTION_DAYS get 410 and download the schedule again; run
+# manage.py prune_schedule_changes daily.
+CHANGES_PAGE_SIZE = 500
+CHANGES_SETTLE_SECONDS = 5
+CHANGE_LOG_RETENTION_DAYS = 30
+
+# Per-request SQL count and time, serializer time and view time, sent as a
+# Server-Timing header and logged as JSON by mimcal.middleware; queries slower
+# than REQUEST_METRICS_SLOW_QUERY_MS are logged with the view name
+REQUEST_METRICS = os.environ.get('REQUEST_METRICS', '0') == '1'
+REQUEST_METRICS_SLOW_QUERY_MS = 100
+
+# Sampled cProfile dumps under PROFILE_DIR/<view name>/, PROFILE_KEEP per view,
+# summarized by manage.py profile_report. Staff users, logged in or sending a
+# token, can profile a request with an X-Profile header. Only the request's
+# thread is profiled, so the async read views under ASGI are not covered.
+PROFILE_DIR = os.environ.get('PROFILE_DIR', '')
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', '0'))
+PROFILE_KEEP = 100
+
 # Password validation
 # https://docs.djangoproject.com/en/3.1/ref/settings/#auth-password-validators
 
@@ -140,3 +243,9 @@ USE_TZ = False
 STATIC_URL = '/static/'
 
 django_heroku.settings(locals())
+
+LOGGING['loggers']['mimcal.request_metrics'] = {
+    'handlers': ['console'],
+    'level': 'INFO',
+    'propagate': False,
+}